@@ -4,8 +4,7 @@ import table_api
 app = Flask(__name__)
 
 def myQueryFunc(conn_str, table_name, query=None, fields=None):
-    db = table_api.connect_to_db(conn_str)
-    table = table_api.connect_to_table(db, table_name)
+    table = table_api.get_table(conn_str, table_name)
     query_results = list(table_api.query(table, query, fields))
     return jsonify({"Query results":query_results})
 
@@ -0,0 +1,341 @@
+# Endpoint benchmark for the FastAPI host (fastapi_host.py)
+# Measures the throughput and p50/p95/p99 latency of /api/token, /api/query (a small and a large result set), /api/get, /api/publish and /api/delete
+# at several concurrency levels, and saves the results as JSON so runs can be compared
+#
+# By default the app runs in-process against the in-memory table and user databases (see table_emulator.py and cosmos_emulator.py),
+# so no Azure resources are needed and runs are repeatable. --latency-ms adds a delay to every database request, like a remote database
+# With --url, a running server (ie uvicorn fastapi_host:app) is benchmarked instead, using --username and --password to log in
+#
+# Use case: python benchmarks/endpoint_benchmark.py [options]
+# Options:
+#   --concurrency 1,8,32    how many requests are sent at the same time (a comma separated list of levels)
+#   --requests 200          how many requests are timed per endpoint and concurrency level
+#   --warmup 20             how many untimed requests are sent first, per endpoint and concurrency level
+#   --rows 2000             how many entries are published to the table before the benchmark starts
+#   --partitions 20         how many partitions the entries are spread over
+#   --scenarios a,b         which endpoints to benchmark (default all: token, query_small, query_large, get, publish, delete)
+#   --latency-ms 0          delay added to every request of the in-memory databases
+#   --url URL               benchmark a running server instead of the app in-process
+#   --username, --password  the user to log in as (default the demo admin user, which the in-process user database is seeded with)
+#   --table-name benchmark  the table to use (it is created if it does not exist)
+#   --output FILE           save the results as JSON
+#   --baseline FILE         compare with the JSON results of an earlier run, and exit with 1 if any endpoint regressed
+#   --threshold 0.2         how much worse (as a fraction) throughput or p95 latency can be than the baseline before it counts as a regression
+#
+# The exit code is also 1 if any request failed (requests turned away with a 429 or 503 are counted as rejected instead)
+# Requires httpx (pip install httpx)
+
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ("token", "query_small", "query_large", "get", "publish", "delete")
+DEFAULT_OPTIONS = {
+    "concurrency" : "1,8,32",
+    "requests" : "200",
+    "warmup" : "20",
+    "rows" : "2000",
+    "partitions" : "20",
+    "scenarios" : ",".join(SCENARIOS),
+    "latency-ms" : "0",
+    "url" : None,
+    "username" : "admin",
+    "password" : "adminpw",
+    "table-name" : "benchmark",
+    "output" : None,
+    "baseline" : None,
+    "threshold" : "0.2",
+}
+
+# The demo admin user from fastapi_host (the password is adminpw)
+DEMO_USERS = {
+    "admin" : {
+        "hashed_password" : "$2a$12$oHhJR57XnptaADwh0XZFs.d/wVUVVEwzjol.R2MwOlNyruzL2B4Fm",
+        "permissions" : {"read" : True, "write" : True, "delete" : True},
+        "email" : "myadmin@email.com",
+    },
+}
+
+PUBLISH_PARTITION = "bench-publish"
+
+
+def parse_options(args:list):
+    options = dict(DEFAULT_OPTIONS)
+    i = 0
+    while(i < len(args)):
+        name = args[i][2:] if args[i].startswith("--") else None
+        if(name not in options or i + 1 >= len(args)):
+            raise Exception(f"Unknown option or missing value: {args[i]} (see the top of {os.path.basename(__file__)} for the options)")
+        options[name] = args[i + 1]
+        i += 2
+    return options
+
+
+def partition_name(partition:int):
+    return f"bench-{partition:02}"
+
+
+def row_key(row:int):
+    return f"{row:06}"
+
+
+def entry_text(partition_key:str, row_key:str, number:int):
+    # A typical deployment info file (see values.txt)
+    return (
+        f"PartitionKey = {partition_key}\n"
+        f"RowKey = {row_key}\n"
+        f"version = 1.{number % 100}.{number % 7}\n"
+        f"url = https://example.com/deployments/{number}?region=canadacentral\n"
+        f"description = Deployment number {number} of the benchmark table\n"
+    )
+
+
+def percentile(values:list, percent:float):
+    # Nearest-rank percentile of sorted values
+    if(len(values) == 0):
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+class Benchmark:
+    def __init__(self, client:httpx.AsyncClient, options:dict):
+        self.client = client
+        self.options = options
+        self.table_name = options["table-name"]
+        self.rows = int(options["rows"])
+        self.partitions = max(1, int(options["partitions"]))
+        self.random = random.Random(0)
+        self.headers = {}
+        # The keys published by the publish scenario, which the delete scenario deletes
+        self.published = []
+        self.publish_numbers = itertools.count()
+
+    async def login(self):
+        response = await self.client.post("/api/token", data={"username" : self.options["username"], "password" : self.options["password"]})
+        response.raise_for_status()
+        self.headers = {"Authorization" : "Bearer " + response.json()["access_token"]}
+
+    async def seed(self):
+        # Publishes the entries to query and get, in files of a few hundred entries
+        batch = 500
+        for start in range(0, self.rows, batch):
+            text = "\n".join(entry_text(partition_name(row % self.partitions), row_key(row), row) for row in range(start, min(start + batch, self.rows)))
+            response = await self.client.post("/api/publish/batch", data={"table_name" : self.table_name}, files=[("my_files", ("seed.txt", text.encode("utf-8")))], headers=self.headers)
+            response.raise_for_status()
+
+    def request(self, scenario:str, level:int, number:int):
+        # Returns (url, keyword arguments) for one request of a scenario
+        if(scenario == "token"):
+            return "/api/token", {"data" : {"username" : self.options["username"], "password" : self.options["password"]}}
+        if(scenario == "query_small"):
+            # The first 10 entries of one partition
+            query = f"PartitionKey eq '{partition_name(0)}' and RowKey lt '{row_key(10 * self.partitions)}'"
+            return "/api/query", {"json" : {"table_name" : self.table_name, "query" : query}, "headers" : self.headers}
+        if(scenario == "query_large"):
+            # Every seeded entry
+            query = "PartitionKey ge 'bench-00' and PartitionKey le 'bench-99'"
+            return "/api/query", {"json" : {"table_name" : self.table_name, "query" : query}, "headers" : self.headers}
+        if(scenario == "get"):
+            row = self.random.randrange(self.rows)
+            return "/api/get", {"json" : {"table_name" : self.table_name, "partition_key" : partition_name(row % self.partitions), "id" : row_key(row)}, "headers" : self.headers}
+        if(scenario == "publish"):
+            key = row_key(next(self.publish_numbers))
+            self.published.append(key)
+            return "/api/publish", {"data" : {"table_name" : self.table_name}, "files" : {"my_file" : ("entry.txt", entry_text(PUBLISH_PARTITION, key, number).encode("utf-8"))}, "headers" : self.headers}
+        if(scenario == "delete"):
+            # Deletes what the publish scenario published, or entries which do not exist if it did not run
+            key = self.published.pop() if len(self.published) > 0 else f"missing-{number}"
+            return "/api/delete", {"json" : {"table_name" : self.table_name, "partition_key" : PUBLISH_PARTITION, "id" : key}, "headers" : self.headers}
+        raise Exception(f"Unknown scenario '{scenario}', use some of: {', '.join(SCENARIOS)}")
+
+    async def run_level(self, scenario:str, level:int, count:int):
+        # Sends count requests, level at a time, and returns the latency of each request, how many failed or were turned away, and how long it all took
+        latencies = []
+        errors = 0
+        rejected = 0
+        numbers = iter(range(count))
+
+        async def worker():
+            nonlocal errors, rejected
+            for number in numbers:
+                url, kwargs = self.request(scenario, level, number)
+                start = time.perf_counter()
+                try:
+                    response = await self.client.post(url, **kwargs)
+                    status_code = response.status_code
+                except httpx.HTTPError:
+                    status_code = None
+                latencies.append(time.perf_counter() - start)
+                # The app turns requests away when it is overloaded (ie too many logins waiting for a password hash thread), those are not errors
+                if(status_code in (429, 503)):
+                    rejected += 1
+                elif(status_code is None or status_code >= 400):
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(level)))
+        return latencies, errors, rejected, time.perf_counter() - start
+
+    async def run_scenario(self, scenario:str, level:int):
+        await self.run_level(scenario, level, int(self.options["warmup"]))
+        latencies, errors, rejected, seconds = await self.run_level(scenario, level, int(self.options["requests"]))
+        latencies.sort()
+        return {
+            "requests" : len(latencies),
+            "errors" : errors,
+            "rejected" : rejected,
+            "seconds" : round(seconds, 4),
+            "throughput" : round(len(latencies) / seconds, 2) if seconds > 0 else None,
+            "mean_ms" : round(sum(latencies) / len(latencies) * 1000, 3) if len(latencies) > 0 else None,
+            "p50_ms" : round(percentile(latencies, 50) * 1000, 3) if len(latencies) > 0 else None,
+            "p95_ms" : round(percentile(latencies, 95) * 1000, 3) if len(latencies) > 0 else None,
+            "p99_ms" : round(percentile(latencies, 99) * 1000, 3) if len(latencies) > 0 else None,
+        }
+
+    async def run(self):
+        await self.login()
+        await self.seed()
+        results = {}
+        levels = [int(level) for level in self.options["concurrency"].split(",")]
+        scenarios = [scenario.strip() for scenario in self.options["scenarios"].split(",")]
+        # Publish runs before delete, so delete has entries to delete
+        scenarios.sort(key=lambda scenario: SCENARIOS.index(scenario) if scenario in SCENARIOS else -1)
+        for scenario in scenarios:
+            results[scenario] = {}
+            for level in levels:
+                result = await self.run_scenario(scenario, level)
+                results[scenario][str(level)] = result
+                print("  {:<12} concurrency {:>3}  {:>9.1f} req/s  p50 {:>8.2f} ms  p95 {:>8.2f} ms  p99 {:>8.2f} ms  errors {}  rejected {}".format(scenario, level, result["throughput"] or 0, result["p50_ms"] or 0, result["p95_ms"] or 0, result["p99_ms"] or 0, result["errors"], result["rejected"]), flush=True)
+        return results
+
+
+def configure_in_process(options:dict):
+    # Points the app at fresh in-memory databases, this has to happen before fastapi_host is imported
+    seed = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(DEMO_USERS, seed)
+    seed.close()
+    latency = options["latency-ms"]
+    name = f"benchmark-{os.getpid()}"
+    os.environ["JWK"] = os.environ.get("JWK") or secrets.token_hex(32)
+    os.environ["CUSTOMCONNSTR_USER"] = f"memory://{name}-users?latency_ms={latency}&seed={seed.name}"
+    os.environ["USER_DB_NAME"] = "benchmark"
+    os.environ["USER_CONTAINER_NAME"] = "users"
+    os.environ["USER_PARTITION_KEY_PATH"] = "/id"
+    os.environ["CUSTOMCONNSTR_TABLE"] = f"memory://{name}-tables?latency_ms={latency}"
+    os.environ["TABLE_NAME"] = options["table-name"]
+    os.environ["TABLE_EMULATOR_URLS"] = "true"
+    for variable in ("TABLE_EMULATOR", "USER_DB_EMULATOR"):
+        os.environ.pop(variable, None)
+    return seed.name
+
+
+async def benchmark(options:dict):
+    timeout = httpx.Timeout(120)
+    if(options["url"] is not None):
+        async with httpx.AsyncClient(base_url=options["url"], timeout=timeout, limits=httpx.Limits(max_connections=None)) as client:
+            return await Benchmark(client, options).run()
+
+    seed_path = configure_in_process(options)
+    try:
+        import fastapi_host
+        # Runs the startup and shutdown events, like uvicorn does
+        async with fastapi_host.app.router.lifespan_context(fastapi_host.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=fastapi_host.app), base_url="http://benchmark", timeout=timeout) as client:
+                return await Benchmark(client, options).run()
+    finally:
+        os.remove(seed_path)
+
+
+def compare(results:dict, baseline:dict, threshold:float):
+    '''
+    Compare benchmark results with an earlier run
+
+    Parameters:
+    - results (required): the "results" of this run
+    - baseline (required): the "results" of the earlier run
+    - threshold (required): how much worse (as a fraction) throughput or p95 latency can be before it counts as a regression
+
+    Return:
+    a list of messages, one for each endpoint and concurrency level which regressed
+    '''
+
+    regressions = []
+    for scenario, levels in results.items():
+        for level, result in levels.items():
+            before = baseline.get(scenario, {}).get(level)
+            if(before is None):
+                continue
+            if(before["throughput"] and result["throughput"] is not None and result["throughput"] < before["throughput"] * (1 - threshold)):
+                regressions.append(f"{scenario} at concurrency {level}: throughput went from {before['throughput']} to {result['throughput']} req/s")
+            if(before["p95_ms"] and result["p95_ms"] is not None and result["p95_ms"] > before["p95_ms"] * (1 + threshold)):
+                regressions.append(f"{scenario} at concurrency {level}: p95 latency went from {before['p95_ms']} to {result['p95_ms']} ms")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(args:list):
+    options = parse_options(args)
+    print("Benchmarking {} ({} requests per endpoint and concurrency level)".format(options["url"] or "the app in-process with in-memory databases", options["requests"]), flush=True)
+    results = asyncio.run(benchmark(options))
+
+    report = {
+        "run" : {
+            "time" : datetime.now(timezone.utc).isoformat(),
+            "commit" : git_commit(),
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "cpus" : os.cpu_count(),
+            "options" : {name : value for name, value in options.items() if name not in ("password", "output", "baseline")},
+        },
+        "results" : results,
+    }
+    if(options["output"] is not None):
+        with open(options["output"], "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved the results to {options['output']}")
+
+    failed = False
+    errors = sum(result["errors"] for levels in results.values() for result in levels.values())
+    if(errors > 0):
+        print(f"{errors} requests failed")
+        failed = True
+    if(options["baseline"] is not None):
+        with open(options["baseline"], "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        # Results are only comparable when the same workload was run
+        for name in ("url", "rows", "partitions", "latency-ms", "requests"):
+            if(baseline["run"]["options"].get(name) != options[name]):
+                print(f"Warning: the baseline was run with --{name} {baseline['run']['options'].get(name)}, this run used {options[name]}")
+        regressions = compare(results, baseline["results"], float(options["threshold"]))
+        for regression in regressions:
+            print("Regression: " + regression)
+        if(len(regressions) > 0):
+            failed = True
+        else:
+            print(f"No regressions compared with {options['baseline']}")
+    return 1 if failed else 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,77 @@
+# Micro-benchmark for table_api.parse_entries
+# Generates multi-MB key-value pair inputs and measures parsing throughput (and peak memory) for each kind of source
+#
+# Use case: python benchmarks/parse_benchmark.py [size in MB] ...
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import table_api
+
+
+def make_input(size_mb:float):
+    # Entries look like a typical deployment info file, about 400 bytes each, separated by blank lines
+    lines = []
+    size = 0
+    i = 0
+    while(size < size_mb * 1024 * 1024):
+        entry = (
+            f'id = "deployment-{i}"\n'
+            f'PartitionKey = "environment-{i % 16}"\n'
+            f'version = 1.{i % 100}.{i % 7}\n'
+            f'url = "https://example.com/deployments/{i}?region=canadacentral&slot=production"\n'
+            f'description = "Deployment number {i} of the NCYD configuration service, published by the pipeline"\n'
+            f'commit = {i * 2654435761 % 2**32:08x}{i * 40503 % 2**16:04x}\n\n'
+        )
+        lines.append(entry)
+        size += len(entry)
+        i += 1
+    return "".join(lines).encode("utf-8")
+
+
+def measure(name:str, make_source, size:int):
+    source = make_source()
+    start = time.perf_counter()
+    count = 0
+    for _ in table_api.parse_entries(source):
+        count += 1
+    elapsed = time.perf_counter() - start
+    if(hasattr(source, "close")):
+        source.close()
+
+    # Memory is measured in a separate pass, since tracing allocations slows parsing down a lot
+    source = make_source()
+    tracemalloc.start()
+    for _ in table_api.parse_entries(source):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if(hasattr(source, "close")):
+        source.close()
+    print("  {:<8} {:>9} entries  {:>8.1f} MB/s  {:>10.0f} entries/s  peak memory {:>7.2f} MB".format(name, count, size / elapsed / 1024 / 1024, count / elapsed, peak / 1024 / 1024))
+
+
+def run(size_mb:float):
+    data = make_input(size_mb)
+    print("Input of {:.1f} MB".format(len(data) / 1024 / 1024))
+
+    with tempfile.NamedTemporaryFile(suffix=".txt", delete=False) as file:
+        file.write(data)
+        path = file.name
+    try:
+        # Note: the bytes source starts with the whole input in memory already, it is not counted in its peak memory
+        measure("bytes", lambda: data, len(data))
+        measure("path", lambda: path, len(data))
+        measure("stream", lambda: open(path, "rb"), len(data))
+    finally:
+        os.remove(path)
+
+
+if(__name__ == "__main__"):
+    sizes = [float(size) for size in sys.argv[1:]] or [4, 16]
+    for size in sizes:
+        run(size)
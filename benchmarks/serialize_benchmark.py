@@ -0,0 +1,101 @@
+# Micro-benchmark for entity_json
+# Serializes query results made of typical entities (strings, numbers, 64-bit integers, datetimes, GUIDs) with the old path
+# (FastAPI's jsonable_encoder then json.dumps, and json.dumps(indent=2) for the CLI) and with entity_json, and measures the throughput of each
+# The columnar and Arrow formats of /api/query are measured too, along with how much smaller they are
+#
+# Use case: python benchmarks/serialize_benchmark.py [number of entities] ...
+
+from azure.data.tables import EdmType, EntityProperty, TableEntity
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fastapi.encoders import jsonable_encoder
+import entity_json
+
+
+def make_entities(count:int):
+    # Entities look like a typical deployment info entry, read back from the database
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    entities = []
+    for i in range(count):
+        entity = TableEntity({
+            "PartitionKey" : f"environment-{i % 16}",
+            "RowKey" : f"deployment-{i}",
+            "version" : f"1.{i % 100}.{i % 7}",
+            "url" : f"https://example.com/deployments/{i}?region=canadacentral&slot=production",
+            "description" : f"Deployment number {i} of the NCYD configuration service, published by the pipeline",
+            "replicas" : i % 12,
+            "cpu" : (i % 40) / 10,
+            "enabled" : i % 3 != 0,
+            "size" : EntityProperty(i * 2654435761, EdmType.INT64),
+            "deployed" : start + timedelta(minutes=i),
+            "build" : UUID(int=i * 40503),
+        })
+        entity._metadata = {"etag" : f"W/\"datetime'{start + timedelta(minutes=i):%Y-%m-%dT%H:%M:%S}Z'\"", "timestamp" : start + timedelta(minutes=i)}
+        entities.append(entity)
+    return entities
+
+
+def old_response(content):
+    # What FastAPI's JSONResponse did for a returned dict
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def old_cli(content):
+    # The CLI used json.dumps(indent=2), default=str stands in for the types it could not serialize
+    return json.dumps(content, indent=2, default=str).encode("utf-8")
+
+
+def json_fallback(content):
+    # entity_json without orjson installed
+    orjson = entity_json.orjson
+    entity_json.orjson = None
+    try:
+        return entity_json.dumps(content)
+    finally:
+        entity_json.orjson = orjson
+
+
+def measure(name:str, serialize, content, count:int, repeat:int = 3):
+    # The best of a few runs
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = serialize(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("  {:<28} {:>9.1f} ms  {:>10.0f} entities/s  {:>8.1f} MB/s".format(name, best * 1000, count / best, len(output) / best / 1024 / 1024))
+    return best
+
+
+def run(count:int):
+    content = {"Query results" : make_entities(count)}
+    print(f"{count} entities" + ("" if entity_json.orjson is not None else " (orjson is not installed, entity_json uses the json module)"))
+    old = measure("jsonable_encoder + json", old_response, content, count)
+    new = measure("entity_json.dumps", entity_json.dumps, content, count)
+    measure("entity_json (json fallback)", json_fallback, content, count)
+    measure("entity_json + metadata", lambda content: entity_json.dumps({"Query results" : [entity_json.with_metadata(entity) for entity in content["Query results"]]}), content, count)
+    old_indent = measure("CLI json.dumps(indent=2)", old_cli, content, count)
+    new_indent = measure("CLI entity_json (indent)", lambda content: entity_json.dumps(content, indent=True), content, count)
+    measure("entity_json columnar", lambda content: entity_json.dumps({"Query results" : entity_json.columnar(content["Query results"])}), content, count)
+    if(entity_json.pyarrow is not None):
+        measure("entity_json arrow", lambda content: entity_json.arrow_stream(entity_json.columnar(content["Query results"])), content, count)
+    print("  Response {:.1f}x faster, CLI {:.1f}x faster".format(old / new, old_indent / new_indent))
+    rows_size = len(entity_json.dumps(content))
+    columnar_size = len(entity_json.dumps({"Query results" : entity_json.columnar(content["Query results"])}))
+    print("  Rows {:.1f} KB, columnar {:.1f} KB ({:.0%})".format(rows_size / 1024, columnar_size / 1024, columnar_size / rows_size), end="")
+    if(entity_json.pyarrow is not None):
+        arrow_size = len(entity_json.arrow_stream(entity_json.columnar(content["Query results"])))
+        print(", arrow {:.1f} KB ({:.0%})".format(arrow_size / 1024, arrow_size / rows_size), end="")
+    print()
+
+
+if(__name__ == "__main__"):
+    counts = [int(count) for count in sys.argv[1:]] or [1000, 10000, 100000]
+    for count in counts:
+        run(count)
@@ -0,0 +1,230 @@
+from azure.data.tables import TableClient
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+import csv
+import entity_json
+import os
+import queue
+import sys
+import threading
+import table_api
+
+# Streaming table export for the table_api CLI (python table_api.py export ...)
+#
+# Entities are read a page at a time and written out straight away, so memory use does not depend on the size of the table
+# When the partitions (or PartitionKey ranges) are given, each one is scanned by its own thread and the pages are merged into one output
+
+
+
+DEFAULT_WORKERS = 4
+FORMATS = ("jsonl", "csv", "parquet")
+
+
+class JsonlWriter:
+    def __init__(self, file:TextIO, fields:Optional[List[str]]):
+        self.file = file
+
+    def write_page(self, entities:List[Dict[str, Any]]):
+        self.file.write("".join(entity_json.dumps(entity_json.plain_entity(entity)).decode("utf-8") + "\n" for entity in entities))
+
+    def close(self):
+        return []
+
+
+class CsvWriter:
+    # The columns are the projected fields, or else the columns in the first page
+    # (columns that only show up later are left out, and reported when the export is done)
+    def __init__(self, file:TextIO, fields:Optional[List[str]]):
+        self.file = file
+        self.fields = fields
+        self.writer = None
+        self.dropped = set()
+
+    def write_page(self, entities:List[Dict[str, Any]]):
+        if(len(entities) == 0):
+            return
+        if(self.writer is None):
+            if(self.fields is None):
+                self.fields = list(dict.fromkeys(key for entity in entities for key in entity))
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fields, extrasaction="ignore")
+            self.writer.writeheader()
+        for entity in entities:
+            self.dropped.update(key for key in entity if key not in self.writer.fieldnames)
+        self.writer.writerows(entity_json.plain_entity(entity) for entity in entities)
+
+    def close(self):
+        return sorted(self.dropped)
+
+
+class ParquetWriter:
+    # The schema is the projected fields, or else the columns in the first page, with types taken from the first page:
+    # boolean, integer (64-bit) and double columns keep their type, integers mixed with doubles are doubles, and anything else
+    # (strings, mixed types, or a column with no values yet) is a string column, where values of other types are written as JSON
+    # A later value which does not fit its column (ie a string in an integer column) is left empty, and its field is reported when the export is done
+    def __init__(self, path:str, fields:Optional[List[str]]):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception("Exporting to Parquet requires pyarrow, install it with 'pip install pyarrow'")
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.path = path
+        self.fields = fields
+        self.writer = None
+        self.schema = None
+        self.dropped = set()
+        self.mismatched = set()
+
+    def _column_type(self, column:List[Any]):
+        types = set(map(type, column)) - {type(None)}
+        if(types == {bool}):
+            return self.pyarrow.bool_()
+        if(types == {int}):
+            return self.pyarrow.int64()
+        if(len(types) > 0 and types <= {int, float}):
+            return self.pyarrow.float64()
+        return self.pyarrow.string()
+
+    def _fit_column(self, field:str, column:List[Any], arrow_type):
+        # The values of a column converted to its type, where they can be
+        types = set(map(type, column)) - {type(None)}
+        if(arrow_type == self.pyarrow.string()):
+            if(types <= {str}):
+                return column
+            return [value if value is None or isinstance(value, str) else entity_json.dumps(value).decode("utf-8") for value in column]
+        allowed = {bool} if arrow_type == self.pyarrow.bool_() else {int} if arrow_type == self.pyarrow.int64() else {int, float}
+        if(types <= allowed):
+            return column
+        self.mismatched.add(field)
+        return [value if type(value) in allowed else None for value in column]
+
+    def write_page(self, entities:List[Dict[str, Any]]):
+        if(len(entities) == 0):
+            return
+        rows = [entity_json.plain_entity(entity) for entity in entities]
+        if(self.schema is None):
+            if(self.fields is None):
+                self.fields = list(dict.fromkeys(key for row in rows for key in row))
+            self.schema = self.pyarrow.schema([(field, self._column_type([row.get(field) for row in rows])) for field in self.fields])
+            self.writer = self.parquet.ParquetWriter(self.path, self.schema)
+        for row in rows:
+            self.dropped.update(key for key in row if key not in self.schema.names)
+        columns = {column.name : self._fit_column(column.name, [row.get(column.name) for row in rows], column.type) for column in self.schema}
+        self.writer.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        if(self.writer is not None):
+            self.writer.close()
+        return sorted(self.dropped)
+
+
+def export_table(table:TableClient, writer, query:Optional[str] = None, fields:Optional[List[str]] = None, partitions:Optional[List[str]] = None, ranges:Optional[List[Tuple[str, str]]] = None, workers:int = DEFAULT_WORKERS, progress:bool = True):
+    '''
+    Stream a table (or part of it) into a writer a page at a time, scanning partitions at the same time when they are given
+
+    Parameters:
+    - table (required): a TableClient which points to the table to export
+    - writer (required): a JsonlWriter, CsvWriter or ParquetWriter
+    - query: a string to specify the query (see table_api.query for formatting). None exports every entry
+    - fields: a list of which fields should be exported. None exports all fields
+    - partitions: a list of PartitionKeys to scan at the same time
+    - ranges: a list of (start, end) PartitionKey ranges to scan at the same time
+    - workers: how many scans can run at the same time
+    - progress: whether to print how many entries have been exported
+
+    Return:
+    the number of entries exported
+    '''
+
+    # Checks the query before any scans start
+    scans = table_api.split_query(table_api.plan_query(query).filter, partitions, ranges)
+    # Bounded, so the scans wait for the writer instead of reading the table into memory
+    pages:"queue.Queue[Optional[list]]" = queue.Queue(maxsize=max(1, workers) * 2)
+    scans_left:"queue.Queue[tuple]" = queue.Queue()
+    for scan in scans:
+        scans_left.put(scan)
+    errors:List[BaseException] = []
+    stop = threading.Event()
+
+    def scan():
+        try:
+            while(not stop.is_set()):
+                try:
+                    scan_filter, parameters = scans_left.get_nowait()
+                except queue.Empty:
+                    return
+                for page in table.query_entities(query_filter=scan_filter, select=fields, parameters=parameters, results_per_page=table_api.MAX_PAGE_SIZE).by_page():
+                    pages.put(list(page))
+                    if(stop.is_set()):
+                        return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            pages.put(None)
+
+    threads = [threading.Thread(target=scan, daemon=True) for _ in range(max(1, min(workers, len(scans))))]
+    for thread in threads:
+        thread.start()
+
+    count = 0
+    running = len(threads)
+    while(running > 0):
+        page = pages.get()
+        if(page is None):
+            running -= 1
+            continue
+        if(stop.is_set()):
+            # Keep draining, so the scans are not stuck waiting to hand over a page
+            continue
+        try:
+            writer.write_page(page)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+            continue
+        count += len(page)
+        if(progress):
+            print(f"\r{count} entries exported", end="", file=sys.stderr, flush=True)
+    if(progress):
+        print(f"\r{count} entries exported", file=sys.stderr, flush=True)
+
+    if(len(errors) > 0):
+        raise errors[0]
+    return count
+
+
+def cli_export(connection_string:str, output_path:str, export_format:Optional[str] = None, query_str:Optional[str] = None, fields:Optional[List[str]] = None, partitions:Optional[List[str]] = None, ranges:Optional[List[Tuple[str, str]]] = None, workers:int = DEFAULT_WORKERS):
+    if(export_format is None):
+        extension = os.path.splitext(output_path)[1].lower().lstrip(".")
+        export_format = {"ndjson" : "jsonl", "pq" : "parquet"}.get(extension, extension)
+        if(export_format not in FORMATS):
+            export_format = "jsonl"
+    if(export_format not in FORMATS):
+        raise Exception(f"Unknown export format '{export_format}', use one of: {', '.join(FORMATS)}")
+    if(fields is not None and len(fields) == 0):
+        fields = None
+
+    table = table_api.get_table(connection_string, table_api.DEFAULT_TABLE_NAME)
+
+    file = None
+    if(export_format == "parquet"):
+        if(output_path == "-"):
+            raise Exception("Parquet exports need an output file")
+        writer = ParquetWriter(output_path, fields)
+    else:
+        file = sys.stdout if output_path == "-" else open(output_path, "w", encoding="utf-8", newline="")
+        writer = JsonlWriter(file, fields) if export_format == "jsonl" else CsvWriter(file, fields)
+
+    try:
+        count = export_table(table, writer, query_str, fields, partitions, ranges, workers)
+    finally:
+        dropped = writer.close()
+        if(file is not None and file is not sys.stdout):
+            file.close()
+
+    if(len(dropped) > 0):
+        print("Warning: these fields only showed up after the columns were decided, and were left out (use -f to choose the columns): {}".format(", ".join(dropped)), file=sys.stderr)
+    if(isinstance(writer, ParquetWriter) and len(writer.mismatched) > 0):
+        print("Warning: these fields had values of another type than their column (taken from the first page), which were left empty: {}".format(", ".join(sorted(writer.mismatched))), file=sys.stderr)
+    print("Successfully exported {} entries to {}".format(count, output_path if output_path != "-" else "standard output"), file=sys.stderr)
@@ -0,0 +1,287 @@
+from azure.data.tables import TableClient
+from typing import Any, Dict, List, Set
+import csv
+import glob
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import table_api
+
+# Parallel bulk import for the table_api CLI (python table_api.py import ...)
+#
+# Parser threads read the input files and cut their entries into segments of SEGMENT_SIZE entries
+# Writer threads take the segments and upload them with per-partition transactions (see table_api.upsert_entries)
+# Every segment that was fully written is recorded in a checkpoint file, so a failed import can be run again
+# and will skip everything that was already written
+#
+# Parsing runs at roughly 30 MB/s per thread (see benchmarks/parse_benchmark.py), far faster than the database can take writes,
+# so threads are enough: what matters is keeping several transactions in flight at the same time
+
+
+
+# How many entries make up one resumable unit of work
+SEGMENT_SIZE = 1000
+DEFAULT_WRITERS = 4
+DEFAULT_PARSERS = 2
+DEFAULT_CHECKPOINT_PATH = ".import-checkpoint"
+
+
+def find_input_files(paths:List[str]):
+    '''
+    Expand the import inputs into a list of files
+
+    Parameters:
+    - paths (required): a list of files, directories (every file inside, recursively) or glob patterns (ie data/**/*.jsonl)
+
+    Return:
+    a sorted list of file paths, without duplicates
+    '''
+
+    files = []
+    for path in paths:
+        if(any(char in path for char in "*?[")):
+            files.extend(match for match in glob.glob(path, recursive=True) if os.path.isfile(match))
+        elif(os.path.isdir(path)):
+            for root, dirs, names in os.walk(path):
+                # Skip hidden directories and files (ie .git)
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                files.extend(os.path.join(root, name) for name in names if not name.startswith("."))
+        elif(os.path.isfile(path)):
+            files.append(path)
+        else:
+            raise FileNotFoundError(f"No such file, directory or matching files: {path}")
+    return sorted(set(files))
+
+
+def read_entries(path:str):
+    '''
+    Read the entries from an input file, based on its extension:
+    - .jsonl or .ndjson: one JSON object per line
+    - .csv: one entry per row, with the column names in the first row
+    - anything else: key-value pair text (see table_api.parse_entries)
+
+    Parameters:
+    - path (required): the path to the file
+
+    Return:
+    an iterator of dictionaries, one per entry
+    '''
+
+    extension = os.path.splitext(path)[1].lower()
+    if(extension in (".jsonl", ".ndjson")):
+        with open(path, "r", encoding="utf-8-sig") as file:
+            for number, line in enumerate(file, 1):
+                line = line.strip()
+                if(line == ""):
+                    continue
+                entry = json.loads(line)
+                if(not isinstance(entry, dict)):
+                    raise ValueError(f"Line {number} of {path} is not a JSON object")
+                yield table_api.add_default_keys(entry)
+    elif(extension == ".csv"):
+        with open(path, "r", encoding="utf-8-sig", newline="") as file:
+            for row in csv.DictReader(file):
+                # Empty cells are left out instead of being stored as empty strings
+                yield table_api.add_default_keys({key : value for key, value in row.items() if key is not None and value != ""})
+    else:
+        yield from table_api.parse_entries(path)
+
+
+def read_segments(path:str):
+    '''
+    Cut the entries of an input file into segments of up to SEGMENT_SIZE entries
+
+    Parameters:
+    - path (required): the path to the file
+
+    Return:
+    an iterator of tuples (segment id, list of entries), where the segment id is unique and stays the same between runs
+    '''
+
+    segment = []
+    index = 0
+    for entry in read_entries(path):
+        segment.append(entry)
+        if(len(segment) >= SEGMENT_SIZE):
+            yield f"{os.path.abspath(path)}#{index}", segment
+            segment = []
+            index += 1
+    if(len(segment) > 0):
+        yield f"{os.path.abspath(path)}#{index}", segment
+
+
+class Checkpoint:
+    '''
+    The segments that have been fully written, stored one per line in a file so an import can be resumed
+    '''
+
+    def __init__(self, path:str):
+        self.path = path
+        self.done:Set[str] = set()
+        if(os.path.exists(path)):
+            with open(path, "r", encoding="utf-8") as file:
+                self.done = set(line.rstrip("\n") for line in file if line.strip() != "")
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def mark_done(self, segment_id:str):
+        with self._lock:
+            self.done.add(segment_id)
+            self._file.write(segment_id + "\n")
+            # Flush every time, so the checkpoint survives the import being killed
+            self._file.flush()
+
+    def close(self, remove:bool = False):
+        self._file.close()
+        if(remove):
+            os.remove(self.path)
+
+
+class ImportStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.skipped = 0
+        self.start = time.monotonic()
+
+    def add(self, written:int = 0, failed:int = 0, skipped:int = 0):
+        with self.lock:
+            self.written += written
+            self.failed += failed
+            self.skipped += skipped
+
+    def line(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.written / elapsed if elapsed > 0 else 0
+        return f"{self.written} written, {self.failed} failed, {self.skipped} skipped (already imported) | {rate:.0f} entries/s | {elapsed:.0f}s"
+
+
+def import_files(table:TableClient, files:List[str], checkpoint:Checkpoint, writers:int = DEFAULT_WRITERS, parsers:int = DEFAULT_PARSERS, progress:bool = True):
+    '''
+    Import entries from files into a table, with parser and writer threads (see the top of this module)
+
+    Parameters:
+    - table (required): a TableClient which points to the table to import into
+    - files (required): the input files (see find_input_files)
+    - checkpoint (required): where to record and skip the segments that were already written
+    - writers: how many transactions can be in flight at the same time
+    - parsers: how many files are parsed at the same time
+    - progress: whether to print the live throughput
+
+    Return:
+    a tuple (stats, failures) with the ImportStats and a list of the results of the entries that failed (see table_api.batch_results)
+    '''
+
+    stats = ImportStats()
+    failures:List[Dict[str, Any]] = []
+    errors:List[BaseException] = []
+    # Bounded, so parsers wait for the writers instead of reading everything into memory (None tells a writer to stop)
+    segments:"queue.Queue[tuple]" = queue.Queue(maxsize=writers * 2)
+    files_left:"queue.Queue[str]" = queue.Queue()
+    for path in files:
+        files_left.put(path)
+    stop = threading.Event()
+
+    def parse():
+        try:
+            while(not stop.is_set()):
+                try:
+                    path = files_left.get_nowait()
+                except queue.Empty:
+                    return
+                for segment_id, entries in read_segments(path):
+                    if(segment_id in checkpoint.done):
+                        stats.add(skipped=len(entries))
+                        continue
+                    segments.put((segment_id, entries))
+                    if(stop.is_set()):
+                        return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def write():
+        while(True):
+            item = segments.get()
+            if(item is None):
+                return
+            segment_id, entries = item
+            if(stop.is_set()):
+                # Something went wrong, drain the queue without writing so the parsers are not stuck waiting
+                continue
+            try:
+                results = table_api.upsert_entries(table, entries)
+            except Exception as e:
+                # Anything else that goes wrong with a segment (ie a connection error) fails just that segment, which is retried by the next run
+                # Some of its batches may have been written, but writing them again does no harm
+                results = table_api.batch_results(entries, e)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                continue
+            failed = [result for result in results if not result["success"]]
+            stats.add(written=len(results) - len(failed), failed=len(failed))
+            if(len(failed) == 0):
+                checkpoint.mark_done(segment_id)
+            else:
+                with stats.lock:
+                    failures.extend(failed)
+
+    parser_threads = [threading.Thread(target=parse, daemon=True) for _ in range(max(1, parsers))]
+    writer_threads = [threading.Thread(target=write, daemon=True) for _ in range(max(1, writers))]
+    for thread in parser_threads + writer_threads:
+        thread.start()
+
+    while(any(thread.is_alive() for thread in parser_threads)):
+        for thread in parser_threads:
+            thread.join(timeout=1)
+        if(progress):
+            print("\r" + stats.line(), end="", file=sys.stderr, flush=True)
+    # Tell each writer there is nothing left once they finish what is queued
+    for _ in writer_threads:
+        segments.put(None)
+    while(any(thread.is_alive() for thread in writer_threads)):
+        for thread in writer_threads:
+            thread.join(timeout=1)
+        if(progress):
+            print("\r" + stats.line(), end="", file=sys.stderr, flush=True)
+    if(progress):
+        print("\r" + stats.line(), file=sys.stderr, flush=True)
+
+    if(len(errors) > 0):
+        raise errors[0]
+    return stats, failures
+
+
+def cli_import(connection_string:str, paths:List[str], writers:int = DEFAULT_WRITERS, parsers:int = DEFAULT_PARSERS, checkpoint_path:str = DEFAULT_CHECKPOINT_PATH):
+    files = find_input_files(paths)
+    if(len(files) == 0):
+        raise Exception("No input files were found")
+
+    table = table_api.get_table(connection_string, table_api.DEFAULT_TABLE_NAME)
+    checkpoint = Checkpoint(checkpoint_path)
+    if(len(checkpoint.done) > 0):
+        print(f"Resuming import from checkpoint '{checkpoint_path}' ({len(checkpoint.done)} segments already imported)")
+    print(f"Importing {len(files)} files with {writers} writers and {parsers} parsers")
+
+    try:
+        stats, failures = import_files(table, files, checkpoint, writers, parsers)
+    except BaseException:
+        checkpoint.close()
+        print(f"Import stopped, run the same command again to continue from checkpoint '{checkpoint_path}'")
+        raise
+
+    for result in failures:
+        print("Failed to import entry with PartitionKey '{}' and RowKey '{}': {}".format(result["PartitionKey"], result["RowKey"], result["error"]))
+    if(len(failures) > 0):
+        checkpoint.close()
+        print(f"Run the same command again to retry the failed entries, everything else is recorded in checkpoint '{checkpoint_path}'")
+        raise Exception("Failed to import {} entries".format(len(failures)))
+
+    # Everything made it, so the next import starts fresh
+    checkpoint.close(remove=True)
+    print("Successfully imported {} entries".format(stats.written))
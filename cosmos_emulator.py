@@ -0,0 +1,196 @@
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
+from azure.data.tables import UpdateMode
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+import json
+import os
+import re
+import table_emulator
+
+# A local stand-in for the async Cosmos container that holds the users (see fastapi_host.get_user_container), for testing and benchmarking
+#
+# Selected with the user database connection string, using the same schemes as table_emulator:
+# - memory://<name> or sqlite:///<path>, optionally with:
+#   - ?latency_ms=<milliseconds> added to every request
+#   - &partition_key_path=</path> the partition key path of the containers (default /id)
+#   - &seed=<path to a JSON file> users to add when a container is empty, either a list of user documents
+#     or an object of documents keyed by username (like demo_user_db in fastapi_host)
+#
+# Setting USER_DB_EMULATOR to one of these connection strings uses it whatever CUSTOMCONNSTR_USER is
+#
+# Items are stored in the table emulator (one table per container, partitioned by the partition key value), and get an _etag like in Cosmos
+# Queries only support SELECT * FROM c, optionally with WHERE c.<field> = @<parameter> conditions joined by AND
+
+
+
+USER_DB_EMULATOR = os.environ.get("USER_DB_EMULATOR")
+DEFAULT_PARTITION_KEY_PATH = "/id"
+
+_CONDITION_PATTERN = re.compile(r"^c\.(\w+)\s*=\s*(@\w+)$")
+
+
+def is_emulator_url(conn_str:Optional[str]):
+    return table_emulator.is_emulator_url(conn_str)
+
+
+def emulator_connection_string(conn_str:Optional[str]):
+    '''
+    Get the emulator connection string to use instead of conn_str
+
+    Parameters:
+    - conn_str: the user database connection string
+
+    Return:
+    an emulator connection string, or None if the connection should go to Azure
+    '''
+
+    if(is_emulator_url(conn_str)):
+        return conn_str
+    return USER_DB_EMULATOR
+
+
+def _parse_query(query:str, parameters:Optional[List[Dict[str, Any]]]):
+    # Returns the (field, value) pairs an item must match
+    match = re.match(r"^\s*SELECT\s+\*\s+FROM\s+c(?:\s+WHERE\s+(.+?))?\s*$", query, re.IGNORECASE)
+    if(match is None):
+        raise ValueError(f"The user database emulator only supports SELECT * FROM c [WHERE c.<field> = @<parameter> AND ...], not: {query}")
+    values = {parameter["name"] : parameter["value"] for parameter in parameters or []}
+    conditions = []
+    if(match.group(1) is not None):
+        for condition in re.split(r"\s+AND\s+", match.group(1), flags=re.IGNORECASE):
+            condition_match = _CONDITION_PATTERN.match(condition.strip())
+            if(condition_match is None):
+                raise ValueError(f"The user database emulator does not support the condition: {condition}")
+            conditions.append((condition_match.group(1), values[condition_match.group(2)]))
+    return conditions
+
+
+class ContainerProxy:
+    '''
+    The emulated async ContainerProxy, with the methods used for the users
+    '''
+
+    def __init__(self, client:"CosmosClient", database_name:str, container_name:str):
+        self.client = client
+        self.id = container_name
+        self._table = table_emulator.AsyncTableClient(client.store, client.url, f"cosmos-{database_name}-{container_name}", client.latency)
+        self._seeded = False
+
+    async def _ready(self):
+        # Creates the container, and adds the seed users the first time it is used while empty
+        if(self._seeded):
+            return
+        self.client.store.create_table(self._table.table_name)
+        self._seeded = True
+        if(self.client.seed_path is None):
+            return
+        if(len([item async for item in self._table.list_entities(results_per_page=1)]) > 0):
+            return
+        with open(self.client.seed_path, "r", encoding="utf-8") as file:
+            seed = json.load(file)
+        if(isinstance(seed, dict)):
+            seed = [{"id" : username, **document} for username, document in seed.items()]
+        for document in seed:
+            await self.upsert_item(document)
+
+    def _partition_value(self, body:Dict[str, Any]):
+        value = body
+        for part in self.client.partition_key_path.strip("/").split("/"):
+            value = value[part]
+        return str(value)
+
+    def _to_item(self, entity:Dict[str, Any]):
+        item = json.loads(entity["document"])
+        item["_etag"] = entity.metadata["etag"]
+        item["_ts"] = int(entity.metadata["timestamp"].timestamp())
+        return item
+
+    def _to_entity(self, body:Dict[str, Any]):
+        document = {key : value for key, value in body.items() if not key.startswith("_")}
+        return {"PartitionKey" : self._partition_value(body), "RowKey" : body["id"], "document" : json.dumps(document)}
+
+    async def read(self, **kwargs):
+        await self._ready()
+        return {"id" : self.id, "partitionKey" : {"paths" : [self.client.partition_key_path], "kind" : "Hash"}}
+
+    async def read_item(self, item:str, partition_key:Any, **kwargs):
+        await self._ready()
+        try:
+            return self._to_item(await self._table.get_entity(partition_key=str(partition_key), row_key=item))
+        except ResourceNotFoundError:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} was not found")
+
+    async def query_items(self, query:str, parameters:Optional[List[Dict[str, Any]]] = None, **kwargs):
+        await self._ready()
+        conditions = _parse_query(query, parameters)
+        async for entity in self._table.list_entities():
+            item = self._to_item(entity)
+            if(all(item.get(field) == value for field, value in conditions)):
+                yield item
+
+    async def create_item(self, body:Dict[str, Any], **kwargs):
+        await self._ready()
+        try:
+            await self._table.create_entity(self._to_entity(body))
+        except ResourceExistsError:
+            raise CosmosResourceExistsError(status_code=409, message=f"Item {body['id']} already exists")
+        return await self.read_item(body["id"], self._partition_value(body))
+
+    async def upsert_item(self, body:Dict[str, Any], **kwargs):
+        await self._ready()
+        await self._table.upsert_entity(self._to_entity(body), mode=UpdateMode.REPLACE)
+        return await self.read_item(body["id"], self._partition_value(body))
+
+    async def replace_item(self, item:str, body:Dict[str, Any], etag:Optional[str] = None, match_condition:Optional[MatchConditions] = None, **kwargs):
+        await self._ready()
+        try:
+            await self._table.update_entity(self._to_entity({**body, "id" : item}), mode=UpdateMode.REPLACE, etag=etag, match_condition=match_condition)
+        except ResourceNotFoundError:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} was not found")
+        except ResourceModifiedError:
+            raise CosmosAccessConditionFailedError(status_code=412, message=f"Item {item} was changed since it was read")
+        return await self.read_item(item, self._partition_value(body))
+
+    async def delete_item(self, item:str, partition_key:Any, **kwargs):
+        await self._ready()
+        await self.read_item(item, partition_key)
+        await self._table.delete_entity(partition_key=str(partition_key), row_key=item)
+
+
+class DatabaseProxy:
+    def __init__(self, client:"CosmosClient", database_name:str):
+        self.client = client
+        self.id = database_name
+
+    def get_container_client(self, container:str):
+        return ContainerProxy(self.client, self.id, container)
+
+
+class CosmosClient:
+    '''
+    The emulated async CosmosClient (see the top of this module for the connection strings)
+    '''
+
+    def __init__(self, conn_str:str):
+        options = parse_qs(urlsplit(conn_str).query)
+        self.store, self.url, self.latency = table_emulator.open_store(conn_str)
+        self.partition_key_path = options.get("partition_key_path", [DEFAULT_PARTITION_KEY_PATH])[0]
+        self.seed_path = options.get("seed", [None])[0]
+
+    @classmethod
+    def from_connection_string(cls, conn_str:str, credential:Any = None, **kwargs):
+        return cls(conn_str)
+
+    def get_database_client(self, database:str):
+        return DatabaseProxy(self, database)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
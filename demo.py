@@ -5,6 +5,38 @@ query_string = "RowKey eq 'id' or new_property gt 100"
 fields = ["PartitionKey", "RowKey", "new_property"]
 text_path = "./values.txt"
 
+
+def decode_columnar(response:requests.Response):
+    '''
+    Turn query results sent in the "columnar" or "arrow" format back into a list of entities (dicts), like the default "rows" format
+    Properties an entity does not have are left out, and reading Arrow needs the pyarrow package
+
+    Parameters:
+    - response (required): the response of /api/query
+
+    Return:
+    the entities, and the continuation token (None when there are no more pages)
+    '''
+
+    if(response.headers.get("content-type", "").startswith("application/vnd.apache.arrow.stream")):
+        import pyarrow
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        metadata = table.schema.metadata or {}
+        # Columns of mixed types are sent as JSON
+        json_columns = [field.name for field in table.schema if (field.metadata or {}).get(b"edm_type") == b"json"]
+        entities = [{key : (json.loads(value) if key in json_columns else value) for key, value in row.items() if value is not None} for row in table.to_pylist()]
+        continuation = metadata.get(b"continuation")
+        return entities, None if continuation is None else continuation.decode("utf-8")
+
+    data = response.json()
+    results = data["Query results"]
+    entities = [{} for _ in range(results["Count"])]
+    for field, column in zip(results["Fields"], results["Columns"]):
+        for entity, value in zip(entities, column):
+            if(value is not None):
+                entity[field] = value
+    return entities, data.get("continuation")
+
 # Demo users
 payload = {"username":"admin", "password":"adminpw"}
 # payload = {"username":"dev", "password":"devpw"}
@@ -43,6 +75,16 @@ data = response.json()
 print(json.dumps(data, indent=True))
 
 
+print("--------------Querying in the columnar format-------------")
+# Each property name is sent once instead of once per entity, which is much smaller for many results
+# Use "format":"arrow" to get an Arrow IPC stream instead (if the server has pyarrow installed)
+payload = {"query":query_string, "fields":fields, "format":"columnar"}
+response = requests.post("http://localhost:8000/api/query", json=payload, headers=headers)
+print(response.status_code)
+entities, continuation = decode_columnar(response)
+print(json.dumps(entities, indent=True))
+
+
 print("---------------Getting item 4 of query--------------")
 payload = {"partition_key":data["Query results"][3]["PartitionKey"], "id":data["Query results"][3]["RowKey"]}
 # response = requests.post("https://ncydtestapi.azurewebsites.net/api/get", json=payload, headers=headers)
@@ -51,6 +93,14 @@ print(response.status_code)
 print(json.dumps(response.json(), indent=True))
 
 
+print("---------------Getting items 1 to 3 of query at once--------------")
+payload = {"keys":[{"partition_key":entity["PartitionKey"], "id":entity["RowKey"]} for entity in data["Query results"][:3]] + [{"id":"owisde984"}]}
+# response = requests.post("https://ncydtestapi.azurewebsites.net/api/get", json=payload, headers=headers)
+response = requests.post("http://localhost:8000/api/get", json=payload, headers=headers)
+print(response.status_code)
+print(json.dumps(response.json(), indent=True))
+
+
 print("--------------Getting inexistant item----------------")
 payload = {"id":"owisde984"}
 # response = requests.post("https://ncydtestapi.azurewebsites.net/api/get", json=payload, headers=headers)
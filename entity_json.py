@@ -0,0 +1,240 @@
+from azure.data.tables import EdmType, EntityProperty
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Iterable, Optional, Sequence
+from uuid import UUID
+import base64
+import json
+
+# Fast JSON serialization of TableEntity results, for the FastAPI host, the table_api CLI and bulk_export
+#
+# Entities are written straight to bytes with orjson (falling back to the json module when it is not installed),
+# instead of going through FastAPI's jsonable_encoder one field at a time first
+# The output is the same as before: EntityProperty values (ie 64-bit integers) are [value, EDM type] pairs, datetimes are ISO 8601 and GUIDs are strings
+# Binary values are base64 encoded, and NaN/infinity (which are not valid JSON) are null
+#
+# Results can also be encoded by column (see columnar), which sends each property name once instead of once per entity,
+# either as JSON or as an Arrow IPC stream (when pyarrow is installed)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# The EDM type of plain property values, in order (bool before int, since booleans are integers in Python)
+_EDM_TYPES = [(bool, EdmType.BOOLEAN), (int, EdmType.INT32), (float, EdmType.DOUBLE), (str, EdmType.STRING), (datetime, EdmType.DATETIME), (UUID, EdmType.GUID), (bytes, EdmType.BINARY)]
+_INT32_MIN = -2**31
+_INT32_MAX = 2**31 - 1
+
+
+
+def _default(value:Any):
+    # The types orjson (or json) do not know how to serialize by themselves
+    if(isinstance(value, EntityProperty)):
+        return [value.value, value.edm_type]
+    if(isinstance(value, bytes)):
+        return base64.b64encode(value).decode("ascii")
+    if(isinstance(value, datetime)):
+        # orjson only knows datetime itself, not subclasses like the SDK's TablesEntityDatetime
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _default_json(value:Any):
+    # The json module also needs help with the types orjson serializes natively
+    if(isinstance(value, datetime)):
+        return value.isoformat()
+    if(isinstance(value, UUID)):
+        return str(value)
+    if(isinstance(value, Enum)):
+        return value.value
+    return _default(value)
+
+
+def _finite(value:Any):
+    # The json module writes NaN and Infinity (which are not valid JSON), so they are replaced with None like orjson does
+    if(isinstance(value, float) and (value != value or value in (float("inf"), float("-inf")))):
+        return None
+    if(isinstance(value, dict)):
+        return {key : _finite(item) for key, item in value.items()}
+    if(isinstance(value, (list, tuple)) and not isinstance(value, EntityProperty)):
+        return [_finite(item) for item in value]
+    return value
+
+
+def dumps(value:Any, indent:bool = False):
+    '''
+    Serialize entities (or any JSON-like value containing them) to JSON
+
+    Parameters:
+    - value (required): the value to serialize
+    - indent: whether to indent the output by 2 spaces
+
+    Return:
+    the JSON as UTF-8 bytes
+    '''
+
+    if(orjson is not None):
+        return orjson.dumps(value, default=_default, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(_finite(value), default=_default_json, indent=2 if indent else None, separators=None if indent else (",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def with_metadata(entity:Dict[str, Any]):
+    '''
+    Get a copy of an entity with its ETag and timestamp added as "odata.etag" and "Timestamp", like the service returns them
+    '''
+
+    metadata = getattr(entity, "metadata", None) or {}
+    result = dict(entity)
+    if(metadata.get("etag") is not None):
+        result["odata.etag"] = metadata["etag"]
+    if(metadata.get("timestamp") is not None):
+        result["Timestamp"] = metadata["timestamp"]
+    return result
+
+
+def plain_value(value:Any):
+    '''
+    Convert a property value read from the database into a plain JSON/CSV friendly value
+    (64-bit integers and other typed properties, datetimes, GUIDs and binary data)
+    '''
+
+    if(isinstance(value, EntityProperty)):
+        value = value.value
+    if(isinstance(value, datetime)):
+        return value.isoformat()
+    if(isinstance(value, UUID)):
+        return str(value)
+    if(isinstance(value, bytes)):
+        return base64.b64encode(value).decode("ascii")
+    return value
+
+
+def plain_entity(entity:Dict[str, Any]):
+    return {key : plain_value(value) for key, value in entity.items()}
+
+
+
+def _edm_types(column:Sequence[Any]):
+    # The EDM types of the values of a column, looking at each Python type once instead of at each value
+    types = set()
+    for value_type in set(map(type, column)):
+        if(value_type is type(None)):
+            continue
+        if(issubclass(value_type, EntityProperty)):
+            types.update(EdmType(value.edm_type) for value in column if type(value) is value_type)
+        elif(value_type is int):
+            integers = [value for value in column if type(value) is int]
+            types.add(EdmType.INT32 if _INT32_MIN <= min(integers) and max(integers) <= _INT32_MAX else EdmType.INT64)
+        else:
+            types.add(next((edm_type for python_type, edm_type in _EDM_TYPES if issubclass(value_type, python_type)), None))
+    return types
+
+
+def _column_type(column:Sequence[Any]):
+    # The EDM type shared by every value of a column (missing values do not count), or None when they differ
+    types = _edm_types(column)
+    if(types == {EdmType.INT32, EdmType.INT64}):
+        # 32-bit integers fit in a 64-bit integer column
+        return EdmType.INT64
+    if(len(types) != 1):
+        return None
+    return types.pop()
+
+
+def columnar(entities:Iterable[Dict[str, Any]], fields:Optional[Sequence[str]] = None):
+    '''
+    Encode entities by column: the property names once, the EDM type of each column, and one list of values per column
+    A value is None where an entity does not have the property, and columns which mix types (ie a string in one entity and a number in another)
+    have no type and keep their values as they are (EntityProperty values stay [value, EDM type] pairs)
+
+    Parameters:
+    - entities (required): the entities to encode
+    - fields: the properties to put first, in order (ie the fields selected by the query), even if no entity has them
+
+    Return:
+    a dict with "Fields" (the property names), "Types" (the EDM type of each column, or None), "Columns" (the values of each column) and "Count" (how many entities)
+    '''
+
+    entities = list(entities)
+    fields = list(fields) if fields is not None else []
+    # Entities from the same table mostly have the same properties in the same order, so there are only a few distinct key lists to go through
+    seen = set(fields)
+    for keys in dict.fromkeys(tuple(entity) for entity in entities):
+        for key in keys:
+            if(key not in seen):
+                seen.add(key)
+                fields.append(key)
+
+    columns = [[entity.get(field) for entity in entities] for field in fields]
+    types = [_column_type(column) for column in columns]
+    for i, column_type in enumerate(types):
+        # The type is given once for the whole column, so typed values do not need to carry it
+        if(column_type is not None and EntityProperty in set(map(type, columns[i]))):
+            columns[i] = [value.value if isinstance(value, EntityProperty) else value for value in columns[i]]
+    return {"Fields" : fields, "Types" : types, "Columns" : columns, "Count" : len(entities)}
+
+
+def _arrow_type(edm_type:Optional[EdmType]):
+    return {
+        EdmType.STRING : pyarrow.string(),
+        EdmType.INT32 : pyarrow.int32(),
+        EdmType.INT64 : pyarrow.int64(),
+        EdmType.DOUBLE : pyarrow.float64(),
+        EdmType.BOOLEAN : pyarrow.bool_(),
+        EdmType.DATETIME : pyarrow.timestamp("us", tz="UTC"),
+        EdmType.GUID : pyarrow.string(),
+        EdmType.BINARY : pyarrow.binary(),
+    }.get(edm_type)
+
+
+def arrow_stream(table:Dict[str, Any], continuation:Optional[str] = None):
+    '''
+    Write entities encoded by columnar as an Arrow IPC stream (needs pyarrow)
+    Each field's metadata has its EDM type, and columns without a single type are sent as JSON strings (with the EDM type "json")
+
+    Parameters:
+    - table (required): what columnar returned
+    - continuation: the continuation token of the page, kept in the schema's metadata
+
+    Return:
+    the stream as bytes
+    '''
+
+    if(pyarrow is None):
+        raise RuntimeError("Arrow needs the pyarrow package, which is not installed")
+
+    arrays = []
+    schema_fields = []
+    for name, edm_type, column in zip(table["Fields"], table["Types"], table["Columns"]):
+        arrow_type = _arrow_type(edm_type)
+        if(edm_type == EdmType.GUID):
+            column = [None if value is None else str(value) for value in column]
+        array = None
+        if(arrow_type is not None):
+            try:
+                array = pyarrow.array(column, type=arrow_type)
+            except (pyarrow.ArrowException, TypeError, ValueError, OverflowError):
+                array = None
+        if(array is None):
+            # Mixed (or unexpected) values are kept exactly, as JSON
+            edm_type = "json"
+            array = pyarrow.array([None if value is None else dumps(value).decode("utf-8") for value in column], type=pyarrow.string())
+        arrays.append(array)
+        schema_fields.append(pyarrow.field(name, array.type, metadata={"edm_type" : str(edm_type.value if isinstance(edm_type, EdmType) else edm_type)}))
+
+    metadata = {"count" : str(table["Count"])}
+    if(continuation is not None):
+        metadata["continuation"] = continuation
+    batch = pyarrow.record_batch(arrays, schema=pyarrow.schema(schema_fields, metadata=metadata))
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
@@ -1,14 +1,34 @@
-from azure.cosmos import CosmosClient
+from azure.cosmos.aio import CosmosClient
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosResourceNotFoundError
+from concurrent.futures import ThreadPoolExecutor
 from azure.identity import DefaultAzureCredential
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict
-from fastapi import FastAPI, File, Form, HTTPException, Response, UploadFile, status, Depends
+from typing import Optional, List, Dict, Union
+from fastapi import FastAPI, File, Form, Header, HTTPException, Response, UploadFile, status, Depends
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from starlette.concurrency import iterate_in_threadpool
 from jose import ExpiredSignatureError, JWTError, jwt
 from pydantic import BaseModel
 from passlib.context import CryptContext
+from ttl_cache import TTLCache
+import asyncio
+import base64
+import cosmos_emulator
+import entity_json
+import hashlib
+import hmac
+import json
+import metrics
+import odata_filter
 import table_api
+import table_api_async
+import table_emulator
 import os
+import profiling
+import time
 
 # Token specifications and tools
 # A 256-bit secret key (32 digit hexadecimal, or 64 letters total)
@@ -21,15 +41,42 @@ SECRET_KEY = os.environ["JWK"]
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 15
 
+# With stateless tokens, the user's permissions (and role version) are signed into the token when they log in,
+# so authenticated requests are authorized from the token alone, without looking the user up
+# A permission change then applies when the user logs in again, or straight away if invalidate_user is called (which revokes their older tokens on this instance)
+STATELESS_TOKENS = os.environ.get("STATELESS_TOKENS", "false").lower() in ("1", "true", "yes")
+# With stateless tokens, how often (in seconds) the user's role_version is read from the database to reject tokens minted before a role change (0 never reads it)
+# This is one read per user every ROLE_VERSION_CHECK_SECONDS, not one per request
+ROLE_VERSION_CHECK_SECONDS = float(os.environ.get("ROLE_VERSION_CHECK_SECONDS", "0"))
+# How many tokens which passed their signature check are remembered (until they expire), so repeated requests skip decoding them again
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get("VERIFIED_TOKEN_CACHE_SIZE", "4096"))
+
 # User and role database info
 USER_DB_CONN_STR = os.environ["CUSTOMCONNSTR_USER"]
 USER_DB_NAME = os.environ["USER_DB_NAME"]
 USER_CONTAINER_NAME = os.environ["USER_CONTAINER_NAME"]
+# The partition key path of the user container (ie /id), if not set it is read from the container itself
+USER_PARTITION_KEY_PATH = os.environ.get("USER_PARTITION_KEY_PATH")
+
+# How long (in seconds) authenticated users and their permissions are cached for, and how many are kept
+# A role change takes up to USER_CACHE_TTL_SECONDS to apply, unless invalidate_user is called
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.environ.get("USER_CACHE_MAX_SIZE", "1024"))
+
+# bcrypt is slow on purpose, so hashing and verifying passwords runs on its own thread pool instead of the event loop
+# (bcrypt releases the GIL, so threads run it in parallel)
+# When more than PASSWORD_HASH_QUEUE_LIMIT logins are waiting for a worker, new logins are turned away with a 503
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get("PASSWORD_HASH_QUEUE_LIMIT", str(PASSWORD_HASH_WORKERS * 4)))
 
 # Table database info
 DEFAULT_TABLE_CONN_STRING = os.environ["CUSTOMCONNSTR_TABLE"]
 DEFAULT_TABLE_NAME = os.environ["TABLE_NAME"]
 
+# Prometheus metrics are served at /metrics (see metrics.py)
+# If METRICS_TOKEN is set, scrapers have to send it as a bearer token (Authorization: Bearer <METRICS_TOKEN>)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
 # We store hashed passwords in the database for security reasons:
 # If an attacker ever got access to the database, they cannot steal the real plaintext password, as one cannot unhash somehting
 # This is important especially because people use the same password for many different things
@@ -63,19 +110,81 @@ DEFAULT_TABLE_NAME = os.environ["TABLE_NAME"]
 
 
 class Query(BaseModel):
-    connection_string : Optional[str]
-    table_name : Optional[str]
-    query : Optional[str]
-    fields : Optional[List[str]]
+    connection_string : Optional[str] = None
+    table_name : Optional[str] = None
+    query : Optional[str] = None
+    fields : Optional[List[str]] = None
+    # Send the results as newline-delimited JSON (one entity per line) as they arrive, instead of all at once
+    # Sending the header "Accept: application/x-ndjson" does the same thing
+    stream : Optional[bool] = None
+    # Get the results a page at a time: page_size is the maximum number of results per page,
+    # and continuation is the token returned with the previous page (leave it out for the first page)
+    page_size : Optional[int] = None
+    continuation : Optional[str] = None
+    # Scan the partitions of the table at the same time instead of one long scan (not used with page_size/continuation)
+    # Leave fan_out out to let the server decide, which it does once it knows how many partitions the table has (see table_api.FANOUT_DISCOVERY)
+    # Giving partitions only reads those partitions, and always fans out
+    fan_out : Optional[bool] = None
+    partitions : Optional[List[str]] = None
+    # Keep the results ordered by PartitionKey and RowKey when fanning out (otherwise they come in as each partition answers)
+    # Leave it out to keep them ordered unless fan_out or partitions were given, so a fan-out the server decided on returns the same order as a scan
+    ordered : Optional[bool] = None
+    # The maximum number of results to return
+    limit : Optional[int] = None
+    # Only describe how the query would run (see odata_filter.plan_query) instead of running it
+    explain : Optional[bool] = None
+    # Add each entity's ETag and timestamp as "odata.etag" and "Timestamp"
+    metadata : Optional[bool] = None
+    # How to send the results (not used with stream):
+    # - "rows" (the default): a list of entities
+    # - "columnar": the property names once, then the values of each property (see entity_json.columnar), which is much smaller for many results
+    # - "arrow": the same columns as an Arrow IPC stream, if the server has pyarrow installed
+    # Sending the header "Accept: application/vnd.apache.arrow.stream" does the same thing as "arrow"
+    format : Optional[str] = None
 
 
 class Entity(BaseModel):
-    connection_string : Optional[str]
-    table_name : Optional[str]
-    partition_key : Optional[str]
+    connection_string : Optional[str] = None
+    table_name : Optional[str] = None
+    partition_key : Optional[str] = None
+    id : str
+
+
+class EntityKey(BaseModel):
+    partition_key : Optional[str] = None
     id : str
 
 
+# Either a single entity (id and partition_key), or many entities at once (keys)
+class EntityGet(Entity):
+    id : Optional[str] = None
+    keys : Optional[List[EntityKey]] = None
+    # Add each entity's ETag and timestamp as "odata.etag" and "Timestamp"
+    metadata : Optional[bool] = None
+
+
+class BulkDelete(BaseModel):
+    connection_string : Optional[str] = None
+    table_name : Optional[str] = None
+    # Either the keys of the entities to delete, or a query string for which entities to delete
+    keys : Optional[List[EntityKey]] = None
+    query : Optional[str] = None
+    # Only count how many entities would be deleted
+    dry_run : bool = False
+
+
+# Incremental sync: call without since the first time, then with the watermark returned by the last call (see table_api.changes)
+class Changes(BaseModel):
+    connection_string : Optional[str] = None
+    table_name : Optional[str] = None
+    since : Optional[str] = None
+    query : Optional[str] = None
+    fields : Optional[List[str]] = None
+    # Get the changes a page at a time, like a paged query: the watermark only comes with the last page (when continuation is null)
+    page_size : Optional[int] = None
+    continuation : Optional[str] = None
+
+
 class Permissions(BaseModel):
     read : bool
     write : bool
@@ -86,6 +195,8 @@ class User(BaseModel):
     username : str
     email : Optional[str]
     permissions : Permissions
+    # Bumped in the user's document whenever their roles/permissions change, so stateless tokens minted before can be rejected
+    role_version : int = 0
 
 
 class UserInDB(User):
@@ -107,6 +218,15 @@ class TokenData(BaseModel):
 
 app = FastAPI()
 
+
+# Endpoints which return entities return this directly (instead of a dict), so FastAPI does not run jsonable_encoder over every field first
+class EntityJSONResponse(JSONResponse):
+    def render(self, content):
+        return entity_json.dumps(content)
+
+# Times every request, and lets the metrics recorded while handling it know which route it is for
+app.add_middleware(metrics.MetricsMiddleware)
+
 # tokenURL is the path to take for getting a token (logging in)
 # No need to add scopes, that is for situations when user decides what permissions they want to give third-party applications
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token")
@@ -114,27 +234,145 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token")
 # Set the hash functions to use the "bcrypt" algorithm
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+password_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+# How many hash jobs are running or waiting in password_hash_pool, only touched from the event loop
+password_hash_pending = 0
+
+# Users (without their hashed password) looked up for authenticated requests, so we don't hit the database every request
+user_cache = TTLCache(max_size=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+# Tokens which passed their signature check, with their claims (and the user built from them for stateless tokens), each kept until the token expires
+verified_tokens = TTLCache(max_size=VERIFIED_TOKEN_CACHE_SIZE, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+# With stateless tokens: the current role_version of users, read at most every ROLE_VERSION_CHECK_SECONDS
+role_versions = TTLCache(max_size=USER_CACHE_MAX_SIZE, ttl=ROLE_VERSION_CHECK_SECONDS, cache_none=True)
+# With stateless tokens: tokens issued at or before these times (in seconds since the epoch) are rejected, per username (None for everyone)
+token_revocations:Dict[Optional[str], int] = {}
+
+
+# The user container client is long-lived, so we only pay for creating the client (and its connections) once
+cosmosdb_acc = None
+user_container = None
+user_partition_key_path = None
+user_container_lock = asyncio.Lock()
+
+
+async def get_user_container():
+    global cosmosdb_acc, user_container, user_partition_key_path
+    async with user_container_lock:
+        if user_container is None:
+            # The Microsoft pre-configured RBAC
+            # cosmosdb_acc = CosmosClient("https://ncydsqlcosmos.documents.azure.com:443/", DefaultAzureCredential(exclude_interactive_browser_credential=False))
+            emulator_conn_str = cosmos_emulator.emulator_connection_string(USER_DB_CONN_STR)
+            if emulator_conn_str is not None:
+                # A local user database for testing and benchmarking (see cosmos_emulator)
+                cosmosdb_acc = cosmos_emulator.CosmosClient.from_connection_string(emulator_conn_str)
+            else:
+                cosmosdb_acc = CosmosClient.from_connection_string(USER_DB_CONN_STR, **metrics.azure_hooks("user"))
+            await cosmosdb_acc.__aenter__()
+            userdb = cosmosdb_acc.get_database_client(USER_DB_NAME)
+            container = userdb.get_container_client(USER_CONTAINER_NAME)
+            if USER_PARTITION_KEY_PATH is not None:
+                user_partition_key_path = USER_PARTITION_KEY_PATH
+            else:
+                user_partition_key_path = (await container.read())["partitionKey"]["paths"][0]
+            user_container = container
+        return user_container
+
+
+@app.on_event("startup")
+async def connect_user_container():
+    await get_user_container()
+
+
+@app.on_event("shutdown")
+async def close_connections():
+    global cosmosdb_acc, user_container
+    if cosmosdb_acc is not None:
+        await cosmosdb_acc.close()
+        cosmosdb_acc = None
+        user_container = None
+    for task in list(discovery_tasks.values()):
+        task.cancel()
+    await table_api_async.close_client_pool()
+    password_hash_pool.shutdown(wait=False)
+
 
 # Can use the demo_user_db here instead
-def get_user(username:str):
-    # The Microsoft pre-configured RBAC
-    # cosmosdb_acc = CosmosClient("https://ncydsqlcosmos.documents.azure.com:443/", DefaultAzureCredential(exclude_interactive_browser_credential=False))
-    cosmosdb_acc = CosmosClient.from_connection_string(USER_DB_CONN_STR)
-    userdb = cosmosdb_acc.get_database_client(USER_DB_NAME)
-    container = userdb.get_container_client(USER_CONTAINER_NAME)
-
-    # Query for our user
-    results = list(container.query_items(query="SELECT * FROM c WHERE c.id = @username",
-        parameters=[dict(name="@username", value=username)],
-        enable_cross_partition_query=True
-    ))
-    if(len(results) == 0):
-        return None
+async def get_user_document(username:str):
+    container = await get_user_container()
+
+    if user_partition_key_path == "/id":
+        # When the container is partitioned by id, the username is both the item id and the partition key
+        # So we can do a point read, which is much cheaper than a query
+        try:
+            return await container.read_item(item=username, partition_key=username)
+        except CosmosResourceNotFoundError:
+            return None
     else:
-        # The **dict means to pass all the key/value pairs in the dictionary as keyword arguments
-        # So with a dict of d={"a":1, "b":2}, func(**d) == func(a=1, b=2)
-        # It also automatically discards any keys that do not match a keyword argument
-        return UserInDB(**results[0], username=results[0]["id"])
+        # Otherwise we do not know which partition the user is in, so query for our user across all of them
+        results = [item async for item in container.query_items(query="SELECT * FROM c WHERE c.id = @username",
+            parameters=[dict(name="@username", value=username)]
+        )]
+        if(len(results) == 0):
+            return None
+        return results[0]
+
+
+async def get_user(username:str):
+    with metrics.stage("user.get_user"):
+        result = await get_user_document(username)
+    if result is None:
+        return None
+    # The **dict means to pass all the key/value pairs in the dictionary as keyword arguments
+    # So with a dict of d={"a":1, "b":2}, func(**d) == func(a=1, b=2)
+    # It also automatically discards any keys that do not match a keyword argument
+    return UserInDB(**result, username=result["id"])
+
+
+async def update_hashed_password(username:str, hashed_password:str):
+    container = await get_user_container()
+    document = await get_user_document(username)
+    if document is None:
+        return
+    document["hashed_password"] = hashed_password
+    # Only replace the user if nobody else changed it since we read it, the rehash can wait until the next login
+    try:
+        await container.replace_item(item=document["id"], body=document, etag=document["_etag"], match_condition=MatchConditions.IfNotModified)
+    except CosmosHttpResponseError:
+        pass
+
+
+# Clients are pooled inside table_api_async, so this does not reconnect or re-create the table on every request
+async def get_table(connection_string:Optional[str] = None, table_name:Optional[str] = None):
+    if table_emulator.is_emulator_url(connection_string):
+        # The local databases are for tests and benchmarks run by whoever runs the app (see TABLE_EMULATOR), not for API callers
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Emulator connection strings (memory:// and sqlite://) can't be used through the API")
+    if connection_string is None:
+        connection_string = DEFAULT_TABLE_CONN_STRING
+    if table_name is None:
+        table_name = DEFAULT_TABLE_NAME
+    return await table_api_async.get_table(connection_string, table_name)
+
+
+def invalidate_user(username:Optional[str] = None):
+    # Call this when a user's roles/permissions change, so the next request reloads them from the database
+    # None forgets every cached user
+    user_cache.invalidate(username)
+    role_versions.invalidate(username)
+    if STATELESS_TOKENS:
+        # Their permissions are signed into their tokens, so the tokens they already have are revoked instead and they have to log in again
+        # Tokens only carry whole seconds, so a token minted in this same second is revoked too
+        token_revocations[username] = int(time.time())
+
+
+def get_cached_user(username:str):
+    async def load_user():
+        user = await get_user(username)
+        if user is None:
+            return None
+        return User(**user.dict())
+    # Concurrent requests for the same user share a single database lookup
+    return user_cache.aget_or_load(username, load_user)
 
 
 def get_hashed_password(plain_password:str):
@@ -145,6 +383,28 @@ def verify_password(plain_password:str, hashed_password:str):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+async def run_password_hash(func, *args):
+    # Run a password hashing function on the password hash pool, so the event loop can keep serving other requests
+    global password_hash_pending
+    if password_hash_pending >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many logins at the moment, please try again later", headers={"Retry-After" : "1"})
+    password_hash_pending += 1
+    # Both the time spent waiting for a thread and the time spent hashing are recorded
+    route = metrics.current_route()
+    queued = time.perf_counter()
+    def timed_func(*args):
+        start = time.perf_counter()
+        metrics.observe_stage("bcrypt.wait", start - queued, route)
+        try:
+            return func(*args)
+        finally:
+            metrics.observe_stage(f"bcrypt.{func.__name__}", time.perf_counter() - start, route)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_hash_pool, timed_func, *args)
+    finally:
+        password_hash_pending -= 1
+
+
 def create_access_token(data:Dict, expires_delta:Optional[timedelta] = None):
     # A JWT is an encoded representation of some JSON object, anyone can decode it, but it has a signature
     # This signature is based on the SECRET_KEY, and is used to verify you made the token
@@ -154,47 +414,145 @@ def create_access_token(data:Dict, expires_delta:Optional[timedelta] = None):
     else:
         # If no specified token expiry date (for now, set it to 15 minutes for security reasons)
         expire = datetime.utcnow() + timedelta(minutes=15)
-    # Add expiry info into our token (ie to_encode["exp"] = expire)
-    to_encode.update({"exp":expire})
+    # Add expiry info into our token (ie to_encode["exp"] = expire), and when it was issued (so it can be revoked)
+    to_encode.update({"exp":expire, "iat":int(time.time())})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def authenticate_user(username:str, password:str):
+async def authenticate_user(username:str, password:str):
     # See if this user exists in our database
-    user = get_user(username)
+    user = await get_user(username)
     if user is None:
         return None
     # Check to see if they entered the correct password
-    if not verify_password(password, user.hashed_password):
+    # This also gives us a new hash if the stored one is outdated (ie a lower bcrypt cost than pwd_context now uses)
+    valid, new_hash = await run_password_hash(pwd_context.verify_and_update, password, user.hashed_password)
+    if not valid:
         return None
+    if new_hash is not None:
+        await update_hashed_password(user.username, new_hash)
     return User(**user.dict())
 
 
+# Continuation tokens are handed to the client, so they are signed like our JWTs to stop anyone from tampering with them
+# They are also tied to the query they came from, so a token can't be reused with a different filter, table or database
+def query_digest(query:Union[Query, Changes]):
+    key = [query.connection_string, query.table_name, query.query, query.fields]
+    if isinstance(query, Changes):
+        # The pages of changes all read after the same watermark
+        key.append(query.since)
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def sign_continuation(continuation:Dict, query:Union[Query, Changes]):
+    payload = base64.urlsafe_b64encode(json.dumps({"c" : continuation, "q" : query_digest(query)}).encode("utf-8"))
+    signature = base64.urlsafe_b64encode(hmac.new(SECRET_KEY.encode("utf-8"), payload, hashlib.sha256).digest())
+    return (payload + b"." + signature).decode("ascii")
+
+
+def verify_continuation(token:str, query:Union[Query, Changes]):
+    invalid_token_exception = HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid continuation token")
+    try:
+        payload, signature = token.encode("ascii").split(b".")
+        expected_signature = base64.urlsafe_b64encode(hmac.new(SECRET_KEY.encode("utf-8"), payload, hashlib.sha256).digest())
+        # compare_digest takes the same time whether or not the signature matches, so it can't be guessed a byte at a time
+        if not hmac.compare_digest(signature, expected_signature):
+            raise invalid_token_exception
+        data = json.loads(base64.urlsafe_b64decode(payload))
+    except (ValueError, UnicodeError):
+        raise invalid_token_exception
+    if data["q"] != query_digest(query):
+        raise invalid_token_exception
+    return data["c"]
+
+
 # Depends means that this function needs to run the oauth2_scheme function (in this case a constructor function) before it can be executed
 async def get_current_user(token:str = Depends(oauth2_scheme)):
     # It is standard to return the WWW-Authenticate header with value Bearer when using bearer tokens to authenticate, so users know to use Bearer tokens
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials", headers={"WWW-Authenticate" : "Bearer"})
-    # Decoding the token for the user information
-    try:
-        payload = jwt.decode(token=token, key=SECRET_KEY, algorithms=[ALGORITHM])
-        # As per JWT convention/standards, 'sub' (aka subject) should be a unique identifier (as we did when creating the token)
-        sub:str = payload.get("sub")
-        if sub is None:
+    # A token we already verified skips decoding and checking its signature again
+    verified = verified_tokens.get(token)
+    if verified is not None:
+        payload, token_user = verified
+        if payload["exp"] <= time.time():
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
+    else:
+        # Decoding the token for the user information
+        try:
+            with metrics.stage("jwt.decode"):
+                payload = jwt.decode(token=token, key=SECRET_KEY, algorithms=[ALGORITHM])
+            # As per JWT convention/standards, 'sub' (aka subject) should be a unique identifier (as we did when creating the token)
+            sub:str = payload.get("sub")
+            if sub is None:
+                raise credentials_exception
+            token_data = TokenData(username=sub)
+        # If there was an error decoding/invalid signature (and if token is expired, it automatically checks that)
+        except ExpiredSignatureError:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
+        except JWTError:
             raise credentials_exception
-        token_data = TokenData(username=sub)
-    # If there was an error decoding/invalid signature (and if token is expired, it automatically checks that)
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
-    except JWTError:
-        raise credentials_exception
-    
-    current_user = User(**get_user(token_data.username).dict())
+        token_user = None
+        if STATELESS_TOKENS and "perms" in payload:
+            token_user = User(username=token_data.username, email=payload.get("email"), permissions=Permissions(**payload["perms"]), role_version=payload.get("rv", 0))
+        # Kept until the token expires, and never longer than the cache's ttl
+        verified_tokens.put(token, (payload, token_user), ttl=min(payload["exp"] - time.time(), verified_tokens.ttl))
+    profiling.annotate(user=payload["sub"])
+
+    if token_user is not None:
+        await check_token_revocation(token_user, payload)
+        return token_user
+
+    current_user = await get_cached_user(payload["sub"])
     if current_user is None:
         raise credentials_exception
     return current_user
 
 
+async def check_token_revocation(user:User, payload:Dict):
+    # Only for stateless tokens, rejects tokens revoked by invalidate_user or minted before the user's latest role change
+    revoked_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked, please log in again", headers={"WWW-Authenticate" : "Bearer"})
+    issued = payload.get("iat", 0)
+    for key in (user.username, None):
+        revoked = token_revocations.get(key)
+        if revoked is not None and issued <= revoked:
+            raise revoked_exception
+    if role_versions.enabled:
+        async def load_role_version():
+            db_user = await get_user(user.username)
+            return None if db_user is None else db_user.role_version
+        role_version = await role_versions.aget_or_load(user.username, load_role_version)
+        # A user who was deleted has no role version, so their tokens are rejected too
+        if role_version is None or user.role_version < role_version:
+            raise revoked_exception
+
+
+# For now, admins are users who have every permission
+def is_admin(user:User):
+    return user.permissions.read and user.permissions.write and user.permissions.delete
+
+
+def get_admin(current_user:User = Depends(get_current_user)):
+    if(not is_admin(current_user)):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you are not an administrator, please contact your system administrator")
+    return current_user
+
+
+async def is_admin_token(authorization:Optional[str]):
+    # The profiling middleware runs before any dependencies, so it checks the bearer token itself
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or token == "":
+        return False
+    try:
+        return is_admin(await get_current_user(token))
+    except HTTPException:
+        return False
+
+
+# Profiles requests when an admin asks for it (or slow requests, see profiling.py)
+app.add_middleware(profiling.ProfilingMiddleware, is_admin=is_admin_token)
+
+
 # So depending on get_current_user means that after we get the current user, we can run this function and return their permissions
 # This depending is for the async functionality, since we can go do other things that don't use current_user first
 def get_permissions(current_user:User = Depends(get_current_user)):
@@ -211,10 +569,63 @@ def get_info(user:User = Depends(get_current_user)):
     return user
 
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(authorization:Optional[str] = Header(default=None)):
+    if METRICS_TOKEN is not None and not hmac.compare_digest(authorization or "", "Bearer " + METRICS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token", headers={"WWW-Authenticate" : "Bearer"})
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/user-cache")
+def get_user_cache_stats(admin:User = Depends(get_admin)):
+    return user_cache.stats()
+
+
+@app.get("/entity-cache")
+def get_entity_cache_stats(admin:User = Depends(get_admin)):
+    return table_api.entity_cache.stats()
+
+
+@app.post("/user-cache/invalidate")
+def post_user_cache_invalidate(username:Optional[str] = Form(default=None), admin:User = Depends(get_admin)):
+    invalidate_user(username)
+    return {"message" : "Successfully invalidated cached user \"{}\"".format(username) if username is not None else "Successfully invalidated all cached users"}
+
+
+@app.get("/admin/profiles")
+def get_profiles(admin:User = Depends(get_admin)):
+    # The captured requests, newest first (see profiling.py), without their profiles
+    return {"Requests" : profiling.request_log.summaries()}
+
+
+@app.get("/admin/profiles/{id}")
+def get_profile(id:int, admin:User = Depends(get_admin)):
+    # A captured request with the text summary of its profile
+    entry = profiling.request_log.get(id)
+    if entry is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No captured request with id {id}, it may have been pushed out of the buffer")
+    return {key : value for key, value in entry.items() if key != "pstats"}
+
+
+@app.get("/admin/profiles/{id}/pstats")
+def get_profile_pstats(id:int, admin:User = Depends(get_admin)):
+    # The whole profile, which can be opened with python -m pstats or snakeviz
+    entry = profiling.request_log.get(id)
+    if entry is None or "pstats" not in entry:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No profile for a captured request with id {id}")
+    return Response(entry["pstats"], media_type="application/octet-stream", headers={"Content-Disposition" : f"attachment; filename=\"request-{id}.prof\""})
+
+
+@app.post("/admin/profiles/clear")
+def post_profiles_clear(admin:User = Depends(get_admin)):
+    profiling.request_log.clear()
+    return {"message" : "Successfully cleared the captured requests"}
+
+
 @app.post("/api/token", response_model=Token)
 async def login(form_data:OAuth2PasswordRequestForm = Depends(OAuth2PasswordRequestForm)):
     # Retrieving user info from the database (logging in)
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     # If user doesn't exist, or not authenticated
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
@@ -222,83 +633,319 @@ async def login(form_data:OAuth2PasswordRequestForm = Depends(OAuth2PasswordRequ
     # Now that the user has logged in, create a token for them
     access_token_expire = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     # Set the 'sub' field as username, which is a unique identifier
-    access_token = create_access_token(data={"sub":user.username}, expires_delta=access_token_expire)
+    claims = {"sub":user.username}
+    if STATELESS_TOKENS:
+        # Signed, so they can be trusted without looking the user up (anyone can read them though, so only what User already shows goes in)
+        claims.update({"email":user.email, "perms":user.permissions.dict(), "rv":user.role_version})
+    access_token = create_access_token(data=claims, expires_delta=access_token_expire)
 
     return {"access_token" : access_token, "token_type" : "Bearer"}
 
 
-@app.post("/api/query", status_code=status.HTTP_200_OK)
-async def api_query(query:Query, user_permissions:Permissions = Depends(get_permissions)):
+# Partition discovery started by /api/query, kept here so the tasks are not garbage collected while they run
+discovery_tasks:Dict[tuple, asyncio.Task] = {}
+
+
+def discover_in_background(table:table_api_async.TableClient):
+    key = table_api.partition_cache_key(table)
+    if key in discovery_tasks:
+        return
+    task = asyncio.create_task(table_api_async.discover_partitions(table))
+    discovery_tasks[key] = task
+
+    def done(task:asyncio.Task):
+        discovery_tasks.pop(key, None)
+        # A failed discovery only means queries keep scanning sequentially, so the error is dropped
+        if not task.cancelled():
+            task.exception()
+    task.add_done_callback(done)
+
+
+async def limit_results(results, limit:int):
+    count = 0
+    async for entity in results:
+        yield entity
+        count += 1
+        if count >= limit:
+            return
+
+
+QUERY_RESULT_FORMATS = ("rows", "columnar", "arrow")
+
+def query_response(query_results:list, query:Query, result_format:str, continuation:Optional[str] = None, paged:bool = False):
+    '''
+    Build the response for the results of a query, in the format asked for
+
+    Parameters:
+    - query_results (required): the entities found
+    - query (required): the query, for its fields and metadata options
+    - result_format (required): one of QUERY_RESULT_FORMATS
+    - continuation: the continuation token of the page (for paged queries)
+    - paged: whether the query was paged, so the continuation is sent even when it is None
+
+    Return:
+    the response
+    '''
+
+    fields = query.fields
+    if query.metadata:
+        query_results = [entity_json.with_metadata(entity) for entity in query_results]
+        if fields is not None:
+            fields = fields + ["odata.etag", "Timestamp"]
+    paging = {"continuation" : continuation} if paged else {}
+
+    if result_format == "rows":
+        return EntityJSONResponse({"Query results" : query_results, **paging})
+    # The selected fields come first and in order, even when no entity has them
+    table = entity_json.columnar(query_results, fields)
+    if result_format == "arrow":
+        return Response(content=entity_json.arrow_stream(table, continuation), media_type=entity_json.ARROW_MEDIA_TYPE)
+    return EntityJSONResponse({"Query results" : table, **paging})
+
+
+@app.post("/api/query", status_code=status.HTTP_200_OK, response_class=EntityJSONResponse)
+async def api_query(query:Query, user_permissions:Permissions = Depends(get_permissions), accept:Optional[str] = Header(default=None)):
     # Querying requires read permissions
     if(not user_permissions.read):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you do not have read permissions, please contact your system administrator")
 
-    if query.connection_string is None:
-        db = table_api.connect_to_db(DEFAULT_TABLE_CONN_STRING)
-    else:
-        db = table_api.connect_to_db(query.connection_string)
-    if query.table_name is None:
-        table = table_api.connect_to_table(db, DEFAULT_TABLE_NAME)
+    profiling.annotate(query=query.query, fields=query.fields)
+
+    result_format = query.format if query.format is not None else "rows"
+    if query.format is None and accept is not None and entity_json.ARROW_MEDIA_TYPE in accept:
+        result_format = "arrow"
+    if result_format not in QUERY_RESULT_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"format must be one of {', '.join(QUERY_RESULT_FORMATS)}")
+    if result_format != "rows" and query.stream:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Streamed results can only be sent as rows")
+    if result_format == "arrow" and entity_json.pyarrow is None:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail="Arrow is not available on this server, use the columnar format instead")
+
+    # Malformed queries are turned away here, instead of after a round trip to the database
+    try:
+        plan = table_api.plan_query(query.query)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    table = await get_table(query.connection_string, query.table_name)
+
+    if query.page_size is not None or query.continuation is not None:
+        if query.explain:
+            return {"Plan" : {**plan.explain(), "paged" : True, "fan_out" : False}}
+        page_size = query.page_size if query.page_size is not None else table_api.DEFAULT_PAGE_SIZE
+        if page_size < 1 or page_size > table_api.MAX_PAGE_SIZE:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"page_size must be between 1 and {table_api.MAX_PAGE_SIZE}")
+        continuation = None
+        if query.continuation is not None:
+            continuation = verify_continuation(query.continuation, query)
+        query_results, continuation = await table_api_async.query_page(table, query.query, query.fields, page_size, continuation)
+        if continuation is not None:
+            continuation = sign_continuation(continuation, query)
+        metrics.observe_rows(len(query_results))
+        return query_response(query_results, query, result_format, continuation=continuation, paged=True)
+
+    if query.limit is not None and query.limit < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="limit must be at least 1")
+    if query.partitions is not None and query.fan_out == False:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="partitions can only be used when fanning out")
+
+    fan_out = query.fan_out
+    if query.partitions is not None:
+        fan_out = True
+    elif plan.kind == odata_filter.POINT_READ:
+        # Reading the entries directly is cheaper than any scan
+        fan_out = False
+    elif fan_out is None:
+        # Fanning out pays off for wide queries over many partitions, which needs the partitions of the table to be known
+        # With TABLE_FANOUT_DISCOVERY, the first wide query on a table scans sequentially while they are found in the background
+        partitions = table_api_async.known_partitions(table)
+        if partitions is None and table_api.FANOUT_DISCOVERY and not table_api.pins_partition(query.query):
+            discover_in_background(table)
+        fan_out = table_api.fanout_worthwhile(query.query, None if partitions is None else len(partitions))
+
+    if query.explain:
+        return {"Plan" : {**plan.explain(), "paged" : False, "fan_out" : fan_out}}
+
+    if fan_out:
+        ordered = query.ordered
+        if ordered is None:
+            ordered = query.fan_out is None and query.partitions is None
+        results = table_api_async.fanout_query(table, query.query, query.fields, query.partitions, ordered=ordered, limit=query.limit)
     else:
-        table = table_api.connect_to_table(db, query.table_name)
-    query_results = list(table_api.query(table, query.query, query.fields))
-    return {"Query results" : query_results}
+        results = table_api_async.query(table, query.query, query.fields)
+        if query.limit is not None:
+            results = limit_results(results, query.limit)
+
+    if query.stream or (result_format == "rows" and accept is not None and "application/x-ndjson" in accept):
+        # The results are fetched lazily a page at a time, and each entity is sent as soon as it arrives
+        # So memory stays flat no matter how many results there are
+        async def ndjson_lines():
+            count = 0
+            async for entity in results:
+                yield entity_json.dumps(entity_json.with_metadata(entity) if query.metadata else entity) + b"\n"
+                count += 1
+            metrics.observe_rows(count)
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    with metrics.stage("table.query"):
+        query_results = [entity async for entity in results]
+    metrics.observe_rows(len(query_results))
+    return query_response(query_results, query, result_format)
+
+
+@app.post("/api/changes", status_code=status.HTTP_200_OK, response_class=EntityJSONResponse)
+async def api_changes(changes:Changes, user_permissions:Permissions = Depends(get_permissions)):
+    # Getting changes requires read permissions
+    if(not user_permissions.read):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you do not have read permissions, please contact your system administrator")
+
+    profiling.annotate(query=changes.query, fields=changes.fields, since=changes.since)
+    if changes.page_size is not None and (changes.page_size < 1 or changes.page_size > table_api.MAX_PAGE_SIZE):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"page_size must be between 1 and {table_api.MAX_PAGE_SIZE}")
+    continuation = None
+    if changes.continuation is not None:
+        continuation = verify_continuation(changes.continuation, changes)
+    table = await get_table(changes.connection_string, changes.table_name)
+    try:
+        result = await table_api_async.changes(table, changes.since, changes.query, changes.fields, changes.page_size, continuation)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    metrics.observe_rows(len(result["changed"]) + len(result["deleted"]))
+    # Deleted entries only come back as their keys, and the watermark goes in the since of the next call
+    content = {"Changed" : result["changed"], "Deleted" : result["deleted"], "watermark" : result["watermark"]}
+    if changes.page_size is not None or changes.continuation is not None:
+        content["continuation"] = None if result["continuation"] is None else sign_continuation(result["continuation"], changes)
+    return EntityJSONResponse(content)
 
 
 @app.post("/api/publish", status_code=status.HTTP_201_CREATED)
-async def api_publish(connection_string:Optional[str] = Form(default=None), table_name:Optional[str] = Form(default=None), my_file:UploadFile = File(), user_permissions:Permissions = Depends(get_permissions)):
+async def api_publish(response:Response, connection_string:Optional[str] = Form(default=None), table_name:Optional[str] = Form(default=None), my_file:UploadFile = File(), user_permissions:Permissions = Depends(get_permissions), if_match:Optional[str] = Header(default=None)):
     # Publishing requires write permissions
     if(not user_permissions.write):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you do not have write permissions, please contact your system administrator")
 
     content = await my_file.read()
-    if connection_string is None:
-        db = table_api.connect_to_db(DEFAULT_TABLE_CONN_STRING)
-    else:
-        db = table_api.connect_to_db(connection_string)
-    if table_name is None:
-        table = table_api.connect_to_table(db, DEFAULT_TABLE_NAME)
-    else:
-        table = table_api.connect_to_table(db, table_name)
+    table = await get_table(connection_string, table_name)
     entry = table_api.parse_bytes(content)
-    table_api.upsert_entry(table, entry)
+    # With If-Match (the ETag from /api/get), the entry is only updated if nobody else changed it since it was read
+    try:
+        written = await table_api_async.upsert_entry(table, entry, etag=if_match)
+    except (ResourceModifiedError, ResourceNotFoundError):
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="The entry was changed or deleted since it was read (If-Match does not match its ETag)")
+    etag = (written or {}).get("etag")
+    if etag is not None:
+        response.headers["ETag"] = etag
     return {"message" : "Successfully published deployment with PartitionKey \"{}\" and id \"{}\"!".format(entry["PartitionKey"], entry["RowKey"])}
 
 
-@app.post("/api/get", status_code=status.HTTP_200_OK)
-async def api_get(entity:Entity, user_permissions:Permissions = Depends(get_permissions)):
+@app.post("/api/publish/batch", status_code=status.HTTP_201_CREATED)
+async def api_publish_batch(response:Response, connection_string:Optional[str] = Form(default=None), table_name:Optional[str] = Form(default=None), my_files:List[UploadFile] = File(), user_permissions:Permissions = Depends(get_permissions)):
+    # Publishing requires write permissions
+    if(not user_permissions.write):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you do not have write permissions, please contact your system administrator")
+
+    # Each file can be a key-value pair text file (with one or more entries), or a zip/tar archive of them
+    # The files are parsed lazily, so entries go into the batches as they are read instead of all being loaded first
+    # Parsing (and reading the spooled upload) is blocking, so it runs in a worker thread a batch at a time instead of on the event loop
+    def parse_upload(my_file:UploadFile):
+        try:
+            if table_api.is_archive(my_file.file):
+                yield from table_api.parse_archive(my_file.file)
+            else:
+                yield from table_api.parse_entries(my_file.file)
+        except Exception as e:
+            raise ValueError(f"Could not parse file \"{my_file.filename}\": {e}")
+
+    def entries():
+        for my_file in my_files:
+            yield from parse_upload(my_file)
+
+    table = await get_table(connection_string, table_name)
+    results = []
+    try:
+        await table_api_async.upsert_batches(table, iterate_in_threadpool(table_api.group_into_batches(entries())), results)
+    except ValueError as e:
+        # Batches before the bad entry may have already been published, so their results are sent back with the error
+        count = sum(1 for result in results if result["success"])
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail" : str(e), "message" : f"Published {count} entries before the error", "count" : count, "results" : results}
+    count = sum(1 for result in results if result["success"])
+    # Some of the transactions failed, see the results for which entries
+    if count < len(results):
+        response.status_code = status.HTTP_207_MULTI_STATUS
+    return {"message" : f"Successfully published {count} of {len(results)} entries!", "count" : count, "results" : results}
+
+
+@app.post("/api/get", status_code=status.HTTP_200_OK, response_class=EntityJSONResponse)
+async def api_get(entity:EntityGet, user_permissions:Permissions = Depends(get_permissions), if_none_match:Optional[str] = Header(default=None)):
     # Getting requires read permissions
     if(not user_permissions.read):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you do not have read permissions, please contact your system administrator")
-
-    if entity.connection_string is None:
-        db = table_api.connect_to_db(DEFAULT_TABLE_CONN_STRING)
-    else:
-        db = table_api.connect_to_db(entity.connection_string)
-    if entity.table_name is None:
-        table = table_api.connect_to_table(db, DEFAULT_TABLE_NAME)
-    else:
-        table = table_api.connect_to_table(db, entity.table_name)
-    entry = table_api.get_entry(table, id=entity.id, partition_key=entity.partition_key)
+    if (entity.id is None) == (entity.keys is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Specify either id or keys (but not both)")
+
+    table = await get_table(entity.connection_string, entity.table_name)
+
+    if entity.keys is not None:
+        # Reads are done at the same time, and many RowKeys in the same partition are fetched with a single query
+        keys = [{"PartitionKey" : key.partition_key if key.partition_key is not None else table_api.DEFAULT_PARTITION_KEY, "RowKey" : key.id} for key in entity.keys]
+        found, missing = await table_api_async.get_entries(table, keys)
+        metrics.observe_rows(len(found))
+        if entity.metadata:
+            found = [entity_json.with_metadata(entry) for entry in found]
+        return EntityJSONResponse({"Entries" : found, "Missing" : [{"partition_key" : key["PartitionKey"], "id" : key["RowKey"]} for key in missing]})
+
+    # The ETag header lets pollers send If-None-Match, and get a 304 without the entry when it did not change
+    entry, changed = await table_api_async.get_entry_if_changed(table, id=entity.id, partition_key=entity.partition_key, etag=if_none_match)
+    if not changed:
+        metrics.observe_rows(0)
+        etag = table_api.entity_etag(entry)
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag" : etag if etag is not None else if_none_match.strip()})
+    metrics.observe_rows(0 if entry is None else 1)
     if(entry is not None):
-        return {"Entry" : entry}
+        etag = table_api.entity_etag(entry)
+        return EntityJSONResponse({"Entry" : entity_json.with_metadata(entry) if entity.metadata else entry}, headers={"ETag" : etag} if etag is not None else None)
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No entity found with the specified PartitionKey and id")
 
 
 @app.post("/api/delete", status_code=status.HTTP_200_OK)
-async def api_delete(entity:Entity, user_permissions:Permissions = Depends(get_permissions)):
+async def api_delete(entity:Entity, user_permissions:Permissions = Depends(get_permissions), if_match:Optional[str] = Header(default=None)):
     # Deleting requires delete permissions
     if(not user_permissions.delete):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you do not have delete permissions, please contact your system administrator")
 
-    if entity.connection_string is None:
-        db = table_api.connect_to_db(DEFAULT_TABLE_CONN_STRING)
-    else:
-        db = table_api.connect_to_db(entity.connection_string)
-    if entity.table_name is None:
-        table = table_api.connect_to_table(db, DEFAULT_TABLE_NAME)
-    else:
-        table = table_api.connect_to_table(db, entity.table_name)
-    table_api.delete_entry(table, id=entity.id, partition_key=entity.partition_key)
+    table = await get_table(entity.connection_string, entity.table_name)
+    # With If-Match (the ETag from /api/get), the entry is only deleted if nobody changed it since it was read
+    try:
+        await table_api_async.delete_entry(table, id=entity.id, partition_key=entity.partition_key, etag=if_match)
+    except ResourceModifiedError:
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="The entry was changed since it was read (If-Match does not match its ETag)")
     return {"message" : f"Successfully deleted entry with PartitionKey \"{entity.partition_key}\" and id \"{entity.id}\"!"}
+
+
+@app.post("/api/delete/batch", status_code=status.HTTP_200_OK)
+async def api_delete_batch(bulk_delete:BulkDelete, response:Response, user_permissions:Permissions = Depends(get_permissions)):
+    # Deleting requires delete permissions
+    if(not user_permissions.delete):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access denied: you do not have delete permissions, please contact your system administrator")
+    if (bulk_delete.keys is None) == (bulk_delete.query is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Specify either keys or query (but not both)")
+
+    keys = None
+    if bulk_delete.keys is not None:
+        keys = [{"PartitionKey" : key.partition_key if key.partition_key is not None else table_api.DEFAULT_PARTITION_KEY, "RowKey" : key.id} for key in bulk_delete.keys]
+    else:
+        # Malformed queries are turned away here, like in api_query
+        try:
+            table_api.plan_query(bulk_delete.query)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    table = await get_table(bulk_delete.connection_string, bulk_delete.table_name)
+    summary = await table_api_async.delete_entries(table, keys=keys, query=bulk_delete.query, dry_run=bulk_delete.dry_run)
+    if bulk_delete.dry_run:
+        return {"message" : f"{summary['matched']} entries would be deleted", **summary}
+    # Some of the entities could not be deleted, see failed for which ones
+    if len(summary["failed"]) > 0:
+        response.status_code = status.HTTP_207_MULTI_STATUS
+    return {"message" : f"Successfully deleted {summary['deleted']} of {summary['matched']} entries!", **summary}
@@ -0,0 +1,246 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Sequence, Tuple
+import bisect
+import functools
+import profiling
+import threading
+import time
+
+# Prometheus metrics for the FastAPI host, served at /metrics in the Prometheus text format
+#
+# Recording is a lock, a dict lookup and a few additions, so it is cheap enough to leave on in production
+# - http_request_duration_seconds: how long each request took, per route, method and status code (recorded by MetricsMiddleware)
+# - stage_duration_seconds: how long each stage of a request took (ie decoding the JWT, looking up the user, bcrypt, each table_api_async call), per route
+# - backend_request_duration_seconds: how long each HTTP request to Cosmos took (every retry counts), per service (table or user database), method and status code
+# - cosmos_request_charge_total: the request units (RU) Cosmos charged, per service and route
+# - cosmos_throttled_requests_total: how many requests Cosmos throttled (429), per service and route
+# - result_rows: how many entities each query or get returned, per route
+#
+# Routes are the path templates (ie /api/query), so the number of series stays small whatever paths are requested
+
+
+
+# Like the Prometheus client defaults, with finer buckets at the low end for the in-memory stages
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 7.5, 10)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# The ASGI scope of the request being handled, so metrics recorded deep inside a request can be labelled with its route
+_current_scope:ContextVar[Optional[dict]] = ContextVar("metrics_scope", default=None)
+
+
+def _escape(value:str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _labels_text(names:Sequence[str], values:Sequence[str], extra:str = ""):
+    pairs = [f"{name}=\"{_escape(str(value))}\"" for name, value in zip(names, values)]
+    if(extra != ""):
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+def _number(value:float):
+    if(value == float("inf")):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name:str, documentation:str, label_names:Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values:Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels:Tuple[str, ...] = (), amount:float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels:Tuple[str, ...] = ()):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(values):
+            lines.append(f"{self.name}{_labels_text(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name:str, documentation:str, label_names:Sequence[str] = (), buckets:Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count in each bucket (not cumulative, the last one is +Inf), sum, count]
+        self._values:Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, labels:Tuple[str, ...] = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if(series is None):
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, labels:Tuple[str, ...] = ()):
+        with self._lock:
+            series = self._values.get(labels)
+            return 0 if series is None else series[2]
+
+    def render(self):
+        with self._lock:
+            values = [(labels, (list(series[0]), series[1], series[2])) for labels, series in self._values.items()]
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bound_label = "le=\"" + _number(bound) + "\""
+                lines.append(f"{self.name}_bucket{_labels_text(self.label_names, labels, bound_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.label_names, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels_text(self.label_names, labels)} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "How long requests took, until the whole response was sent", ("route", "method", "status"))
+STAGE_SECONDS = Histogram("stage_duration_seconds", "How long each stage of a request took", ("route", "stage"))
+BACKEND_SECONDS = Histogram("backend_request_duration_seconds", "How long each HTTP request to Cosmos took, including every retry", ("service", "method", "status"))
+REQUEST_CHARGE = Counter("cosmos_request_charge_total", "Request units (RU) charged by Cosmos", ("service", "route"))
+THROTTLED = Counter("cosmos_throttled_requests_total", "Requests throttled by Cosmos (status 429)", ("service", "route"))
+RESULT_ROWS = Histogram("result_rows", "How many entities a query or get returned", ("route",), ROW_BUCKETS)
+
+ALL_METRICS = [REQUEST_SECONDS, STAGE_SECONDS, BACKEND_SECONDS, REQUEST_CHARGE, THROTTLED, RESULT_ROWS]
+
+
+def render():
+    '''
+    Get every metric in the Prometheus text format
+    '''
+
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def current_route():
+    '''
+    Get the route (path template) of the request being handled, or "" outside of a request
+    '''
+
+    scope = _current_scope.get()
+    if(scope is None):
+        return ""
+    route = scope.get("route")
+    # The route is only known once the request has been routed, and unknown paths are grouped together
+    return getattr(route, "path", "unmatched")
+
+
+def observe_stage(name:str, seconds:float, route:Optional[str] = None):
+    STAGE_SECONDS.observe(seconds, (current_route() if route is None else route, name))
+    # Also kept with the request if it is being captured for profiling
+    profiling.add_stage(name, seconds)
+
+
+def observe_rows(count:int, route:Optional[str] = None):
+    RESULT_ROWS.observe(count, (current_route() if route is None else route,))
+    profiling.annotate(rows=count)
+
+
+@contextmanager
+def stage(name:str):
+    '''
+    Time a stage of a request, with "with metrics.stage("name"):"
+    '''
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def timed(name:str):
+    '''
+    Decorate a coroutine function to time each call as a stage
+    '''
+
+    def decorator(func:Callable):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                observe_stage(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def azure_hooks(service:str):
+    '''
+    Get the raw_request_hook and raw_response_hook keyword arguments for an Azure SDK client (ie from_connection_string(conn_str, **metrics.azure_hooks("table"))),
+    which time every HTTP request and record the request charge and throttling from the response headers
+
+    Parameters:
+    - service (required): the label for the requests of this client (ie "table" or "user")
+    '''
+
+    def on_request(request):
+        request.context["metrics_start"] = time.perf_counter()
+
+    def on_response(response):
+        http_response = response.http_response
+        start = response.context.get("metrics_start")
+        if(start is not None):
+            BACKEND_SECONDS.observe(time.perf_counter() - start, (service, response.http_request.method, str(http_response.status_code)))
+        route = current_route()
+        charge = http_response.headers.get("x-ms-request-charge")
+        if(charge is not None):
+            try:
+                REQUEST_CHARGE.inc((service, route), float(charge))
+            except ValueError:
+                pass
+        if(http_response.status_code == 429):
+            THROTTLED.inc((service, route))
+
+    return {"raw_request_hook" : on_request, "raw_response_hook" : on_response}
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware which times every HTTP request (until its whole response is sent, so streamed responses are included)
+    and makes the request's route available to the metrics recorded while handling it
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if(scope["type"] != "http"):
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if(message["type"] == "http.response.start"):
+                status_code = message["status"]
+            await send(message)
+
+        token = _current_scope.set(scope)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, (getattr(scope.get("route"), "path", "unmatched"), scope["method"], str(status_code)))
+            _current_scope.reset(token)
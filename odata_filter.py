@@ -0,0 +1,412 @@
+from azure.data.tables import EntityProperty
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+import re
+
+# A local parser for the query strings accepted by table_api.query (see its docstring for the format),
+# so malformed queries are rejected before a request is sent, and queries can be planned before they run
+#
+# plan_query sorts a query into one of three kinds:
+# - point_read: only looks up entries by PartitionKey and RowKey, so it is answered with point reads instead of a query
+# - partition: every match is in a known set of partitions, so the service only reads those partitions
+# - scan: anything else, which makes the service read the whole table
+
+
+
+POINT_READ = "point_read"
+PARTITION = "partition"
+SCAN = "scan"
+
+COMPARISON_OPERATORS = ("eq", "ne", "gt", "ge", "lt", "le")
+# The service allows at most 15 comparisons in one filter
+MAX_COMPARISONS = 15
+KEY_FIELDS = ("PartitionKey", "RowKey")
+
+# What each comparison operator becomes when the two sides are swapped (ie 'a' lt RowKey is RowKey gt 'a')
+_FLIPPED = {"eq" : "eq", "ne" : "ne", "gt" : "lt", "ge" : "le", "lt" : "gt", "le" : "ge"}
+
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<paren>[()])
+  | (?P<typed>(?:datetime|guid|binary|X)'[^']*')
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?[LlDd]?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+""", re.VERBOSE)
+
+
+class Comparison:
+    # field op value, always stored with the field on the left
+    def __init__(self, field:str, op:str, value:Any):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return f"Comparison({self.field} {self.op} {self.value!r})"
+
+
+class And:
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return f"And({self.left!r}, {self.right!r})"
+
+
+class Or:
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return f"Or({self.left!r}, {self.right!r})"
+
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+    def __repr__(self):
+        return f"Not({self.operand!r})"
+
+
+class Literal:
+    # Only used while parsing, to tell values apart from field names
+    def __init__(self, value:Any):
+        self.value = value
+
+
+def _tokenize(query:str):
+    tokens = []
+    position = 0
+    while(position < len(query)):
+        match = _TOKEN_PATTERN.match(query, position)
+        if(match is None):
+            if(query[position] == "'"):
+                raise ValueError(f"Invalid query: the string starting at position {position} is missing its closing quote")
+            raise ValueError(f"Invalid query: unexpected character '{query[position]}' at position {position}")
+        kind = match.lastgroup
+        if(kind != "space"):
+            tokens.append((kind, match.group(), position))
+        position = match.end()
+    return tokens
+
+
+def _literal(kind:str, text:str, position:int):
+    try:
+        if(kind == "string"):
+            return text[1:-1].replace("''", "'")
+        if(kind == "number"):
+            if(text[-1] in "LlDd"):
+                return int(text[:-1]) if text[-1] in "Ll" else float(text[:-1])
+            return float(text) if any(char in text for char in ".eE") else int(text)
+        prefix, value = text[:-1].split("'", 1)
+        if(prefix == "datetime"):
+            return datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if(prefix == "guid"):
+            return UUID(value)
+        return bytes.fromhex(value)
+    except ValueError:
+        raise ValueError(f"Invalid query: '{text}' at position {position} is not a valid value")
+
+
+class _Parser:
+    '''
+    Recursive descent parser for:
+    - expression: term (or term)*
+    - term: factor (and factor)*
+    - factor: not factor | ( expression ) | operand operator operand
+    '''
+
+    def __init__(self, query:str):
+        self.query = query
+        self.tokens = _tokenize(query)
+        self.index = 0
+        self.comparisons = 0
+
+    def peek(self):
+        if(self.index < len(self.tokens)):
+            return self.tokens[self.index]
+        return (None, None, len(self.query))
+
+    def next(self):
+        token = self.peek()
+        self.index += 1
+        return token
+
+    def keyword(self, word:str):
+        kind, text, _ = self.peek()
+        if(kind == "name" and text.lower() == word):
+            self.index += 1
+            return True
+        return False
+
+    def expected(self, what:str):
+        kind, text, position = self.peek()
+        found = "the end of the query" if kind is None else f"'{text}'"
+        return ValueError(f"Invalid query: expected {what} at position {position}, found {found}")
+
+    def parse(self):
+        node = self.expression()
+        if(self.peek()[0] is not None):
+            raise self.expected("and, or or the end of the query")
+        if(self.comparisons > MAX_COMPARISONS):
+            raise ValueError(f"Invalid query: at most {MAX_COMPARISONS} comparisons are allowed, found {self.comparisons}")
+        return node
+
+    def expression(self):
+        node = self.term()
+        while(self.keyword("or")):
+            node = Or(node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while(self.keyword("and")):
+            node = And(node, self.factor())
+        return node
+
+    def factor(self):
+        if(self.keyword("not")):
+            return Not(self.factor())
+        if(self.peek()[0] == "paren" and self.peek()[1] == "("):
+            self.next()
+            node = self.expression()
+            if(self.peek()[1] != ")"):
+                raise self.expected("')'")
+            self.next()
+            return node
+        return self.comparison()
+
+    def operand(self):
+        kind, text, position = self.next()
+        if(kind in ("string", "number", "typed")):
+            return Literal(_literal(kind, text, position))
+        if(kind == "name"):
+            if(text.lower() in ("true", "false")):
+                return Literal(text.lower() == "true")
+            if(text.lower() in COMPARISON_OPERATORS + ("and", "or", "not")):
+                self.index -= 1
+                raise self.expected("a field name or value")
+            return text
+        self.index -= 1
+        raise self.expected("a field name or value")
+
+    def comparison(self):
+        position = self.peek()[2]
+        left = self.operand()
+        kind, text, _ = self.peek()
+        if(kind != "name" or text.lower() not in COMPARISON_OPERATORS):
+            raise self.expected("one of " + ", ".join(COMPARISON_OPERATORS))
+        self.next()
+        op = text.lower()
+        right = self.operand()
+        self.comparisons += 1
+
+        if(isinstance(left, Literal) and isinstance(right, str)):
+            left, right, op = right, left, _FLIPPED[op]
+        if(isinstance(left, Literal)):
+            raise ValueError(f"Invalid query: the comparison at position {position} needs a field name on one side")
+        if(isinstance(right, str)):
+            raise ValueError(f"Invalid query: the comparison at position {position} compares two fields ({left} and {right}), which is not supported")
+        if(left in KEY_FIELDS and not isinstance(right.value, str)):
+            raise ValueError(f"Invalid query: {left} can only be compared with a string (in single quotes), at position {position}")
+        return Comparison(left, op, right.value)
+
+
+def parse_filter(query:str):
+    '''
+    Parse and validate a query string
+
+    Parameters:
+    - query (required): a string to specify the query (see table_api.query for formatting)
+
+    Return:
+    the root node of the parsed query (a Comparison, And, Or or Not)
+
+    Raises ValueError with the position of the problem if the query is not valid
+    '''
+
+    if(query.strip() == ""):
+        raise ValueError("Invalid query: the query is empty")
+    return _Parser(query).parse()
+
+
+def _comparable(value:Any):
+    # Property values as read from the database can be wrapped (ie 64-bit integers), and datetimes without a timezone are UTC
+    if(isinstance(value, EntityProperty)):
+        value = value.value
+    if(isinstance(value, datetime) and value.tzinfo is None):
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _compare(actual:Any, op:str, expected:Any):
+    actual = _comparable(actual)
+    expected = _comparable(expected)
+    # Values of different types never match, like in the service (numbers are one type, booleans are not numbers)
+    numbers = (int, float)
+    if(isinstance(actual, bool) or isinstance(expected, bool)):
+        if(not (isinstance(actual, bool) and isinstance(expected, bool))):
+            return False
+    elif(isinstance(actual, numbers) and isinstance(expected, numbers)):
+        pass
+    elif(type(actual) != type(expected) and not (isinstance(actual, datetime) and isinstance(expected, datetime))):
+        return False
+    try:
+        if(op == "eq"):
+            return actual == expected
+        if(op == "ne"):
+            return actual != expected
+        if(op == "gt"):
+            return actual > expected
+        if(op == "ge"):
+            return actual >= expected
+        if(op == "lt"):
+            return actual < expected
+        return actual <= expected
+    except TypeError:
+        # ie ordering GUIDs
+        return False
+
+
+def evaluate(node, entity:Dict[str, Any]):
+    '''
+    Check whether an entity matches a parsed query, the same way the service would
+    An entity without a field never matches a comparison on that field (not even ne)
+
+    Parameters:
+    - node (required): a parsed query (see parse_filter)
+    - entity (required): a dictionary representation of the entity
+
+    Return:
+    a boolean
+    '''
+
+    if(isinstance(node, And)):
+        return evaluate(node.left, entity) and evaluate(node.right, entity)
+    if(isinstance(node, Or)):
+        return evaluate(node.left, entity) or evaluate(node.right, entity)
+    if(isinstance(node, Not)):
+        return not evaluate(node.operand, entity)
+    if(node.field not in entity or entity[node.field] is None):
+        return False
+    return _compare(entity[node.field], node.op, node.value)
+
+
+def query_fields(node):
+    '''
+    Get the fields a parsed query compares (see parse_filter), in the order they first show up
+
+    Parameters:
+    - node (required): a parsed query, or None
+
+    Return:
+    a list of field names
+    '''
+
+    if(node is None):
+        return []
+    if(isinstance(node, (And, Or))):
+        return list(dict.fromkeys(query_fields(node.left) + query_fields(node.right)))
+    if(isinstance(node, Not)):
+        return query_fields(node.operand)
+    return [node.field]
+
+
+def _flatten(node, kind:type):
+    # The operands of a chain of the same operator, ie a and (b and c) gives [a, b, c]
+    if(isinstance(node, kind)):
+        return _flatten(node.left, kind) + _flatten(node.right, kind)
+    return [node]
+
+
+def _key_lookup(conditions:list):
+    # The (PartitionKey, RowKey) of a group of and-ed conditions which only look up one entry, otherwise None
+    keys = {}
+    for condition in conditions:
+        if(not isinstance(condition, Comparison) or condition.field not in KEY_FIELDS or condition.op != "eq"):
+            return None
+        if(keys.get(condition.field, condition.value) != condition.value):
+            # ie RowKey eq 'a' and RowKey eq 'b', which can never match
+            return None
+        keys[condition.field] = condition.value
+    if(len(keys) != 2):
+        return None
+    return (keys["PartitionKey"], keys["RowKey"])
+
+
+def _partition(conditions:list):
+    for condition in conditions:
+        if(isinstance(condition, Comparison) and condition.field == "PartitionKey" and condition.op == "eq"):
+            return condition.value
+    return None
+
+
+class QueryPlan:
+    '''
+    How a query will be run (see plan_query)
+    - kind: POINT_READ, PARTITION or SCAN
+    - keys: for POINT_READ, the (PartitionKey, RowKey) of each entry to read
+    - partitions: for POINT_READ and PARTITION, the partitions that can have matches
+    - filter: the query string, None if every entry matches
+    - reason: why the query was given this kind
+    '''
+
+    def __init__(self, kind:str, query:Optional[str], reason:str, keys:Optional[List[Tuple[str, str]]] = None, partitions:Optional[List[str]] = None):
+        self.kind = kind
+        self.filter = query
+        self.reason = reason
+        self.keys = keys or []
+        self.partitions = partitions or []
+
+    def explain(self):
+        '''
+        Describe the plan, ie for the explain option of /api/query
+
+        Return:
+        a dictionary with the kind, filter, reason, and the keys or partitions of the plan
+        '''
+
+        explanation:Dict[str, Any] = {"kind" : self.kind, "filter" : self.filter, "reason" : self.reason}
+        if(self.kind == POINT_READ):
+            explanation["keys"] = [{"PartitionKey" : partition_key, "RowKey" : row_key} for partition_key, row_key in self.keys]
+        if(self.kind in (POINT_READ, PARTITION)):
+            explanation["partitions"] = self.partitions
+        return explanation
+
+
+def plan_query(query:Optional[str]):
+    '''
+    Parse a query string and decide how it should run
+
+    Parameters:
+    - query: a string to specify the query (see table_api.query for formatting). None (or an empty string) matches every entry
+
+    Return:
+    a QueryPlan
+
+    Raises ValueError if the query is not valid
+    '''
+
+    if(query is None or query.strip() == ""):
+        return QueryPlan(SCAN, None, "there is no filter, so every entry is read")
+
+    # Each side of a top-level or is planned separately, and the query is only as cheap as its most expensive side
+    branches = [_flatten(branch, And) for branch in _flatten(parse_filter(query), Or)]
+
+    keys = [_key_lookup(conditions) for conditions in branches]
+    if(all(key is not None for key in keys)):
+        keys = list(dict.fromkeys(keys))
+        partitions = list(dict.fromkeys(key[0] for key in keys))
+        return QueryPlan(POINT_READ, query, "only PartitionKey eq and RowKey eq are used, so the entries are read directly", keys=keys, partitions=partitions)
+
+    partitions = [_partition(conditions) for conditions in branches]
+    if(all(partition is not None for partition in partitions)):
+        partitions = list(dict.fromkeys(partitions))
+        return QueryPlan(PARTITION, query, "every match has a PartitionKey eq condition, so only those partitions are read", partitions=partitions)
+
+    return QueryPlan(SCAN, query, "there is no PartitionKey eq condition (or part of an or is missing one), so the whole table is read")
@@ -0,0 +1,180 @@
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+import cProfile
+import io
+import itertools
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+
+# Opt-in request profiling and slow-request capture for the FastAPI host
+#
+# A request is captured when:
+# - an administrator sends the X-Profile header (any value), which profiles it with cProfile
+# - it takes longer than PROFILE_SLOW_REQUEST_SECONDS (when set), along with a profile if it was one of the PROFILE_SAMPLE_RATE requests being profiled
+# Captured requests (route, status, duration, user, filter, fields, row count, stage timings and the profile) go into a ring buffer of the last PROFILE_BUFFER_SIZE,
+# which administrators can download from /admin/profiles
+#
+# cProfile follows the event loop thread, so other requests running at the same time show up in a profile too, and only one request is profiled at a time
+# When profiling and slow-request capture are both off, a request only costs a look through its headers
+
+
+
+PROFILE_BUFFER_SIZE = int(os.environ.get("PROFILE_BUFFER_SIZE", "50"))
+# 0 turns off slow-request capture
+PROFILE_SLOW_REQUEST_SECONDS = float(os.environ.get("PROFILE_SLOW_REQUEST_SECONDS", "0"))
+# The fraction of requests to profile (between 0 and 1), so slow requests come with a profile. Profiles of requests which turn out fast are thrown away
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HEADER = b"x-profile"
+# How many functions the text summary of a profile lists
+PROFILE_SUMMARY_LINES = 40
+
+# Details about the request being captured (None when it is not), filled in by annotate and add_stage
+_capture:ContextVar[Optional[Dict[str, Any]]] = ContextVar("profiling_capture", default=None)
+# cProfile can only profile one thing at a time
+_profiler_lock = threading.Lock()
+
+
+def annotate(**details):
+    '''
+    Add details (ie the filter, fields or row count) to the request being captured, does nothing when it is not being captured
+    '''
+
+    capture = _capture.get()
+    if(capture is not None):
+        capture.update(details)
+
+
+def add_stage(name:str, seconds:float):
+    capture = _capture.get()
+    if(capture is not None):
+        capture["stages"].append({"stage" : name, "ms" : round(seconds * 1000, 3)})
+
+
+class RequestLog:
+    '''
+    A thread safe ring buffer of the last captured requests
+    '''
+
+    def __init__(self, max_size:int = PROFILE_BUFFER_SIZE):
+        self._entries:deque = deque(maxlen=max(1, max_size))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, entry:Dict[str, Any]):
+        with self._lock:
+            entry["id"] = next(self._ids)
+            self._entries.append(entry)
+        return entry["id"]
+
+    def summaries(self):
+        # The newest first, without the profiles
+        with self._lock:
+            entries = list(self._entries)
+        return [{key : value for key, value in entry.items() if key not in ("profile", "pstats")} for entry in reversed(entries)]
+
+    def get(self, id:int):
+        with self._lock:
+            for entry in self._entries:
+                if(entry["id"] == id):
+                    return entry
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+request_log = RequestLog()
+
+
+def _summary(profiler:cProfile.Profile):
+    # The functions which took the most time (including what they called), as text
+    text = io.StringIO()
+    stats = pstats.Stats(profiler, stream=text)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_SUMMARY_LINES)
+    # The same bytes dump_stats would write, so they can be opened with pstats or snakeviz
+    return text.getvalue(), marshal.dumps(stats.stats)
+
+
+class ProfilingMiddleware:
+    '''
+    ASGI middleware which profiles and captures requests (see the top of this module)
+
+    Parameters:
+    - is_admin (required): a coroutine function given the request's Authorization header, which says whether it belongs to an administrator
+    '''
+
+    def __init__(self, app, is_admin:Callable[[Optional[str]], Awaitable[bool]]):
+        self.app = app
+        self.is_admin = is_admin
+
+    async def __call__(self, scope, receive, send):
+        if(scope["type"] != "http"):
+            await self.app(scope, receive, send)
+            return
+
+        requested = False
+        authorization = None
+        for name, value in scope["headers"]:
+            if(name == PROFILE_HEADER):
+                requested = True
+            elif(name == b"authorization"):
+                authorization = value.decode("latin-1")
+        sampled = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+        if(not requested and not sampled and PROFILE_SLOW_REQUEST_SECONDS <= 0):
+            await self.app(scope, receive, send)
+            return
+
+        # Only administrators can ask for a profile, so nobody else can slow the app down with it
+        if(requested and not await self.is_admin(authorization)):
+            requested = False
+        profile = requested or sampled
+        profiler = None
+        if(profile and _profiler_lock.acquire(blocking=False)):
+            profiler = cProfile.Profile()
+
+        status_code = 500
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if(message["type"] == "http.response.start"):
+                status_code = message["status"]
+            await send(message)
+
+        capture = {"stages" : []}
+        token = _capture.set(capture)
+        start = time.perf_counter()
+        try:
+            if(profiler is not None):
+                profiler.enable()
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            if(profiler is not None):
+                profiler.disable()
+                _profiler_lock.release()
+            duration = time.perf_counter() - start
+            _capture.reset(token)
+
+            slow = PROFILE_SLOW_REQUEST_SECONDS > 0 and duration >= PROFILE_SLOW_REQUEST_SECONDS
+            if(requested or slow):
+                entry = {
+                    "time" : datetime.now(timezone.utc).isoformat(),
+                    "trigger" : "header" if requested else "slow",
+                    "method" : scope["method"],
+                    "path" : scope["path"],
+                    "route" : getattr(scope.get("route"), "path", None),
+                    "status" : status_code,
+                    "duration_ms" : round(duration * 1000, 3),
+                    **capture,
+                    "profiled" : profiler is not None,
+                }
+                if(profiler is not None):
+                    entry["profile"], entry["pstats"] = _summary(profiler)
+                elif(profile):
+                    entry["note"] = "Not profiled, another request was being profiled at the same time"
+                request_log.add(entry)
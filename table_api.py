@@ -1,68 +1,221 @@
-from azure.data.tables import TableServiceClient, TableClient
-import json
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.data.tables import TableServiceClient, TableClient, UpdateMode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ttl_cache import TTLCache
+import entity_json
+import io
+import logging
+import odata_filter
+import os
+import queue
+import re
+import requests
 import sys
-from typing import Any, Dict, List, Optional
+import table_emulator
+import tarfile
+import threading
+import zipfile
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, TextIO, Tuple, Union
 
 
 
 DEFAULT_PARTITION_KEY = "pkey"
 DEFAULT_TABLE_NAME = "ncyd_configuration_info"
-
-
-def parse_file(path:str):
+# A line with only this on it separates entries in a text file (so does a blank line)
+ENTRY_SEPARATOR = "---"
+# The service returns at most 1000 entities per page
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# A transaction can only change entities within one partition, and at most 100 of them
+MAX_BATCH_SIZE = 100
+# When getting many entries, partitions with at least this many requested RowKeys are fetched with one filter query instead of point reads
+MULTI_GET_FILTER_THRESHOLD = 3
+# A filter can have at most 15 comparisons, one of which is used by the PartitionKey
+MAX_FILTER_ROW_KEYS = 14
+# How many reads are done at the same time when getting many entries
+MULTI_GET_CONCURRENCY = 8
+
+# Client pool settings
+# The pool is keyed by (connection string, table name), and connection strings can come from the API callers,
+# so it is bounded (least recently used clients are dropped first) to stop it from growing forever
+CLIENT_CACHE_SIZE = int(os.environ.get("TABLE_CLIENT_CACHE_SIZE", "32"))
+# How many keep-alive connections are kept open per host, shared by every pooled client
+HTTP_POOL_SIZE = int(os.environ.get("TABLE_HTTP_POOL_SIZE", "32"))
+
+# Entry cache settings (off unless ENTITY_CACHE_SIZE is set)
+# get_entry results (including entries that were not found) are kept for ENTITY_CACHE_TTL_SECONDS,
+# after which they are revalidated with their ETag, so an unchanged entry is not downloaded again
+# Entries changed through this module are removed from the cache straight away,
+# but changes made by other processes can take up to ENTITY_CACHE_TTL_SECONDS to show up
+ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", "0"))
+ENTITY_CACHE_TTL_SECONDS = float(os.environ.get("ENTITY_CACHE_TTL_SECONDS", "30"))
+
+entity_cache = TTLCache(max_size=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL_SECONDS, cache_none=True, keep_expired=True)
+
+# Fan-out query settings (see fanout_query)
+# How many partitions (or PartitionKey ranges) are scanned at the same time
+FANOUT_CONCURRENCY = int(os.environ.get("TABLE_FANOUT_CONCURRENCY", "8"))
+# Queries which do not pin a PartitionKey are only fanned out when the table has at least this many partitions
+FANOUT_MIN_PARTITIONS = int(os.environ.get("TABLE_FANOUT_MIN_PARTITIONS", "4"))
+# Whether a wide query on a table whose partitions are not known yet starts finding them in the background (see fastapi_host.api_query)
+# Finding them costs one request per partition every PARTITION_CACHE_TTL_SECONDS, so it is off unless the tables are queried often enough to pay for it
+# Without it, the partitions of a table are only known once a query asked to fan out
+FANOUT_DISCOVERY = os.environ.get("TABLE_FANOUT_DISCOVERY", "false").lower() in ("1", "true", "yes")
+# How long the discovered partitions of a table are remembered
+# A stale list only makes a fan-out less even, never incomplete, since the scans cover every PartitionKey between the known ones
+PARTITION_CACHE_TTL_SECONDS = float(os.environ.get("TABLE_PARTITION_CACHE_TTL_SECONDS", "300"))
+
+partition_cache = TTLCache(max_size=CLIENT_CACHE_SIZE, ttl=PARTITION_CACHE_TTL_SECONDS)
+
+# Change tracking settings (see changes)
+# Deleted entries leave a tombstone (an entity with just their PartitionKey and RowKey) in a table named after theirs with this suffix,
+# so a copy kept up to date with changes finds out about deletes too. TABLE_TOMBSTONES=false turns them off
+# Tombstones are never removed, so re-publishing an entry which was deleted leaves its (older) tombstone behind
+TABLE_TOMBSTONES = os.environ.get("TABLE_TOMBSTONES", "true").lower() in ("1", "true", "yes")
+TOMBSTONE_TABLE_SUFFIX = "Tombstones"
+MAX_TABLE_NAME_LENGTH = 63
+# How the database writes times (ie 2024-01-31T12:00:00.1234567Z), which watermarks are written as before they go in a filter
+_SERVICE_TIME = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{1,7})?Z$")
+
+logger = logging.getLogger(__name__)
+_pool_lock = threading.Lock()
+_service_clients:"OrderedDict[str, TableServiceClient]" = OrderedDict()
+# The pooled service clients by URL, so the tombstone table of a TableClient can be found
+_services_by_url:"OrderedDict[str, TableServiceClient]" = OrderedDict()
+_table_clients:"OrderedDict[Tuple[str, str], TableClient]" = OrderedDict()
+# Tables that are known to exist, so create_table_if_not_exists is only called once per table
+_known_tables:"OrderedDict[Tuple[str, str], bool]" = OrderedDict()
+_shared_transport:Optional[RequestsTransport] = None
+
+
+def parse_entries(source:Union[str, bytes, BinaryIO, TextIO]):
     '''
-    Parse a key-value pair text file into a python dictionary ready to be uploaded to the database
+    Parse key-value pair text into python dictionaries ready to be uploaded to the database
+    The text is read a line at a time and each entry is returned as soon as it is complete,
+    so large inputs never have to be loaded into memory all at once
+
+    Each line is a key-value pair in the format <key> = <value>, where the key and value can be in double quotes
+    A file can hold many entries, separated by blank lines or by lines containing only ---
 
     Parameters:
-    - path (required): the path to the text file containing key value pairs
+    - source (required): the path to a text file, the bytes of one, or an open (binary or text) file or stream
+      (anything with a .file attribute, like a FastAPI UploadFile, is read through that)
 
     Return:
-    a dictionary with the specified key-value pairs by the text file
+    an iterator of dictionaries, one per entry
     '''
-    
-    out = {}
 
-    with open(path, 'r') as file:
-        for line in file:
-            # Get rid of newline characters
-            line = line.replace("\n", "")
+    if(isinstance(source, str)):
+        with open(source, "r", encoding="utf-8-sig") as file:
+            yield from _parse_lines(file)
+        return
 
-            # Split into two parts
-            key_value = line.split("=")
+    if(isinstance(source, (bytes, bytearray, memoryview))):
+        source = io.BytesIO(source)
+    source = getattr(source, "file", source)
+    if(isinstance(source, io.TextIOBase)):
+        yield from _parse_lines(source)
+        return
+
+    # Decode the bytes as they are read, handling both \n and \r\n line endings
+    text = io.TextIOWrapper(source, encoding="utf-8-sig")
+    try:
+        yield from _parse_lines(text)
+    finally:
+        # Give the stream back to the caller instead of closing it along with the wrapper
+        text.detach()
 
-            # Strip leading and trailing whitespace
-            key_value[0] = key_value[0].strip()
-            key_value[1] = key_value[1].strip()
 
-            # Strip the extra quotations
-            if(key_value[0][0] == '"' and key_value[0][-1] == '"'):
-                key_value[0] = key_value[0][1:-1]
-            if(key_value[1][0] == '"' and key_value[1][-1] == '"'):
-                key_value[1] = key_value[1][1:-1]
+def _parse_lines(lines:Iterable[str]):
+    entry = {}
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+
+        # A blank line or --- ends the current entry
+        if(line == "" or line == ENTRY_SEPARATOR):
+            if(len(entry) > 0):
+                yield add_default_keys(entry)
+                entry = {}
+            continue
+
+        # Split on the first = only, so values can contain = too
+        key, separator, value = line.partition("=")
+        if(separator == ""):
+            raise ValueError("Line {} is not a key-value pair: {}".format(number, line))
+        entry[_unquote(key.strip())] = _unquote(value.strip())
+
+    if(len(entry) > 0):
+        yield add_default_keys(entry)
+
+
+def _unquote(text:str):
+    # Strip the extra quotations
+    if(len(text) >= 2 and text[0] == '"' and text[-1] == '"'):
+        return text[1:-1]
+    return text
+
+
+def add_default_keys(entry:Dict[str, Any]):
+    '''
+    Fill in the PartitionKey (DEFAULT_PARTITION_KEY) and RowKey (from "prefix" or "id") of an entry if they are missing
+
+    Parameters:
+    - entry (required): the dictionary to fill in, it is changed in place
+
+    Return:
+    the same dictionary
+    '''
 
-            out[key_value[0]] = key_value[1]
-    
     # Add a partition key if not specified
-    if("PartitionKey" not in out.keys()):
-        out["PartitionKey"] = DEFAULT_PARTITION_KEY
-    
+    if("PartitionKey" not in entry):
+        entry["PartitionKey"] = DEFAULT_PARTITION_KEY
+
     # Add a row key (required and must be unique)
-    if("RowKey" not in out.keys()):
-        try:
-            # Keep the old key in case querying for that
-            out["RowKey"] = out["prefix"]
-        except:
-            try:
-                out["RowKey"] = out["id"]
-            except:
-                raise Exception("Please provide a key named \"prefix\" or \"id\" with a unique value")
-    
-    return out
+    if("RowKey" not in entry):
+        # Keep the old key in case querying for that
+        if("prefix" in entry):
+            entry["RowKey"] = entry["prefix"]
+        elif("id" in entry):
+            entry["RowKey"] = entry["id"]
+        else:
+            raise Exception("Please provide a key named \"prefix\" or \"id\" with a unique value")
+
+    return entry
+
+
+def _parse_single(source:Union[str, bytes]):
+    entries = parse_entries(source)
+    entry = next(entries, None)
+    if(entry is None):
+        raise Exception("No key-value pairs were found")
+    if(next(entries, None) is not None):
+        raise Exception("Found more than one entry, please publish them as a batch")
+    return entry
+
+
+def parse_file(path:str):
+    '''
+    Parse a key-value pair text file holding a single entry into a python dictionary ready to be uploaded to the database
+
+    Parameters:
+    - path (required): the path to the text file containing key value pairs
+
+    Return:
+    a dictionary with the specified key-value pairs by the text file
+    '''
+
+    return _parse_single(path)
 
 
 def parse_bytes(text_bytes:bytes):
     '''
-    Parse a key-value pair bytes into a python dictionary ready to be uploaded to the database
+    Parse key-value pair bytes holding a single entry into a python dictionary ready to be uploaded to the database
 
     Parameters:
     - text_bytes (required): the bytes containing key value pairs
@@ -70,61 +223,135 @@ def parse_bytes(text_bytes:bytes):
     Return:
     a dictionary with the specified key-value pairs by the bytes
     '''
-    
-    out = {}
 
-    text = text_bytes.decode("utf-8")
+    return _parse_single(text_bytes)
 
-    for line in text.split("\n"):
-        # Get rid of newline and carriage return characters
-        line = line.replace("\r", "")
 
-        # Split into two parts (key and value)
-        key_value = line.split(" = ")
-        
-        # Strip the extra quatations
-        if(key_value[0][0] == '"' and key_value[0][-1] == '"'):
-            key_value[0] = key_value[0][1:-1]
-        if(key_value[1][0] == '"' and key_value[1][-1] == '"'):
-            key_value[1] = key_value[1][1:-1]
-    
-        out[key_value[0]] = key_value[1]
-    
-    # Add a partition key if not specified
-    if("PartitionKey" not in out.keys()):
-        out["PartitionKey"] = DEFAULT_PARTITION_KEY
-    
-    # Add a row key (required and must be unique)
-    if("RowKey" not in out.keys()):
-        try:
-            # Keep the old key in case querying for that
-            out["RowKey"] = out["prefix"]
-        except:
-            try:
-                out["RowKey"] = out["id"]
-            except:
-                raise Exception("Please provide a key named \"prefix\" or \"id\" with a unique value")
-    
-    return out
+def is_archive(data:Union[bytes, BinaryIO]):
+    '''
+    Check whether some bytes (or a binary file) are a zip or tar (optionally compressed) archive
+
+    Parameters:
+    - data (required): the bytes or binary file to check
+
+    Return:
+    True if the bytes are a zip or tar archive, otherwise False
+    '''
+
+    stream = _as_binary_stream(data)
+    try:
+        if(zipfile.is_zipfile(stream)):
+            return True
+        stream.seek(0)
+        return tarfile.is_tarfile(stream)
+    finally:
+        stream.seek(0)
+
+
+def parse_archive(data:Union[bytes, BinaryIO]):
+    '''
+    Parse every key-value pair text file inside a zip or tar archive (see parse_entries)
+
+    Parameters:
+    - data (required): the bytes of (or a binary file holding) a zip or tar (optionally compressed) archive
+
+    Return:
+    an iterator of dictionaries, one per entry in the files in the archive
+    '''
+
+    stream = _as_binary_stream(data)
+    if(zipfile.is_zipfile(stream)):
+        stream.seek(0)
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if(info.is_dir() or _is_hidden(info.filename)):
+                    continue
+                with archive.open(info) as member_file:
+                    yield from parse_entries(member_file)
+    else:
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode="r:*") as archive:
+            for member in archive:
+                if(not member.isfile() or _is_hidden(member.name)):
+                    continue
+                yield from parse_entries(archive.extractfile(member))
+
+
+def _as_binary_stream(data:Union[bytes, BinaryIO]):
+    if(isinstance(data, (bytes, bytearray, memoryview))):
+        return io.BytesIO(data)
+    return getattr(data, "file", data)
+
+
+def _is_hidden(path:str):
+    # Skip things like .DS_Store and __MACOSX/ that get added to archives
+    return any(part.startswith(".") or part == "__MACOSX" for part in path.replace("\\", "/").split("/"))
+
+
+def _lru_put(cache:OrderedDict, key, value):
+    # Must be called while holding _pool_lock
+    cache[key] = value
+    cache.move_to_end(key)
+    while(len(cache) > CLIENT_CACHE_SIZE):
+        # Evicted clients are not closed, since another thread may still be using them
+        # They share the same transport, so nothing is leaked once they are garbage collected
+        cache.popitem(last=False)
+
+
+def _get_transport():
+    '''
+    Get the HTTP transport shared by every pooled client, so keep-alive connections are reused between requests
+    '''
+
+    global _shared_transport
+    with _pool_lock:
+        if(_shared_transport is None):
+            session = requests.Session()
+            # The Azure SDK does its own retries, so turn off the ones in requests
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=Retry(total=False, redirect=False, raise_on_status=False))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            # Not owning the session means closing one client will not close the connections for all the others
+            _shared_transport = RequestsTransport(session=session, session_owner=False)
+        return _shared_transport
 
 
 def connect_to_db(conn_str:str):
     '''
     Get a TableServiceClient to do operations on a Cosmos Table API database
+    Clients are pooled, so calling this again with the same connection string returns the same client
 
     Parameters:
-    - conn_str: the connection string to access a Cosmos Table API database
+    - conn_str: the connection string to access a Cosmos Table API database (or the emulator, see table_emulator)
 
     Return:
     a TableServiceClient which points to the database specified in the connection string
     '''
 
-    return TableServiceClient.from_connection_string(conn_str)
+    with _pool_lock:
+        db = _service_clients.get(conn_str)
+        if(db is not None):
+            _service_clients.move_to_end(conn_str)
+            return db
+
+    emulator_conn_str = table_emulator.emulator_connection_string(conn_str)
+    if(emulator_conn_str is not None):
+        # A local backend for testing and benchmarking (see table_emulator)
+        db = table_emulator.TableServiceClient.from_connection_string(emulator_conn_str)
+    else:
+        db = TableServiceClient.from_connection_string(conn_str, transport=_get_transport())
+    with _pool_lock:
+        # Another thread may have made one at the same time, keep the first one
+        db = _service_clients.get(conn_str, db)
+        _lru_put(_service_clients, conn_str, db)
+        _lru_put(_services_by_url, db.url, db)
+    return db
 
 
 def connect_to_table(db:TableServiceClient, table_name:str):
     '''
     Get a TableClient to do operations on a Cosmos Table API table
+    The table is created if it does not exist yet, but this is only checked the first time a table is used
 
     Parameters:
     - db (required): a TableClientService which points to the database in which the table is located
@@ -134,24 +361,185 @@ def connect_to_table(db:TableServiceClient, table_name:str):
     a TableClient which points to the table specified by table_name
     '''
 
-    return db.create_table_if_not_exists(table_name)
+    key = (db.url, table_name)
+    with _pool_lock:
+        if(key in _known_tables):
+            _known_tables.move_to_end(key)
+            return db.get_table_client(table_name)
+
+    table = db.create_table_if_not_exists(table_name)
+    with _pool_lock:
+        _lru_put(_known_tables, key, True)
+    return table
 
 
-def upsert_entry(table:TableClient, entry:Dict[str, Any]):
+def get_table(conn_str:str, table_name:str = DEFAULT_TABLE_NAME):
+    '''
+    Get a pooled TableClient for a table, reusing the same client (and its connections) between calls
+    This is thread safe, and should be preferred over calling connect_to_db and connect_to_table every time
+
+    Parameters:
+    - conn_str (required): the connection string to access a Cosmos Table API database
+    - table_name: the name of the table to access
+
+    Return:
+    a TableClient which points to the table specified by table_name
+    '''
+
+    key = (conn_str, table_name)
+    with _pool_lock:
+        table = _table_clients.get(key)
+        if(table is not None):
+            _table_clients.move_to_end(key)
+            return table
+
+    table = connect_to_table(connect_to_db(conn_str), table_name)
+    with _pool_lock:
+        table = _table_clients.get(key, table)
+        _lru_put(_table_clients, key, table)
+    return table
+
+
+def clear_client_pool():
+    '''
+    Forget every pooled client and known table, so the next call reconnects (ie after a table was deleted)
+
+    Return: None
+    '''
+
+    with _pool_lock:
+        _table_clients.clear()
+        _service_clients.clear()
+        _services_by_url.clear()
+        _known_tables.clear()
+
+
+def entity_cache_key(table:TableClient, partition_key:str, row_key:str):
+    '''
+    Get the key an entry is cached under in entity_cache (works for both sync and async TableClients)
+    '''
+
+    return (table.url, table.table_name, partition_key, row_key)
+
+
+def invalidate_entries(table:TableClient, keys:Iterable[Dict[str, str]]):
+    '''
+    Remove entries from entity_cache, so the next get_entry reads them from the database
+
+    Parameters:
+    - table (required): a TableClient which points to the table the entries are in
+    - keys (required): an iterable of dictionaries with the PartitionKey and RowKey of each entry
+
+    Return: None
+    '''
+
+    if(not entity_cache.enabled):
+        return
+    for key in keys:
+        entity_cache.invalidate(entity_cache_key(table, key["PartitionKey"], key["RowKey"]))
+
+
+def upsert_entry(table:TableClient, entry:Dict[str, Any], etag:Optional[str] = None):
     '''
     Upload an entry to the database
 
     Parameters:
     - table (required): a TableClient which points to the table to be queried
     - entry (required): a dictionary with string keys. Nested objects not supported
+    - etag: only update the entry if it still has this ETag (see write_conditions), raises ResourceModifiedError if it changed and ResourceNotFoundError if it does not exist
 
-    Return: None
+    Return:
+    the metadata of the new version of the entry (ie its "etag")
+    '''
+
+    try:
+        if(etag is None):
+            return table.upsert_entity(entry)
+        return table.update_entity(entry, mode=UpdateMode.MERGE, **write_conditions(etag))
+    finally:
+        # Even a failed conditional update means the entry changed, so the cached copy is dropped either way
+        invalidate_entries(table, [entry])
+
+
+def group_into_batches(entries:Iterable[Dict[str, Any]]):
+    '''
+    Group entries into batches that can each be sent as one transaction (same PartitionKey, at most MAX_BATCH_SIZE entries)
+    A transaction can't change the same entity twice, so if an entry shows up again before its batch is sent, the last one wins
+    Entries are only held until their batch is full, so this works on iterators that are too large to fit in memory
+
+    Parameters:
+    - entries (required): an iterable of dictionaries, each with a PartitionKey and a RowKey
+
+    Return:
+    an iterator of lists of entries
     '''
 
-    table.upsert_entity(entry)
+    partitions:Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for entry in entries:
+        batch = partitions.setdefault(entry["PartitionKey"], {})
+        batch[entry["RowKey"]] = entry
+        if(len(batch) >= MAX_BATCH_SIZE):
+            yield list(batch.values())
+            del partitions[entry["PartitionKey"]]
+    for batch in partitions.values():
+        yield list(batch.values())
+
+
+def batch_results(batch:List[Dict[str, Any]], error:Optional[Exception] = None):
+    '''
+    Get the per-entry results of sending a batch, for reporting back to the user
 
+    Parameters:
+    - batch (required): the entries that were in the batch
+    - error: the error raised when sending the batch, None if it succeeded
 
-def delete_entry(table:TableClient, id:str, partition_key:Optional[str] = None):
+    Return:
+    a list with a dictionary for each entry, with its PartitionKey, RowKey, whether it succeeded, and the error if it did not
+    '''
+
+    results = []
+    for entry in batch:
+        result = {"PartitionKey" : entry["PartitionKey"], "RowKey" : entry["RowKey"], "success" : error is None}
+        if(error is not None):
+            # Transactions are all or nothing, so every entry in a failed batch failed together
+            result["error"] = getattr(error, "message", None) or str(error)
+        results.append(result)
+    return results
+
+
+def upsert_entries(table:TableClient, entries:Iterable[Dict[str, Any]]):
+    '''
+    Upload many entries to the database, using one transaction per batch of up to MAX_BATCH_SIZE entries in the same partition
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - entries (required): an iterable of dictionaries with string keys. Nested objects not supported
+
+    Return:
+    a list with a result for each entry (see batch_results)
+    '''
+
+    results = []
+    for batch in group_into_batches(entries):
+        try:
+            table.submit_transaction([("upsert", entry) for entry in batch])
+            results.extend(batch_results(batch))
+        except HttpResponseError as e:
+            results.extend(batch_results(batch, e))
+        except TypeError:
+            # A value the SDK can't send (ie a nested object), found before anything was sent
+            # The error does not say which entry it was, so the entries are sent one at a time and only the bad ones fail
+            for entry in batch:
+                try:
+                    table.upsert_entity(entry)
+                    results.extend(batch_results([entry]))
+                except (HttpResponseError, TypeError) as e:
+                    results.extend(batch_results([entry], e))
+        invalidate_entries(table, batch)
+    return results
+
+
+def delete_entry(table:TableClient, id:str, partition_key:Optional[str] = None, etag:Optional[str] = None):
     '''
     Delete an entry from the database
 
@@ -159,14 +547,82 @@ def delete_entry(table:TableClient, id:str, partition_key:Optional[str] = None):
     - table (required): a TableClient which points to the table to be queried
     - id (required): the id of the entry to get
     - partition_key: the partition the entry is in
+    - etag: only delete the entry if it still has this ETag (see write_conditions), raises ResourceModifiedError if it changed
 
     Return: None
     '''
 
     if(partition_key is None):
-        table.delete_entity(partition_key=DEFAULT_PARTITION_KEY, row_key=id)
-        return
-    table.delete_entity(partition_key, id)
+        partition_key = DEFAULT_PARTITION_KEY
+    key = {"PartitionKey" : partition_key, "RowKey" : id}
+    try:
+        table.delete_entity(partition_key=partition_key, row_key=id, **write_conditions(etag))
+    finally:
+        invalidate_entries(table, [key])
+    # Only once the entry is gone, so a copy kept up to date with changes never deletes an entry which is still there
+    # (a tombstone which can't be written is logged, not raised, see write_tombstones)
+    write_tombstones(table, [key])
+
+
+def list_keys(table:TableClient, query:Optional[str]=None):
+    '''
+    Get the keys of the entries which meet a query, without downloading the rest of their fields
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - query: a string to specify the query (see query for formatting). None returns all entries in the table
+
+    Return:
+    an iterator of dictionaries with only the PartitionKey and RowKey of each entry
+    '''
+
+    for entity in table.query_entities(query_filter=query, select=["PartitionKey", "RowKey"]):
+        yield {"PartitionKey" : entity["PartitionKey"], "RowKey" : entity["RowKey"]}
+
+
+def delete_entries(table:TableClient, keys:Optional[Iterable[Dict[str, str]]]=None, query:Optional[str]=None, dry_run:bool=False):
+    '''
+    Delete many entries from the database, using one transaction per batch of up to MAX_BATCH_SIZE entries in the same partition
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - keys: an iterable of dictionaries with the PartitionKey and RowKey of each entry to delete
+    - query: instead of keys, delete every entry which meets this query (see query for formatting)
+    - dry_run: only count the entries which would be deleted, without deleting them
+
+    Return:
+    a dictionary with how many entries matched, how many were deleted, and the results of any that failed (see batch_results)
+    '''
+
+    if((keys is None) == (query is None)):
+        raise ValueError("Exactly one of keys or query must be given")
+    if(keys is None):
+        keys = list_keys(table, query)
+
+    summary = {"matched" : 0, "deleted" : 0, "failed" : []}
+    for batch in group_into_batches(keys):
+        summary["matched"] += len(batch)
+        if(dry_run):
+            continue
+        deleted = batch
+        try:
+            table.submit_transaction([("delete", key) for key in batch])
+        except HttpResponseError:
+            # The whole transaction fails if any entry in it is already gone, so retry them one at a time
+            # (deleting an entry that does not exist on its own is not an error)
+            deleted = []
+            for key in batch:
+                try:
+                    table.delete_entity(partition_key=key["PartitionKey"], row_key=key["RowKey"])
+                    deleted.append(key)
+                except HttpResponseError as e:
+                    summary["failed"].extend(batch_results([key], e))
+        finally:
+            # Only once the entries are gone, so a read which started in between can't cache them again (see cache_read_result)
+            invalidate_entries(table, batch)
+        summary["deleted"] += len(deleted)
+        write_tombstones(table, deleted)
+    return summary
 
 
 def get_entry(table:TableClient, id:str, partition_key:Optional[str] = None):
@@ -182,17 +638,181 @@ def get_entry(table:TableClient, id:str, partition_key:Optional[str] = None):
     a dictionary representation of the entry
     '''
 
+    if(partition_key is None):
+        partition_key = DEFAULT_PARTITION_KEY
+    if(not entity_cache.enabled):
+        try:
+            return table.get_entity(partition_key=partition_key, row_key=id)
+        except ResourceNotFoundError:
+            return None
+
+    key = entity_cache_key(table, partition_key, id)
+    # Taken before reading, so an update (which invalidates the key) during the read keeps what was read out of the cache
+    generation = entity_cache.generation(key)
+    found, entry, fresh = entity_cache.peek(key)
+    if(found and fresh):
+        return entry
     try:
-        if(partition_key is None):
-            return table.get_entity(partition_key=DEFAULT_PARTITION_KEY, row_key=id)
-        return table.get_entity(partition_key=partition_key, row_key=id)
-    except:
+        return cache_read_result(key, entry, table.get_entity(partition_key=partition_key, row_key=id, headers=revalidation_headers(entry)), generation=generation)
+    except HttpResponseError as e:
+        if(e.status_code != 304 and not isinstance(e, ResourceNotFoundError)):
+            raise
+        return cache_read_result(key, entry, error=e, generation=generation)
+
+
+def entity_etag(entry:Optional[Dict[str, Any]]):
+    # The ETag of an entry read from the database (it changes every time the entry does), None if it is not known
+    return getattr(entry, "metadata", {}).get("etag")
+
+
+def etag_matches(condition:Optional[str], etag:Optional[str]):
+    '''
+    Check an ETag against the value of an HTTP If-Match or If-None-Match header
+
+    Parameters:
+    - condition (required): the header's value, one or more ETags separated by commas, or "*" for any ETag
+    - etag (required): the ETag of the entry, None if it does not exist
+
+    Return:
+    True if the entry exists and its ETag is one of those in condition
+    '''
+
+    if(condition is None or etag is None):
+        return False
+    # The ETags of the database do not have commas in them
+    return any(tag.strip() in ("*", etag) for tag in condition.split(","))
+
+
+def write_conditions(etag:Optional[str]):
+    '''
+    Get the keyword arguments for update_entity or delete_entity which make it only go through if the entry still has the ETag etag (optimistic concurrency)
+    An ETag of "*" only needs the entry to exist, like an HTTP If-Match header (None has no condition at all)
+    '''
+
+    if(etag is None or etag.strip() == "*"):
+        return {}
+    return {"etag" : etag, "match_condition" : MatchConditions.IfNotModified}
+
+
+def revalidation_headers(entry:Optional[Dict[str, Any]]):
+    # Ask the database to only send the entry back if it changed since we cached it
+    etag = entity_etag(entry)
+    if(etag is None):
         return None
+    return {"If-None-Match" : etag}
+
+
+def cache_read_result(key:Tuple, cached_entry:Optional[Dict[str, Any]], entry:Optional[Dict[str, Any]] = None, error:Optional[HttpResponseError] = None, generation:Optional[tuple] = None):
+    # Shared by the sync and async get_entry, puts the result of a read into entity_cache and returns the entry
+    # generation is the key's generation from before the read (see TTLCache.generation), so a read which raced with an update is not cached
+    if(error is None):
+        entity_cache.put(key, entry, generation=generation)
+        return entry
+    if(error.status_code == 304):
+        # Not modified, so our cached copy is still good
+        entity_cache.refresh(key)
+        return cached_entry
+    if(isinstance(error, ResourceNotFoundError)):
+        # Remember that it does not exist too, so repeated lookups for a missing entry are cheap
+        entity_cache.put(key, None, generation=generation)
+    return None
+
+
+def odata_string(value:str):
+    '''
+    Write a string as an OData literal, ie it's becomes 'it''s'
+
+    Parameters:
+    - value (required): the string
+
+    Return:
+    the quoted string, which is safe to put in a filter
+    '''
+
+    return "'" + value.replace("'", "''") + "'"
+
+
+def plan_get_entries(keys:Iterable[Dict[str, str]]):
+    '''
+    Work out the cheapest reads to get many entries: a point read for each lone entry,
+    and one filter query per partition with at least MULTI_GET_FILTER_THRESHOLD requested entries
+
+    Parameters:
+    - keys (required): an iterable of dictionaries with the PartitionKey and RowKey of each entry to get
+
+    Return:
+    a tuple (unique_keys, reads) with the keys without duplicates (in the order they were given),
+    and a list of reads, each either ("get", PartitionKey, RowKey) or ("query", filter, parameters)
+    '''
+
+    unique_keys = list(dict.fromkeys((key["PartitionKey"], key["RowKey"]) for key in keys))
+    partitions:Dict[str, List[str]] = {}
+    for partition_key, row_key in unique_keys:
+        partitions.setdefault(partition_key, []).append(row_key)
+
+    reads = []
+    for partition_key, row_keys in partitions.items():
+        if(len(row_keys) < MULTI_GET_FILTER_THRESHOLD):
+            reads.extend(("get", partition_key, row_key) for row_key in row_keys)
+            continue
+        for i in range(0, len(row_keys), MAX_FILTER_ROW_KEYS):
+            chunk = row_keys[i:i + MAX_FILTER_ROW_KEYS]
+            # The keys are written into the filter as literals, because the SDK only fills in parameters which are separate words
+            row_filter = " or ".join(f"RowKey eq {odata_string(row_key)}" for row_key in chunk)
+            reads.append(("query", f"PartitionKey eq {odata_string(partition_key)} and ({row_filter})", {}))
+    return unique_keys, reads
+
+
+def get_entries(table:TableClient, keys:Iterable[Dict[str, str]], max_concurrency:int = MULTI_GET_CONCURRENCY):
+    '''
+    Get many specific entries from the database at once, reading up to max_concurrency at the same time (see plan_get_entries)
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - keys (required): an iterable of dictionaries with the PartitionKey and RowKey of each entry to get
+    - max_concurrency: the maximum number of reads to do at the same time
+
+    Return:
+    a tuple (found, missing) with a list of dictionary representations of the entries that were found,
+    and a list of the keys that were not found
+    '''
+
+    unique_keys, reads = plan_get_entries(keys)
+
+    def read(plan):
+        if(plan[0] == "get"):
+            entry = get_entry(table, plan[2], plan[1])
+            return [] if entry is None else [entry]
+        return list(table.query_entities(query_filter=plan[1], parameters=plan[2]))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(reads)))) as executor:
+        entries = [entry for results in executor.map(read, reads) for entry in results]
+    return found_and_missing(unique_keys, entries)
+
+
+def found_and_missing(unique_keys:List[Tuple[str, str]], entries:Iterable[Dict[str, Any]]):
+    '''
+    Put the entries that were read back in the order they were asked for, and find which ones were missing
+
+    Parameters:
+    - unique_keys (required): the (PartitionKey, RowKey) of each entry that was asked for
+    - entries (required): the entries that were read
+
+    Return:
+    a tuple (found, missing) with a list of the entries that were found, and a list of the keys that were not found
+    '''
+
+    by_key = {(entry["PartitionKey"], entry["RowKey"]) : entry for entry in entries}
+    found = [by_key[key] for key in unique_keys if key in by_key]
+    missing = [{"PartitionKey" : key[0], "RowKey" : key[1]} for key in unique_keys if key not in by_key]
+    return found, missing
 
 
 def query(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]]=None):
     '''
     Query the database
+    The query is checked before it is sent (see odata_filter), and queries which only look up entries by PartitionKey and RowKey
+    (ie PartitionKey eq 'pkey' and RowKey eq 'my_id') are answered with point reads, which are much cheaper than a query
 
     Parameters:
     - table (required): a TableClient which points to the table to be queried
@@ -202,6 +822,8 @@ def query(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]
     Return:
     an iterable containing dictionary representations of the entries which meet the query requirements
 
+    Raises ValueError if the query is not valid
+
     Formatting a query string:\n
     Only specify required conditions, in the format <field> <operator> <value>\n
     *Note: the value must be within single quotes (ie 'value') if it is a string\n
@@ -219,7 +841,568 @@ def query(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]
     mystring eq 'welcome' and mynumber gt 10
     '''
 
-    return table.query_entities(query_filter=query, select=fields)
+    plan = plan_query(query)
+    if(plan.kind == odata_filter.POINT_READ):
+        return point_read(table, plan.keys, fields)
+    return table.query_entities(query_filter=plan.filter, select=fields)
+
+
+def plan_query(query:Optional[str]):
+    '''
+    Check a query and decide how it will run (see odata_filter.plan_query)
+
+    Parameters:
+    - query: a string to specify the query (see query for formatting)
+
+    Return:
+    an odata_filter.QueryPlan, whose explain() describes the plan
+
+    Raises ValueError if the query is not valid
+    '''
+
+    return odata_filter.plan_query(query)
+
+
+def select_fields(entry:Dict[str, Any], fields:Optional[List[str]]):
+    # Point reads always return every field, so the projection is done here (a missing field is null, like in a query)
+    if(fields is None):
+        return entry
+    return {field : entry.get(field) for field in fields}
+
+
+def point_read(table:TableClient, keys:List[Tuple[str, str]], fields:Optional[List[str]]=None):
+    '''
+    Read entries by key, for queries that only look up entries by PartitionKey and RowKey (see get_entries)
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - keys (required): the (PartitionKey, RowKey) of each entry to read
+    - fields: a list of which fields should be returned. None returns all fields
+
+    Return:
+    an iterator containing dictionary representations of the entries which were found
+    '''
+
+    if(len(keys) == 1):
+        entry = get_entry(table, keys[0][1], keys[0][0])
+        found = [] if entry is None else [entry]
+    else:
+        found, _ = get_entries(table, [{"PartitionKey" : partition_key, "RowKey" : row_key} for partition_key, row_key in keys])
+    for entry in found:
+        yield select_fields(entry, fields)
+
+
+def query_page(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]]=None, page_size:int=DEFAULT_PAGE_SIZE, continuation:Optional[Dict[str, str]]=None):
+    '''
+    Query one page of the database, so large results can be fetched a bit at a time
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - query: a string to specify the query (see query for formatting). None returns all entries in the table
+    - fields: a list of which fields should be returned. None returns all fields
+    - page_size: the maximum number of entries to return (at most MAX_PAGE_SIZE)
+    - continuation: the continuation token returned with the previous page. None starts from the beginning
+
+    Return:
+    a tuple (entries, continuation) with a list of dictionary representations of the entries in this page,
+    and the continuation token to pass in to get the next page (None if there are no more pages)
+    '''
+
+    plan = plan_query(query)
+    if(plan.kind == odata_filter.POINT_READ):
+        # A point read query can match at most a few entries, so they all fit in one page
+        return list(point_read(table, plan.keys, fields)), None
+    pages = table.query_entities(query_filter=plan.filter, select=fields, results_per_page=page_size).by_page(continuation_token=continuation)
+    try:
+        page = list(next(pages))
+    except StopIteration:
+        return [], None
+    return page, pages.continuation_token
+
+
+def split_query(query:Optional[str] = None, partitions:Optional[List[str]] = None, ranges:Optional[List[Tuple[str, str]]] = None):
+    '''
+    Split a query into scans that can run at the same time, one per partition or PartitionKey range
+
+    Parameters:
+    - query: a string to specify the query (see query for formatting). None matches every entry
+    - partitions: a list of PartitionKeys to scan
+    - ranges: a list of (start, end) PartitionKey ranges to scan, where start is included and end is not ("" means no limit)
+
+    Return:
+    a list of (filter, parameters) tuples, one per scan (a single scan of the whole query if there are no partitions or ranges)
+    '''
+
+    # The keys are written into the filters as literals, the SDK's parameters break on queries with double spaces or @ in a string
+    scans = []
+    for partition in partitions or []:
+        scans.append(f"PartitionKey eq {odata_string(partition)}")
+    for start, end in ranges or []:
+        conditions = []
+        if(start != ""):
+            conditions.append(f"PartitionKey ge {odata_string(start)}")
+        if(end != ""):
+            conditions.append(f"PartitionKey lt {odata_string(end)}")
+        scans.append(" and ".join(conditions) or None)
+    if(len(scans) == 0):
+        scans.append(None)
+
+    if(query is not None):
+        scans = [f"({query}) and ({scan_filter})" if scan_filter is not None else query for scan_filter in scans]
+    return [(scan_filter, {}) for scan_filter in scans]
+
+
+def pins_partition(query:Optional[str]):
+    '''
+    Check if a query only reads from known partitions (ie PartitionKey eq 'prod' and version gt 3), which is already fast without fanning out
+
+    Parameters:
+    - query: a string to specify the query (see query for formatting)
+
+    Return:
+    a boolean (False for a query which is not valid)
+    '''
+
+    try:
+        return plan_query(query).kind != odata_filter.SCAN
+    except ValueError:
+        return False
+
+
+def partition_cache_key(table:TableClient):
+    return (table.url, table.table_name)
+
+
+def discovery_filter(last:Optional[str]):
+    # Each discovery request asks for the first entity after the last partition found, which skips the rest of that partition
+    if(last is None):
+        return "PartitionKey ge @after", {"after" : ""}
+    return "PartitionKey gt @after", {"after" : last}
+
+
+def fanout_ranges(partitions:List[str]):
+    '''
+    Turn the known partitions of a table into PartitionKey ranges which together cover every possible PartitionKey,
+    so partitions created after the list was made are still found
+
+    Parameters:
+    - partitions (required): a list of PartitionKeys
+
+    Return:
+    a sorted list of (start, end) ranges, one per partition (see split_query)
+    '''
+
+    boundaries = sorted(set(partitions))[1:]
+    starts = [""] + boundaries
+    ends = boundaries + [""]
+    return list(zip(starts, ends))
+
+
+def fanout_worthwhile(query:Optional[str], partition_count:Optional[int]):
+    '''
+    Estimate whether fanning out a query over the partitions will be faster than one sequential scan
+
+    Parameters:
+    - query: a string to specify the query (see query for formatting)
+    - partition_count: how many partitions the table has, None if not known yet
+
+    Return:
+    a boolean
+    '''
+
+    if(partition_count is None or pins_partition(query)):
+        return False
+    return partition_count >= FANOUT_MIN_PARTITIONS
+
+
+def discover_partitions(table:TableClient, refresh:bool = False):
+    '''
+    Find every PartitionKey in a table, with one small request per partition
+    The result is cached for PARTITION_CACHE_TTL_SECONDS
+
+    Parameters:
+    - table (required): a TableClient which points to the table
+    - refresh: whether to ignore the cached partitions and look again
+
+    Return:
+    a sorted list of PartitionKeys
+    '''
+
+    def load():
+        partitions = []
+        last = None
+        while(True):
+            query_filter, parameters = discovery_filter(last)
+            # Iterating the entities (not the first page) follows continuation tokens past empty pages
+            entity = next(iter(table.query_entities(query_filter=query_filter, parameters=parameters, select=["PartitionKey"], results_per_page=1)), None)
+            if(entity is None):
+                return partitions
+            last = entity["PartitionKey"]
+            partitions.append(last)
+
+    key = partition_cache_key(table)
+    if(refresh):
+        partition_cache.invalidate(key)
+    return partition_cache.get_or_load(key, load)
+
+
+def fanout_query(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]]=None, partitions:Optional[List[str]]=None, max_concurrency:int=FANOUT_CONCURRENCY, ordered:bool=False, limit:Optional[int]=None):
+    '''
+    Query the database by scanning many partitions at the same time, instead of one long cross-partition scan
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - query: a string to specify the query (see query for formatting). None returns all entries in the table
+    - fields: a list of which fields should be returned. None returns all fields
+    - partitions: a list of PartitionKeys to scan (only these partitions are read). None discovers the partitions of the table (see discover_partitions)
+    - max_concurrency: the maximum number of partitions to scan at the same time
+    - ordered: whether to return the entries ordered by PartitionKey and RowKey, like query does. Otherwise they are returned as soon as they arrive
+    - limit: stop after this many entries. None returns every entry
+
+    Return:
+    an iterator containing dictionary representations of the entries which meet the query requirements
+    '''
+
+    # Checks the query before any scans start
+    query = plan_query(query).filter
+    if(partitions is None):
+        scans = split_query(query, ranges=fanout_ranges(discover_partitions(table)))
+    else:
+        scans = split_query(query, partitions=sorted(set(partitions)))
+    page_size = MAX_PAGE_SIZE if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+    stop = threading.Event()
+    # Pages are handed over through bounded queues, so scans wait for the caller instead of reading everything into memory
+    # When ordered, each scan has its own queue and they are read one after the other, otherwise they all share one
+    if(ordered):
+        queues = [queue.Queue(maxsize=2) for _ in scans]
+    else:
+        queues = [queue.Queue(maxsize=max(1, max_concurrency) * 2)] * len(scans)
+
+    def put(target:queue.Queue, item):
+        while(not stop.is_set()):
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan(index:int):
+        if(stop.is_set()):
+            return
+        scan_filter, parameters = scans[index]
+        try:
+            for page in table.query_entities(query_filter=scan_filter, select=fields, parameters=parameters, results_per_page=page_size).by_page():
+                if(not put(queues[index], list(page))):
+                    return
+        except Exception as e:
+            put(queues[index], e)
+            return
+        put(queues[index], None)
+
+    def pages():
+        if(ordered):
+            for index in range(len(scans)):
+                while(True):
+                    page = queues[index].get()
+                    if(page is None):
+                        break
+                    yield page
+        else:
+            running = len(scans)
+            while(running > 0):
+                page = queues[0].get()
+                if(page is None):
+                    running -= 1
+                    continue
+                yield page
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(scans))))
+    try:
+        # The executor starts scans in order, so when ordered, the scans being read next are always the ones running
+        for index in range(len(scans)):
+            executor.submit(scan, index)
+        count = 0
+        for page in pages():
+            if(isinstance(page, Exception)):
+                raise page
+            for entity in page:
+                yield entity
+                count += 1
+                if(limit is not None and count >= limit):
+                    return
+    finally:
+        # Also runs when the caller stops early, so the scans that are still going stop too
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def tombstone_table_name(table_name:str):
+    # The table which holds the tombstones of a table's deleted entries
+    return table_name[:MAX_TABLE_NAME_LENGTH - len(TOMBSTONE_TABLE_SUFFIX)] + TOMBSTONE_TABLE_SUFFIX
+
+
+def tombstones(keys:Iterable[Dict[str, str]]):
+    # Just the keys of the deleted entries, the database adds when they were written (their Timestamp)
+    return [{"PartitionKey" : key["PartitionKey"], "RowKey" : key["RowKey"]} for key in keys]
+
+
+def tombstone_table(table:TableClient):
+    '''
+    Get a TableClient for the tombstone table of a table (see TABLE_TOMBSTONES)
+
+    Parameters:
+    - table (required): a TableClient which came from get_table
+
+    Return:
+    a TableClient, or None if tombstones are turned off or the table's database is not in the client pool
+    '''
+
+    if(not TABLE_TOMBSTONES):
+        return None
+    with _pool_lock:
+        db = _services_by_url.get(table.url)
+    if(db is None):
+        return None
+    return connect_to_table(db, tombstone_table_name(table.table_name))
+
+
+def tombstones_failed(table:TableClient, count:int):
+    # The entries are already deleted, so failing the delete would only make the caller retry one that finds nothing left to delete
+    logger.warning("Could not write the tombstones of %d entries deleted from %s, copies kept up to date with changes will still have them", count, table.table_name, exc_info=True)
+
+
+def write_tombstones(table:TableClient, keys:Iterable[Dict[str, str]]):
+    '''
+    Leave a tombstone for each deleted entry, so changes can report it
+    A tombstone which can't be written is logged instead of raised, since it is written once the entries are already gone
+
+    Parameters:
+    - table (required): a TableClient which points to the table the entries were deleted from
+    - keys (required): the PartitionKey and RowKey of each deleted entry
+
+    Return: None
+    '''
+
+    tombstone_client = tombstone_table(table)
+    if(tombstone_client is None):
+        return
+    keys = tombstones(keys)
+    try:
+        for batch in group_into_batches(keys):
+            tombstone_client.submit_transaction([("upsert", tombstone) for tombstone in batch])
+    except AzureError:
+        tombstones_failed(table, len(keys))
+
+
+def parse_watermark(since:str):
+    '''
+    Check a watermark (see changes) and get the time it stands for
+
+    Raises ValueError if it is not an ISO 8601 time
+    '''
+
+    try:
+        timestamp = datetime.fromisoformat(since.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        raise ValueError(f"Invalid watermark '{since}': it should be an ISO 8601 time (ie 2024-01-31T12:00:00.0000000Z)")
+    if(timestamp.tzinfo is None):
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def _service_time(timestamp:datetime):
+    # A time written the way the database writes Timestamps (UTC, with 7 digits of fractional seconds)
+    if(timestamp.tzinfo is None):
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f") + "0Z"
+
+
+def normalize_watermark(since:str):
+    '''
+    Check a watermark and write it the way the database writes times (ie 2024-01-31T12:00:00.0000000Z), so it can go in a filter
+    A watermark which is already written that way is kept as it is, since it can be more precise than a datetime
+
+    Raises ValueError if it is not an ISO 8601 time
+    '''
+
+    timestamp = parse_watermark(since)
+    if(_SERVICE_TIME.match(since.strip()) is not None):
+        return since.strip()
+    return _service_time(timestamp)
+
+
+def watermark_text(timestamp:datetime):
+    # The database's own text for a Timestamp when it is known, since it is more precise than a datetime (100 nanoseconds)
+    service_value = getattr(timestamp, "tables_service_value", "")
+    if(service_value != ""):
+        return service_value
+    return _service_time(timestamp)
+
+
+def since_filter(query:Optional[str], since:Optional[str], until:Optional[str] = None):
+    '''
+    Add a watermark to a query, so it only matches entries written after it (see changes)
+
+    Parameters:
+    - query (required): a string to specify the query (see query for formatting), or None for all entries
+    - since (required): the watermark, or None to leave the query as it is
+    - until: only match entries written at or before this time (in the same format as a watermark)
+
+    Return:
+    the query string (None if all of them are None)
+
+    Raises ValueError if the watermark is not valid
+    '''
+
+    # The times go into the filter as text, so they are checked and written the way the database expects first
+    conditions = [f"Timestamp {op} datetime'{normalize_watermark(time)}'" for op, time in (("gt", since), ("le", until)) if time is not None]
+    if(query is not None and query.strip() != ""):
+        conditions.append(f"({query})")
+    if(len(conditions) == 0):
+        return None
+    return " and ".join(conditions)
+
+
+def change_query(query_str:Optional[str]):
+    # The parsed query of changes, which is checked against the changed entries here (see changes), or None for all entries
+    if(query_str is None or query_str.strip() == ""):
+        return None
+    return odata_filter.parse_filter(query_str)
+
+
+def change_fields(fields:Optional[List[str]], node = None):
+    # The keys are needed to apply a change, Timestamp is only sent back when it is selected,
+    # and the fields of the query are needed to check the changed entries against it
+    if(fields is None):
+        return None
+    return list(dict.fromkeys(["PartitionKey", "RowKey", *fields, "Timestamp", *odata_filter.query_fields(node)]))
+
+
+def change_set(changed:Iterable[Dict[str, Any]], deleted:Iterable[Dict[str, Any]], watermark:Optional[str], node = None, fields:Optional[List[str]] = None):
+    '''
+    Shared by the sync and async changes, puts the changed entries and tombstones in the order they were written, and finds the next watermark
+    Changed entries which do not meet the query (node) are reported with the deleted ones, since they are not in the results anymore
+
+    Parameters:
+    - changed (required): the entries written after the watermark
+    - deleted (required): the tombstones written after the watermark
+    - watermark (required): the watermark to return if none of the changes are newer
+    - node: the parsed query (see change_query)
+    - fields: the fields to return (see changes)
+    '''
+
+    earliest = datetime.min.replace(tzinfo=timezone.utc)
+    changed = sorted((entity_json.with_metadata(entity) for entity in changed), key=lambda entity: entity.get("Timestamp") or earliest)
+    deleted = [{"PartitionKey" : tombstone["PartitionKey"], "RowKey" : tombstone["RowKey"], "Timestamp" : tombstone.metadata.get("timestamp")} for tombstone in deleted]
+    timestamps = [item["Timestamp"] for item in changed + deleted if item.get("Timestamp") is not None]
+    if(len(timestamps) > 0 and (watermark is None or max(timestamps) > parse_watermark(watermark))):
+        watermark = watermark_text(max(timestamps))
+
+    if(node is not None):
+        deleted += [{"PartitionKey" : entity["PartitionKey"], "RowKey" : entity["RowKey"], "Timestamp" : entity.get("Timestamp")} for entity in changed if not odata_filter.evaluate(node, entity)]
+        changed = [entity for entity in changed if odata_filter.evaluate(node, entity)]
+    if(fields is not None):
+        # The fields only the query needed are left out again
+        wanted = [field for field in change_fields(fields) if field != "Timestamp"]
+        projected = []
+        for entity in changed:
+            entry = select_fields(entity, wanted)
+            entry.update({key : entity[key] for key in ("odata.etag", "Timestamp") if key in entity})
+            projected.append(entry)
+        changed = projected
+    deleted.sort(key=lambda tombstone: tombstone["Timestamp"] or earliest)
+    return {"changed" : changed, "deleted" : deleted, "watermark" : watermark}
+
+
+def changes_state(continuation:Optional[Dict[str, Any]], since:Optional[str]):
+    # Where a paged changes call is up to: which source it is reading ("changed" entries, then "deleted" tombstones), its continuation token there,
+    # the newest change seen so far, and the time the first page was read, which every page stops at so the pages add up to one consistent set of changes
+    if(continuation is not None):
+        return dict(continuation)
+    return {"source" : "changed", "token" : None, "watermark" : since, "until" : _service_time(datetime.now(timezone.utc))}
+
+
+def changes_page(result:Dict[str, Any], state:Dict[str, Any], done:bool):
+    # Shared by the sync and async changes, the watermark is only handed out with the last page, so a client can't skip the rest by using it
+    state["watermark"] = result["watermark"]
+    if(done):
+        if(result["watermark"] is None):
+            # A first call which found nothing still gets a watermark (the time it read up to), so the next call does not read everything again
+            result["watermark"] = state["until"]
+        result["continuation"] = None
+    else:
+        result["watermark"] = None
+        result["continuation"] = state
+    return result
+
+
+def changes(table:TableClient, since:Optional[str] = None, query_str:Optional[str] = None, fields:Optional[List[str]] = None, page_size:Optional[int] = None, continuation:Optional[Dict[str, Any]] = None):
+    '''
+    Get the entries written (or deleted) after a watermark, to keep a copy of a table up to date without reading all of it every time
+    Call it without a watermark the first time (which returns every entry), then with the watermark it returned
+    Changes are found by their Timestamp, which the database sets on every write, and deletes by their tombstones (see TABLE_TOMBSTONES)
+    Changes written while the call runs (or between its pages) are left for the next call
+
+    With a watermark, the entries written after it are read and checked against the query here, instead of by the database,
+    so an entry changed so that it no longer meets the query is reported as deleted (and one which never met it may be too)
+
+    Parameters:
+    - table (required): a TableClient which points to the table to be queried
+    - since: the watermark returned by the last call, None to get every entry
+    - query_str: only return changed entries which meet this query (see query for formatting)
+    - fields: a list of which fields should be returned. None returns all fields (PartitionKey and RowKey are always returned)
+    - page_size: get the changes a page at a time, with up to this many changed entries or deleted keys (at most MAX_PAGE_SIZE) per page
+    - continuation: the continuation returned with the previous page. None starts from the beginning
+
+    Return:
+    a dictionary with:
+    - "changed": the entries written after the watermark, with their "odata.etag" and "Timestamp", oldest first
+    - "deleted": the PartitionKey, RowKey and Timestamp of the entries deleted after the watermark (or changed so they no longer meet the query), oldest first (none when since is None)
+    - "watermark": the watermark for the next call (None until the last page, when paging)
+    - "continuation": when paging, the continuation to pass in to get the next page (None after the last page)
+
+    Raises ValueError if the query or the watermark is not valid
+    '''
+
+    node = change_query(query_str)
+    if(since is not None):
+        since = normalize_watermark(since)
+    state = changes_state(continuation, since)
+    deleted_filter = since_filter(None, since, state["until"])
+    if(since is None):
+        # Without a watermark everything is new, so the database can do the filtering
+        changed_filter = since_filter(query_str, None, state["until"])
+        node = None
+    else:
+        changed_filter = deleted_filter
+    select = change_fields(fields, node)
+    tombstone_client = tombstone_table(table) if since is not None else None
+
+    if(page_size is None and continuation is None):
+        changed = list(table.query_entities(query_filter=changed_filter, select=select))
+        deleted = []
+        if(tombstone_client is not None):
+            deleted = list(tombstone_client.query_entities(query_filter=deleted_filter))
+        return changes_page(change_set(changed, deleted, since, node, fields), state, True)
+
+    if(state["source"] == "changed"):
+        pages = table.query_entities(query_filter=changed_filter, select=select, results_per_page=page_size or DEFAULT_PAGE_SIZE).by_page(continuation_token=state["token"])
+        result = change_set(next(pages, []), [], state["watermark"], node, fields)
+        state["token"] = pages.continuation_token
+        done = state["token"] is None and tombstone_client is None
+        if(state["token"] is None and tombstone_client is not None):
+            # The changed entries are done, the tombstones are next
+            state["source"] = "deleted"
+    elif(tombstone_client is not None):
+        pages = tombstone_client.query_entities(query_filter=deleted_filter, results_per_page=page_size or DEFAULT_PAGE_SIZE).by_page(continuation_token=state["token"])
+        result = change_set([], next(pages, []), state["watermark"])
+        state["token"] = pages.continuation_token
+        done = state["token"] is None
+    else:
+        result = change_set([], [], state["watermark"])
+        done = True
+    return changes_page(result, state, done)
 
 
 # For internal use
@@ -233,19 +1416,69 @@ def help():
         - publish <connection string> <path to text file>
             publish an entry to the database by specifying key-value pairs with a unique "id" key in a text file
 
+        - publish-batch <connection string> <path> ...
+            publish many entries at once, where each path is a text file, a directory of text files, or a zip/tar archive of text files
+            a text file can hold many entries, separated by blank lines or lines with only ---
+            entries in the same partition are sent together in transactions of up to 100 entries
+
+        - import <connection string> <path> ... [OPTIONS]
+            import many entries in parallel, where each path is a file, a directory (read recursively) or a glob pattern (ie "data/**/*.jsonl")
+            files ending in .jsonl/.ndjson hold one JSON object per line, .csv files hold one entry per row, anything else is key-value pair text
+            progress is saved in a checkpoint file, so if the import fails, running the same command again continues where it stopped
+            OPTIONS:
+                --writers <number> how many transactions to send at the same time (default 4)
+                --parsers <number> how many files to parse at the same time (default 2)
+                --checkpoint <path> where to save the progress (default .import-checkpoint)
+
         - delete <connection string> [OPTIONS]
             delete an entry from the database by specifying a unique "id"
             OPTIONS (one is required):
                 -i <id> delete the entry with specified id
                 -f <path to text file> for more advanced searching, specify the partition key and row key of the entry to be deleted
 
+        - delete-batch <connection string> [OPTIONS]
+            delete many entries from the database at once, in transactions of up to 100 entries in the same partition
+            OPTIONS (one of -q or -i is required):
+                -q <query string> delete every entry which meets the query (see API documentation for formatting)
+                -i <id> ... delete the entries with the specified ids
+                --dry-run only print how many entries would be deleted
+            *ex: delete-batch <connection string> -q "PartitionKey eq 'old_environment'" --dry-run
+
         - query <connection string> [OPTIONS]...
             query the database using a query string and filters the results for only relevant fields
             OPTIONS:
                 -q <query string> if not provided, returns all entries (see API documentation for formatting)
                 -f <fields> ... if not provided, returns all available fields
+                -s print each entry as a JSON line as soon as it arrives, instead of all at once when the query is done
+                --fan-out scan the partitions of the table at the same time instead of one after the other, faster for tables with many partitions
             *ex: query <connection string>
             *ex: query <connection string> -q query_string -f field1 field2 field3)
+            *ex: query <connection string> -s -q query_string
+
+        - export <connection string> <output path> [OPTIONS]
+            stream the database (or part of it) into a file a page at a time, without loading it all into memory
+            the output path can be - to write to standard output (jsonl and csv only)
+            OPTIONS:
+                --format <jsonl|csv|parquet> if not provided, taken from the file extension (default jsonl), parquet requires pyarrow
+                -q <query string> if not provided, exports all entries (see API documentation for formatting)
+                -f <fields> ... if not provided, exports all available fields (for csv and parquet, the columns of the first page)
+                --partitions <partition key> ... scan these partitions at the same time
+                --ranges <start:end> ... scan these PartitionKey ranges at the same time (start included, end not, either can be empty)
+                --workers <number> how many partitions or ranges to scan at the same time (default 4)
+            *ex: export <connection string> backup.jsonl
+            *ex: export <connection string> deployments.csv -q "PartitionKey eq 'prod'" -f RowKey version
+            *ex: export <connection string> all.parquet --ranges :m m:
+
+        - sync <connection string> <mirror path> [OPTIONS]
+            keep a local copy of the database up to date: the first sync copies every entry, later ones only copy what changed or was deleted since
+            the mirror is a JSON lines file (its watermark is kept in <mirror path>.sync) or a SQLite database
+            OPTIONS:
+                --format <jsonl|sqlite> if not provided, sqlite for .db/.sqlite/.sqlite3 files and jsonl otherwise
+                -q <query string> only mirror the entries which meet the query (see API documentation for formatting)
+                -f <fields> ... only mirror these fields (PartitionKey and RowKey are always kept)
+                --full copy every entry again instead of only the changes
+            *ex: sync <connection string> mirror.jsonl
+            *ex: sync <connection string> mirror.db -q "PartitionKey eq 'prod'"
 
         - get <connection string> [OPTIONS]
             returns a specific entry within the database by specifying a unique "id"
@@ -258,15 +1491,38 @@ def help():
 
 def cli_publish(connection_string:str, text_path:str):
     entry = parse_file(text_path)
-    database = connect_to_db(connection_string)
-    table = connect_to_table(database, DEFAULT_TABLE_NAME)
+    table = get_table(connection_string, DEFAULT_TABLE_NAME)
     upsert_entry(table, entry)
     print("Successfully published entry with PartitionKey '{}' and RowKey '{}' to database".format(entry["PartitionKey"], entry["RowKey"]))
 
 
+def cli_publish_batch(connection_string:str, paths:List[str]):
+    def entries():
+        for path in paths:
+            if(os.path.isdir(path)):
+                for name in sorted(os.listdir(path)):
+                    if(not name.startswith(".") and os.path.isfile(os.path.join(path, name))):
+                        yield from parse_entries(os.path.join(path, name))
+                continue
+            # Entries are parsed lazily and sent as soon as a batch is full, so large files are not loaded all at once
+            with open(path, "rb") as file:
+                if(is_archive(file)):
+                    yield from parse_archive(file)
+                else:
+                    yield from parse_entries(file)
+
+    table = get_table(connection_string, DEFAULT_TABLE_NAME)
+    results = upsert_entries(table, entries())
+    failed = [result for result in results if not result["success"]]
+    for result in failed:
+        print("Failed to publish entry with PartitionKey '{}' and RowKey '{}': {}".format(result["PartitionKey"], result["RowKey"], result["error"]))
+    print("Successfully published {} of {} entries to database".format(len(results) - len(failed), len(results)))
+    if(len(failed) > 0):
+        raise Exception("Failed to publish {} entries".format(len(failed)))
+
+
 def cli_delete(connection_string:str, text_path:Optional[str]=None, id:Optional[str]=None):
-    database = connect_to_db(connection_string)
-    table = connect_to_table(database, DEFAULT_TABLE_NAME)
+    table = get_table(connection_string, DEFAULT_TABLE_NAME)
     if(text_path is not None):
         keys = parse_file(text_path)
         delete_entry(table, keys["RowKey"], keys["PartitionKey"])
@@ -276,18 +1532,39 @@ def cli_delete(connection_string:str, text_path:Optional[str]=None, id:Optional[
         print("Successfully deleted entry with PartitionKey '{}' and RowKey '{}'".format(DEFAULT_PARTITION_KEY, id))
 
 
-def cli_query(connection_string:str, query_str:Optional[str]=None, fields:Optional[List[str]]=None):
-    database = connect_to_db(connection_string)
-    table = connect_to_table(database, DEFAULT_TABLE_NAME)
+def cli_delete_batch(connection_string:str, query_str:Optional[str]=None, ids:Optional[List[str]]=None, dry_run:bool=False):
+    table = get_table(connection_string, DEFAULT_TABLE_NAME)
+    keys = None
+    if(ids is not None):
+        keys = [{"PartitionKey" : DEFAULT_PARTITION_KEY, "RowKey" : id} for id in ids]
+    summary = delete_entries(table, keys=keys, query=query_str, dry_run=dry_run)
+    if(dry_run):
+        print("{} entries would be deleted".format(summary["matched"]))
+        return
+    for result in summary["failed"]:
+        print("Failed to delete entry with PartitionKey '{}' and RowKey '{}': {}".format(result["PartitionKey"], result["RowKey"], result["error"]))
+    print("Successfully deleted {} of {} entries".format(summary["deleted"], summary["matched"]))
+    if(len(summary["failed"]) > 0):
+        raise Exception("Failed to delete {} entries".format(len(summary["failed"])))
+
+
+def cli_query(connection_string:str, query_str:Optional[str]=None, fields:Optional[List[str]]=None, stream:bool=False, fan_out:bool=False):
+    table = get_table(connection_string, DEFAULT_TABLE_NAME)
     if(fields is not None):
         if(len(fields) == 0):
             fields = None
+    if(fan_out):
+        # Ordered, so the output is the same as without fanning out
+        results = fanout_query(table, query_str, fields, ordered=True)
+        return results if stream else list(results)
+    if(stream):
+        # Results are fetched lazily a page at a time
+        return query(table, query_str, fields)
     return list(query(table, query_str, fields))
 
 
 def cli_get(connection_string:str, text_path:Optional[str]=None, id:Optional[str]=None):
-    database = connect_to_db(connection_string)
-    table = connect_to_table(database, DEFAULT_TABLE_NAME)
+    table = get_table(connection_string, DEFAULT_TABLE_NAME)
     if(text_path is not None):
         keys = parse_file(text_path)
         return get_entry(table, keys["RowKey"], keys["PartitionKey"])
@@ -322,6 +1599,148 @@ def run():
     
         cli_publish(connection_string, text_path)
 
+    elif(command == "publish-batch"):
+        try:
+            connection_string = sys.argv[2]
+            paths = sys.argv[3:]
+            if(len(paths) == 0):
+                raise Exception("At least one path is required")
+        except:
+            print("Invalid format")
+            print("Use case for publish-batch: python table_api.py publish-batch <connection string> <path> ...")
+            print("See 'python table_api.py help' for more help documentation")
+            sys.tracebacklimit = 0
+            raise
+
+        cli_publish_batch(connection_string, paths)
+
+    elif(command == "import"):
+        # Imported here, since bulk_import imports this module
+        import bulk_import
+        writers = bulk_import.DEFAULT_WRITERS
+        parsers = bulk_import.DEFAULT_PARSERS
+        checkpoint_path = bulk_import.DEFAULT_CHECKPOINT_PATH
+        try:
+            connection_string = sys.argv[2]
+            paths = []
+            i = 3
+            while(i < len(sys.argv)):
+                if(sys.argv[i] == "--writers"):
+                    writers = int(sys.argv[i + 1])
+                    i += 2
+                elif(sys.argv[i] == "--parsers"):
+                    parsers = int(sys.argv[i + 1])
+                    i += 2
+                elif(sys.argv[i] == "--checkpoint"):
+                    checkpoint_path = sys.argv[i + 1]
+                    i += 2
+                else:
+                    paths.append(sys.argv[i])
+                    i += 1
+            if(len(paths) == 0):
+                raise Exception("At least one path is required")
+        except:
+            print("Invalid format")
+            print("Use case for import: python table_api.py import <connection string> <path> ... [OPTIONS]")
+            print("See 'python table_api.py help' for more help documentation")
+            sys.tracebacklimit = 0
+            raise
+
+        bulk_import.cli_import(connection_string, paths, writers, parsers, checkpoint_path)
+
+    elif(command == "export"):
+        # Imported here, since bulk_export imports this module
+        import bulk_export
+        export_format = None
+        query_str = None
+        fields = None
+        partitions = None
+        ranges = None
+        workers = bulk_export.DEFAULT_WORKERS
+        try:
+            connection_string = sys.argv[2]
+            output_path = sys.argv[3]
+            options = ("--format", "-q", "-f", "--partitions", "--ranges", "--workers")
+            i = 4
+            while(i < len(sys.argv)):
+                option = sys.argv[i]
+                if(option not in options):
+                    raise Exception(f"Unknown option {option}")
+                # Options can take many values, so read until the next option
+                values = []
+                i += 1
+                while(i < len(sys.argv) and sys.argv[i] not in options):
+                    values.append(sys.argv[i])
+                    i += 1
+                if(len(values) == 0 or (option in ("--format", "-q", "--workers") and len(values) != 1)):
+                    raise Exception(f"{option} requires an argument")
+                if(option == "--format"):
+                    export_format = values[0]
+                elif(option == "-q"):
+                    query_str = values[0]
+                elif(option == "-f"):
+                    fields = values
+                elif(option == "--partitions"):
+                    partitions = values
+                elif(option == "--ranges"):
+                    ranges = []
+                    for value in values:
+                        if(":" not in value):
+                            raise Exception(f"Range '{value}' should look like start:end")
+                        start, end = value.split(":", 1)
+                        ranges.append((start, end))
+                elif(option == "--workers"):
+                    workers = int(values[0])
+        except:
+            print("Invalid format")
+            print("Use case for export: python table_api.py export <connection string> <output path> [OPTIONS]")
+            print("See 'python table_api.py help' for more help documentation")
+            sys.tracebacklimit = 0
+            raise
+
+        bulk_export.cli_export(connection_string, output_path, export_format, query_str, fields, partitions, ranges, workers)
+
+    elif(command == "sync"):
+        # Imported here, since table_sync imports this module
+        import table_sync
+        mirror_format = None
+        query_str = None
+        fields = None
+        full = "--full" in sys.argv
+        if(full):
+            sys.argv.remove("--full")
+        try:
+            connection_string = sys.argv[2]
+            mirror_path = sys.argv[3]
+            options = ("--format", "-q", "-f")
+            i = 4
+            while(i < len(sys.argv)):
+                option = sys.argv[i]
+                if(option not in options):
+                    raise Exception(f"Unknown option {option}")
+                # -f can take many values, so read until the next option
+                values = []
+                i += 1
+                while(i < len(sys.argv) and sys.argv[i] not in options):
+                    values.append(sys.argv[i])
+                    i += 1
+                if(len(values) == 0 or (option in ("--format", "-q") and len(values) != 1)):
+                    raise Exception(f"{option} requires an argument")
+                if(option == "--format"):
+                    mirror_format = values[0]
+                elif(option == "-q"):
+                    query_str = values[0]
+                elif(option == "-f"):
+                    fields = values
+        except:
+            print("Invalid format")
+            print("Use case for sync: python table_api.py sync <connection string> <mirror path> [OPTIONS]")
+            print("See 'python table_api.py help' for more help documentation")
+            sys.tracebacklimit = 0
+            raise
+
+        table_sync.cli_sync(connection_string, mirror_path, mirror_format, query_str, fields, full)
+
     elif(command == "delete"):
         try:
             connection_string = sys.argv[2]
@@ -341,7 +1760,38 @@ def run():
         elif(mode == "-i"):
             cli_delete(connection_string, id=value)
     
+    elif(command == "delete-batch"):
+        dry_run = "--dry-run" in sys.argv
+        if(dry_run):
+            sys.argv.remove("--dry-run")
+        try:
+            connection_string = sys.argv[2]
+            mode = sys.argv[3]
+            if(mode != "-q" and mode != "-i"):
+                raise Exception("No option specifying method of input was given")
+            values = sys.argv[4:]
+            if(len(values) == 0 or (mode == "-q" and len(values) != 1)):
+                raise Exception(f"{mode} requires an argument")
+        except:
+            print("Invalid format")
+            print("Use case for delete-batch: python table_api.py delete-batch <connection string> [OPTIONS]")
+            print("See 'python table_api.py help' for more help documentation")
+            sys.tracebacklimit = 0
+            raise
+
+        if(mode == "-q"):
+            cli_delete_batch(connection_string, query_str=values[0], dry_run=dry_run)
+        elif(mode == "-i"):
+            cli_delete_batch(connection_string, ids=values, dry_run=dry_run)
+
     elif(command == "query"):
+        # The stream option can go anywhere, so take it out before reading the other options
+        stream = "-s" in sys.argv
+        if(stream):
+            sys.argv.remove("-s")
+        fan_out = "--fan-out" in sys.argv
+        if(fan_out):
+            sys.argv.remove("--fan-out")
         try:
             connection_string = sys.argv[2]
             query_str = None
@@ -374,8 +1824,12 @@ def run():
             sys.tracebacklimit = 0
             raise
         
-        results = cli_query(connection_string, query_str, fields)
-        print(json.dumps(results, indent=2))
+        results = cli_query(connection_string, query_str, fields, stream, fan_out)
+        if(stream):
+            for entity in results:
+                print(entity_json.dumps(entity).decode("utf-8"))
+        else:
+            print(entity_json.dumps(results, indent=True).decode("utf-8"))
 
     elif(command == "get"):
         try:
@@ -396,7 +1850,7 @@ def run():
         elif(mode == "-i"):
             results = cli_get(connection_string, id=value)
 
-        print(json.dumps(results, indent=2))
+        print(entity_json.dumps(results, indent=True).decode("utf-8"))
 
     else:
         print(f"'{command}' is not a recognized command, see help:")
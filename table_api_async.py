@@ -0,0 +1,760 @@
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.data.tables import UpdateMode
+from azure.data.tables.aio import TableServiceClient, TableClient
+from collections import OrderedDict
+from typing import Any, AsyncIterable, Dict, Iterable, List, Optional, Tuple
+from table_api import DEFAULT_PARTITION_KEY, DEFAULT_TABLE_NAME, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, CLIENT_CACHE_SIZE, HTTP_POOL_SIZE, MULTI_GET_CONCURRENCY, FANOUT_CONCURRENCY, TABLE_TOMBSTONES, batch_results, cache_read_result, change_fields, change_query, change_set, changes_page, changes_state, discovery_filter, entity_cache, entity_cache_key, entity_etag, etag_matches, fanout_ranges, found_and_missing, group_into_batches, invalidate_entries, normalize_watermark, partition_cache, partition_cache_key, plan_get_entries, plan_query, revalidation_headers, select_fields, since_filter, split_query, tombstone_table_name, tombstones, tombstones_failed, write_conditions
+import aiohttp
+import asyncio
+import metrics
+import odata_filter
+import table_emulator
+import threading
+
+# The async counterpart of table_api, built on the aio Azure SDK so database calls do not block the event loop
+# Clients (and the aiohttp session they share) belong to the event loop they were created on,
+# so this is meant to be used from a single long-running loop (ie the FastAPI app)
+# The CLI and the Flask app should keep using table_api
+
+
+
+# How many transactions are sent at the same time by the batch operations
+BATCH_CONCURRENCY = 4
+
+_pool_lock = threading.Lock()
+_service_clients:"OrderedDict[str, TableServiceClient]" = OrderedDict()
+# The pooled service clients by URL, so the tombstone table of a TableClient can be found
+_services_by_url:"OrderedDict[str, TableServiceClient]" = OrderedDict()
+_table_clients:"OrderedDict[Tuple[str, str], TableClient]" = OrderedDict()
+# Tables that are known to exist, so create_table_if_not_exists is only called once per table
+_known_tables:"OrderedDict[Tuple[str, str], bool]" = OrderedDict()
+_shared_transport:Optional[AioHttpTransport] = None
+
+
+def _lru_put(cache:OrderedDict, key, value):
+    # Must be called while holding _pool_lock
+    cache[key] = value
+    cache.move_to_end(key)
+    while(len(cache) > CLIENT_CACHE_SIZE):
+        # Evicted clients are not closed, since another request may still be using them
+        # They share the same transport, so nothing is leaked once they are garbage collected
+        cache.popitem(last=False)
+
+
+def _get_transport():
+    '''
+    Get the aiohttp transport shared by every pooled client, so keep-alive connections are reused between requests
+    Must be called from within the running event loop
+    '''
+
+    global _shared_transport
+    with _pool_lock:
+        if(_shared_transport is None):
+            # Same session settings as the Azure SDK uses when it makes its own session
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                auto_decompress=False,
+                trust_env=True
+            )
+            # Not owning the session means closing one client will not close the connections for all the others
+            _shared_transport = AioHttpTransport(session=session, session_owner=False)
+        return _shared_transport
+
+
+def connect_to_db(conn_str:str):
+    '''
+    Get an async TableServiceClient to do operations on a Cosmos Table API database
+    Clients are pooled, so calling this again with the same connection string returns the same client
+
+    Parameters:
+    - conn_str: the connection string to access a Cosmos Table API database (or the emulator, see table_emulator)
+
+    Return:
+    an async TableServiceClient which points to the database specified in the connection string
+    '''
+
+    with _pool_lock:
+        db = _service_clients.get(conn_str)
+        if(db is not None):
+            _service_clients.move_to_end(conn_str)
+            return db
+
+    emulator_conn_str = table_emulator.emulator_connection_string(conn_str)
+    if(emulator_conn_str is not None):
+        # A local backend for testing and benchmarking (see table_emulator)
+        db = table_emulator.AsyncTableServiceClient.from_connection_string(emulator_conn_str)
+    else:
+        db = TableServiceClient.from_connection_string(conn_str, transport=_get_transport(), **metrics.azure_hooks("table"))
+    with _pool_lock:
+        # Another request may have made one at the same time, keep the first one
+        db = _service_clients.get(conn_str, db)
+        _lru_put(_service_clients, conn_str, db)
+        _lru_put(_services_by_url, db.url, db)
+    return db
+
+
+async def connect_to_table(db:TableServiceClient, table_name:str):
+    '''
+    Get an async TableClient to do operations on a Cosmos Table API table
+    The table is created if it does not exist yet, but this is only checked the first time a table is used
+
+    Parameters:
+    - db (required): an async TableClientService which points to the database in which the table is located
+    - table_name (required): the name of the table to access
+
+    Return:
+    an async TableClient which points to the table specified by table_name
+    '''
+
+    key = (db.url, table_name)
+    with _pool_lock:
+        if(key in _known_tables):
+            _known_tables.move_to_end(key)
+            return db.get_table_client(table_name)
+
+    with metrics.stage("table.create_table_if_not_exists"):
+        table = await db.create_table_if_not_exists(table_name)
+    with _pool_lock:
+        _lru_put(_known_tables, key, True)
+    return table
+
+
+async def get_table(conn_str:str, table_name:str = DEFAULT_TABLE_NAME):
+    '''
+    Get a pooled async TableClient for a table, reusing the same client (and its connections) between calls
+
+    Parameters:
+    - conn_str (required): the connection string to access a Cosmos Table API database
+    - table_name: the name of the table to access
+
+    Return:
+    an async TableClient which points to the table specified by table_name
+    '''
+
+    key = (conn_str, table_name)
+    with _pool_lock:
+        table = _table_clients.get(key)
+        if(table is not None):
+            _table_clients.move_to_end(key)
+            return table
+
+    table = await connect_to_table(connect_to_db(conn_str), table_name)
+    with _pool_lock:
+        table = _table_clients.get(key, table)
+        _lru_put(_table_clients, key, table)
+    return table
+
+
+async def close_client_pool():
+    '''
+    Forget every pooled client and close the shared connections (ie when the app shuts down)
+
+    Return: None
+    '''
+
+    global _shared_transport
+    with _pool_lock:
+        _table_clients.clear()
+        _service_clients.clear()
+        _services_by_url.clear()
+        _known_tables.clear()
+        transport = _shared_transport
+        _shared_transport = None
+    if(transport is not None and transport.session is not None):
+        await transport.session.close()
+
+
+@metrics.timed("table.upsert_entry")
+async def upsert_entry(table:TableClient, entry:Dict[str, Any], etag:Optional[str] = None):
+    '''
+    Upload an entry to the database
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - entry (required): a dictionary with string keys. Nested objects not supported
+    - etag: only update the entry if it still has this ETag (see table_api.write_conditions), raises ResourceModifiedError if it changed and ResourceNotFoundError if it does not exist
+
+    Return:
+    the metadata of the new version of the entry (ie its "etag")
+    '''
+
+    try:
+        if(etag is None):
+            return await table.upsert_entity(entry)
+        return await table.update_entity(entry, mode=UpdateMode.MERGE, **write_conditions(etag))
+    finally:
+        invalidate_entries(table, [entry])
+
+
+async def upsert_entries(table:TableClient, entries:Iterable[Dict[str, Any]]):
+    '''
+    Upload many entries to the database, using one transaction per batch of up to table_api.MAX_BATCH_SIZE entries in the same partition
+    Up to BATCH_CONCURRENCY transactions are sent at the same time
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - entries (required): an iterable of dictionaries with string keys. Nested objects not supported
+
+    Return:
+    a list with a result for each entry (see table_api.batch_results)
+    '''
+
+    async def batches():
+        for batch in group_into_batches(entries):
+            yield batch
+    return await upsert_batches(table, batches())
+
+
+@metrics.timed("table.upsert_entries")
+async def upsert_batches(table:TableClient, batches:AsyncIterable[List[Dict[str, Any]]], results:Optional[List[Dict[str, Any]]] = None):
+    '''
+    Upload batches of entries to the database, one transaction per batch (see upsert_entries)
+    Batches of different partitions are sent at the same time, but the batches of a partition are sent one after another,
+    so an entry which is in more than one batch ends up as it was in the last one
+    The batches can be produced elsewhere, ie parsed and grouped in a worker thread with iterate_in_threadpool(table_api.group_into_batches(entries))
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - batches (required): an async iterable of lists of entries, each list with up to table_api.MAX_BATCH_SIZE entries in the same partition
+    - results: a list to add the result of each entry to as its batch finishes,
+      so the results of the batches which were sent are still there if reading the batches fails part-way
+
+    Return:
+    a list with a result for each entry (see table_api.batch_results)
+    '''
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    if(results is None):
+        results = []
+    tasks = set()
+    # The last batch sent for each partition, which the next batch of that partition waits for
+    last_batches:Dict[str, asyncio.Future] = {}
+
+    async def send(batch, previous):
+        try:
+            if(previous is not None):
+                await asyncio.wait([previous])
+            try:
+                await table.submit_transaction([("upsert", entry) for entry in batch])
+                results.extend(batch_results(batch))
+            except HttpResponseError as e:
+                results.extend(batch_results(batch, e))
+            except TypeError:
+                # A value the SDK can't send (ie a nested object), found before anything was sent
+                # The error does not say which entry it was, so the entries are sent one at a time and only the bad ones fail
+                for entry in batch:
+                    try:
+                        await table.upsert_entity(entry)
+                        results.extend(batch_results([entry]))
+                    except (HttpResponseError, TypeError) as e:
+                        results.extend(batch_results([entry], e))
+        finally:
+            invalidate_entries(table, batch)
+            semaphore.release()
+
+    def forget(partition_key, task):
+        if(last_batches.get(partition_key) is task):
+            del last_batches[partition_key]
+
+    try:
+        async for batch in batches:
+            # Wait for a free slot before reading more entries, so entries are not piled up in memory
+            await semaphore.acquire()
+            partition_key = batch[0]["PartitionKey"]
+            task = asyncio.ensure_future(send(batch, last_batches.get(partition_key)))
+            last_batches[partition_key] = task
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda task, partition_key=partition_key: forget(partition_key, task))
+    finally:
+        # Let the batches that were already sent finish, even if reading the entries failed
+        if(len(tasks) > 0):
+            await asyncio.gather(*tasks)
+    return results
+
+
+@metrics.timed("table.delete_entries")
+async def delete_entries(table:TableClient, keys:Optional[Iterable[Dict[str, str]]]=None, query:Optional[str]=None, dry_run:bool=False):
+    '''
+    Delete many entries from the database (see table_api.delete_entries)
+    Keys are streamed from the query, and up to BATCH_CONCURRENCY transactions are sent at the same time
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - keys: an iterable of dictionaries with the PartitionKey and RowKey of each entry to delete
+    - query: instead of keys, delete every entry which meets this query
+    - dry_run: only count the entries which would be deleted, without deleting them
+
+    Return:
+    a dictionary with how many entries matched, how many were deleted, and the results of any that failed
+    '''
+
+    if((keys is None) == (query is None)):
+        raise ValueError("Exactly one of keys or query must be given")
+
+    summary = {"matched" : 0, "deleted" : 0, "failed" : []}
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    tasks = set()
+
+    async def send(batch):
+        try:
+            deleted = batch
+            try:
+                await table.submit_transaction([("delete", key) for key in batch])
+            except HttpResponseError:
+                # The whole transaction fails if any entry in it is already gone, so retry them one at a time
+                # (deleting an entry that does not exist on its own is not an error)
+                deleted = []
+                for key in batch:
+                    try:
+                        await table.delete_entity(partition_key=key["PartitionKey"], row_key=key["RowKey"])
+                        deleted.append(key)
+                    except HttpResponseError as e:
+                        summary["failed"].extend(batch_results([key], e))
+            finally:
+                # Only once the entries are gone, see table_api.delete_entries
+                invalidate_entries(table, batch)
+            summary["deleted"] += len(deleted)
+            await write_tombstones(table, deleted)
+        finally:
+            semaphore.release()
+
+    async def handle(batch):
+        summary["matched"] += len(batch)
+        if(dry_run):
+            return
+        # Wait for a free slot before reading more keys, so keys are not piled up in memory
+        await semaphore.acquire()
+        task = asyncio.ensure_future(send(batch))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if(keys is not None):
+        for batch in group_into_batches(keys):
+            await handle(batch)
+    else:
+        # group_into_batches needs a regular iterator, so gather the keys a page at a time
+        async for page in table.query_entities(query_filter=query, select=["PartitionKey", "RowKey"]).by_page():
+            page_keys = [{"PartitionKey" : entity["PartitionKey"], "RowKey" : entity["RowKey"]} async for entity in page]
+            for batch in group_into_batches(page_keys):
+                await handle(batch)
+    if(len(tasks) > 0):
+        await asyncio.gather(*tasks)
+    return summary
+
+
+@metrics.timed("table.delete_entry")
+async def delete_entry(table:TableClient, id:str, partition_key:Optional[str] = None, etag:Optional[str] = None):
+    '''
+    Delete an entry from the database
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - id (required): the id of the entry to get
+    - partition_key: the partition the entry is in
+    - etag: only delete the entry if it still has this ETag (see table_api.write_conditions), raises ResourceModifiedError if it changed
+
+    Return: None
+    '''
+
+    if(partition_key is None):
+        partition_key = DEFAULT_PARTITION_KEY
+    key = {"PartitionKey" : partition_key, "RowKey" : id}
+    try:
+        await table.delete_entity(partition_key=partition_key, row_key=id, **write_conditions(etag))
+    finally:
+        invalidate_entries(table, [key])
+    # Only once the entry is gone, see table_api.delete_entry
+    await write_tombstones(table, [key])
+
+
+@metrics.timed("table.get_entry")
+async def get_entry(table:TableClient, id:str, partition_key:Optional[str] = None):
+    '''
+    Get a specific entry from the database
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - id (required): the id of the entry to get
+    - partition_key: the partition the entry is in
+
+    Return:
+    a dictionary representation of the entry, or None if it does not exist
+    '''
+
+    if(partition_key is None):
+        partition_key = DEFAULT_PARTITION_KEY
+    if(not entity_cache.enabled):
+        try:
+            return await table.get_entity(partition_key=partition_key, row_key=id)
+        except ResourceNotFoundError:
+            return None
+
+    # Shares table_api.entity_cache, see table_api.get_entry
+    key = entity_cache_key(table, partition_key, id)
+    generation = entity_cache.generation(key)
+    found, entry, fresh = entity_cache.peek(key)
+    if(found and fresh):
+        return entry
+    try:
+        return cache_read_result(key, entry, await table.get_entity(partition_key=partition_key, row_key=id, headers=revalidation_headers(entry)), generation=generation)
+    except HttpResponseError as e:
+        if(e.status_code != 304 and not isinstance(e, ResourceNotFoundError)):
+            raise
+        return cache_read_result(key, entry, error=e, generation=generation)
+
+
+@metrics.timed("table.get_entry")
+async def get_entry_if_changed(table:TableClient, id:str, partition_key:Optional[str] = None, etag:Optional[str] = None):
+    '''
+    Get a specific entry from the database, unless it still has one of the ETags a client already has (like an HTTP If-None-Match header)
+    When the entity cache is on it answers from its copy, otherwise the database is asked to leave the entry out of its response if it did not change,
+    and the ETag of any entry it does send is compared locally
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - id (required): the id of the entry to get
+    - partition_key: the partition the entry is in
+    - etag: the value of the If-None-Match header (one or more ETags separated by commas, or "*")
+
+    Return:
+    a tuple (entry, changed): changed is False when the entry still has one of the ETags (entry is then None if the database did not send it),
+    otherwise entry is the entry, or None if it does not exist
+    '''
+
+    if(partition_key is None):
+        partition_key = DEFAULT_PARTITION_KEY
+    if(etag is None or entity_cache.enabled or "," in etag or etag.strip() == "*"):
+        # The undecorated get_entry, since this call is already timed as the same stage
+        entry = await get_entry.__wrapped__(table, id, partition_key)
+        return entry, not etag_matches(etag, entity_etag(entry))
+    try:
+        # The service may ignore If-None-Match and send the entry anyway, so the ETag is always compared here too
+        entry = await table.get_entity(partition_key=partition_key, row_key=id, headers={"If-None-Match" : etag.strip()})
+        return entry, not etag_matches(etag, entity_etag(entry))
+    except HttpResponseError as e:
+        if(e.status_code == 304):
+            return None, False
+        if(isinstance(e, ResourceNotFoundError)):
+            return None, True
+        raise
+
+
+@metrics.timed("table.get_entries")
+async def get_entries(table:TableClient, keys:Iterable[Dict[str, str]], max_concurrency:int = MULTI_GET_CONCURRENCY):
+    '''
+    Get many specific entries from the database at once, reading up to max_concurrency at the same time (see table_api.get_entries)
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - keys (required): an iterable of dictionaries with the PartitionKey and RowKey of each entry to get
+    - max_concurrency: the maximum number of reads to do at the same time
+
+    Return:
+    a tuple (found, missing) with a list of the entries that were found, and a list of the keys that were not found
+    '''
+
+    unique_keys, reads = plan_get_entries(keys)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def read(plan):
+        async with semaphore:
+            if(plan[0] == "get"):
+                entry = await get_entry(table, plan[2], plan[1])
+                return [] if entry is None else [entry]
+            return [entity async for entity in table.query_entities(query_filter=plan[1], parameters=plan[2])]
+
+    entries = [entry for results in await asyncio.gather(*[read(plan) for plan in reads]) for entry in results]
+    return found_and_missing(unique_keys, entries)
+
+
+def query(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]]=None):
+    '''
+    Query the database (see table_api.query for how to format a query string, and how point read queries are answered)
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - query: a string to specify the query. None returns all entries in the table
+    - fields: a list of which fields should be returned. None returns all fields
+
+    Return:
+    an async iterable containing dictionary representations of the entries which meet the query requirements
+
+    Raises ValueError if the query is not valid
+    '''
+
+    plan = plan_query(query)
+    if(plan.kind == odata_filter.POINT_READ):
+        return point_read(table, plan.keys, fields)
+    return table.query_entities(query_filter=plan.filter, select=fields)
+
+
+async def point_read(table:TableClient, keys:List[Tuple[str, str]], fields:Optional[List[str]]=None):
+    '''
+    Read entries by key, for queries that only look up entries by PartitionKey and RowKey (see table_api.point_read)
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - keys (required): the (PartitionKey, RowKey) of each entry to read
+    - fields: a list of which fields should be returned. None returns all fields
+
+    Return:
+    an async iterator containing dictionary representations of the entries which were found
+    '''
+
+    if(len(keys) == 1):
+        entry = await get_entry(table, keys[0][1], keys[0][0])
+        found = [] if entry is None else [entry]
+    else:
+        found, _ = await get_entries(table, [{"PartitionKey" : partition_key, "RowKey" : row_key} for partition_key, row_key in keys])
+    for entry in found:
+        yield select_fields(entry, fields)
+
+
+@metrics.timed("table.query_page")
+async def query_page(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]]=None, page_size:int=DEFAULT_PAGE_SIZE, continuation:Optional[Dict[str, str]]=None):
+    '''
+    Query one page of the database (see table_api.query_page)
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - query: a string to specify the query. None returns all entries in the table
+    - fields: a list of which fields should be returned. None returns all fields
+    - page_size: the maximum number of entries to return (at most table_api.MAX_PAGE_SIZE)
+    - continuation: the continuation token returned with the previous page. None starts from the beginning
+
+    Return:
+    a tuple (entries, continuation) with a list of the entries in this page, and the continuation token for the next page (None if there are no more pages)
+    '''
+
+    plan = plan_query(query)
+    if(plan.kind == odata_filter.POINT_READ):
+        return [entry async for entry in point_read(table, plan.keys, fields)], None
+    pages = table.query_entities(query_filter=plan.filter, select=fields, results_per_page=page_size).by_page(continuation_token=continuation)
+    try:
+        page = await pages.__anext__()
+    except StopAsyncIteration:
+        return [], None
+    return [entity async for entity in page], pages.continuation_token
+
+
+@metrics.timed("table.discover_partitions")
+async def discover_partitions(table:TableClient, refresh:bool = False):
+    '''
+    Find every PartitionKey in a table, with one small request per partition (see table_api.discover_partitions)
+    The result is cached for table_api.PARTITION_CACHE_TTL_SECONDS, and shared with table_api
+
+    Parameters:
+    - table (required): an async TableClient which points to the table
+    - refresh: whether to ignore the cached partitions and look again
+
+    Return:
+    a sorted list of PartitionKeys
+    '''
+
+    async def load():
+        partitions = []
+        last = None
+        while(True):
+            query_filter, parameters = discovery_filter(last)
+            entity = None
+            async for entity in table.query_entities(query_filter=query_filter, parameters=parameters, select=["PartitionKey"], results_per_page=1):
+                break
+            else:
+                return partitions
+            last = entity["PartitionKey"]
+            partitions.append(last)
+
+    key = partition_cache_key(table)
+    if(refresh):
+        partition_cache.invalidate(key)
+    return await partition_cache.aget_or_load(key, load)
+
+
+def known_partitions(table:TableClient):
+    '''
+    Get the cached partitions of a table without looking them up
+
+    Parameters:
+    - table (required): an async TableClient which points to the table
+
+    Return:
+    a sorted list of PartitionKeys, or None if they are not cached
+    '''
+
+    return partition_cache.get(partition_cache_key(table))
+
+
+async def fanout_query(table:TableClient, query:Optional[str]=None, fields:Optional[List[str]]=None, partitions:Optional[List[str]]=None, max_concurrency:int=FANOUT_CONCURRENCY, ordered:bool=False, limit:Optional[int]=None):
+    '''
+    Query the database by scanning many partitions at the same time (see table_api.fanout_query)
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - query: a string to specify the query. None returns all entries in the table
+    - fields: a list of which fields should be returned. None returns all fields
+    - partitions: a list of PartitionKeys to scan (only these partitions are read). None discovers the partitions of the table
+    - max_concurrency: the maximum number of partitions to scan at the same time
+    - ordered: whether to return the entries ordered by PartitionKey and RowKey. Otherwise they are returned as soon as they arrive
+    - limit: stop after this many entries. None returns every entry
+
+    Return:
+    an async iterator containing dictionary representations of the entries which meet the query requirements
+    '''
+
+    query = plan_query(query).filter
+    if(partitions is None):
+        scans = split_query(query, ranges=fanout_ranges(await discover_partitions(table)))
+    else:
+        scans = split_query(query, partitions=sorted(set(partitions)))
+    page_size = MAX_PAGE_SIZE if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+    # Bounded queues, so scans wait for the caller instead of reading everything into memory (see table_api.fanout_query)
+    if(ordered):
+        queues = [asyncio.Queue(maxsize=2) for _ in scans]
+    else:
+        queues = [asyncio.Queue(maxsize=max(1, max_concurrency) * 2)] * len(scans)
+    next_scan = iter(range(len(scans)))
+
+    async def scan():
+        # Each worker takes the next scan in order, so when ordered, the scans being read next are always the ones running
+        for index in next_scan:
+            scan_filter, parameters = scans[index]
+            try:
+                async for page in table.query_entities(query_filter=scan_filter, select=fields, parameters=parameters, results_per_page=page_size).by_page():
+                    await queues[index].put([entity async for entity in page])
+            except Exception as e:
+                await queues[index].put(e)
+                return
+            await queues[index].put(None)
+
+    async def pages():
+        if(ordered):
+            for index in range(len(scans)):
+                while(True):
+                    page = await queues[index].get()
+                    if(page is None):
+                        break
+                    yield page
+        else:
+            running = len(scans)
+            while(running > 0):
+                page = await queues[0].get()
+                if(page is None):
+                    running -= 1
+                    continue
+                yield page
+
+    workers = [asyncio.create_task(scan()) for _ in range(max(1, min(max_concurrency, len(scans))))]
+    try:
+        count = 0
+        async for page in pages():
+            if(isinstance(page, Exception)):
+                raise page
+            for entity in page:
+                yield entity
+                count += 1
+                if(limit is not None and count >= limit):
+                    return
+    finally:
+        # Also runs when the caller stops early (ie the client disconnected), so the scans that are still going stop too
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def tombstone_table(table:TableClient):
+    '''
+    Get an async TableClient for the tombstone table of a table (see table_api.tombstone_table)
+    '''
+
+    if(not TABLE_TOMBSTONES):
+        return None
+    with _pool_lock:
+        db = _services_by_url.get(table.url)
+    if(db is None):
+        return None
+    return await connect_to_table(db, tombstone_table_name(table.table_name))
+
+
+async def write_tombstones(table:TableClient, keys:Iterable[Dict[str, str]]):
+    '''
+    Leave a tombstone for each deleted entry, so changes can report it (see table_api.write_tombstones)
+    '''
+
+    tombstone_client = await tombstone_table(table)
+    if(tombstone_client is None):
+        return
+    keys = tombstones(keys)
+    try:
+        for batch in group_into_batches(keys):
+            await tombstone_client.submit_transaction([("upsert", tombstone) for tombstone in batch])
+    except AzureError:
+        tombstones_failed(table, len(keys))
+
+
+@metrics.timed("table.changes")
+async def changes(table:TableClient, since:Optional[str] = None, query_str:Optional[str] = None, fields:Optional[List[str]] = None, page_size:Optional[int] = None, continuation:Optional[Dict[str, Any]] = None):
+    '''
+    Get the entries written (or deleted) after a watermark (see table_api.changes)
+
+    Parameters:
+    - table (required): an async TableClient which points to the table to be queried
+    - since: the watermark returned by the last call, None to get every entry
+    - query_str: only return changed entries which meet this query
+    - fields: a list of which fields should be returned. None returns all fields
+    - page_size: get the changes a page at a time, with up to this many changed entries or deleted keys per page
+    - continuation: the continuation returned with the previous page. None starts from the beginning
+
+    Return:
+    a dictionary with the "changed" entries, the "deleted" keys, the next "watermark" and the "continuation" for the next page
+
+    Raises ValueError if the query or the watermark is not valid
+    '''
+
+    node = change_query(query_str)
+    if(since is not None):
+        since = normalize_watermark(since)
+    state = changes_state(continuation, since)
+    deleted_filter = since_filter(None, since, state["until"])
+    if(since is None):
+        changed_filter = since_filter(query_str, None, state["until"])
+        node = None
+    else:
+        changed_filter = deleted_filter
+    select = change_fields(fields, node)
+    tombstone_client = await tombstone_table(table) if since is not None else None
+
+    if(page_size is None and continuation is None):
+        changed = [entity async for entity in table.query_entities(query_filter=changed_filter, select=select)]
+        deleted = []
+        if(tombstone_client is not None):
+            deleted = [tombstone async for tombstone in tombstone_client.query_entities(query_filter=deleted_filter)]
+        return changes_page(change_set(changed, deleted, since, node, fields), state, True)
+
+    if(state["source"] == "changed"):
+        pages = table.query_entities(query_filter=changed_filter, select=select, results_per_page=page_size or DEFAULT_PAGE_SIZE).by_page(continuation_token=state["token"])
+        result = change_set(await _next_page(pages), [], state["watermark"], node, fields)
+        state["token"] = pages.continuation_token
+        done = state["token"] is None and tombstone_client is None
+        if(state["token"] is None and tombstone_client is not None):
+            state["source"] = "deleted"
+    elif(tombstone_client is not None):
+        pages = tombstone_client.query_entities(query_filter=deleted_filter, results_per_page=page_size or DEFAULT_PAGE_SIZE).by_page(continuation_token=state["token"])
+        result = change_set([], await _next_page(pages), state["watermark"])
+        state["token"] = pages.continuation_token
+        done = state["token"] is None
+    else:
+        result = change_set([], [], state["watermark"])
+        done = True
+    return changes_page(result, state, done)
+
+
+async def _next_page(pages):
+    # The entities of the next page, or none if there are no more pages
+    try:
+        page = await pages.__anext__()
+    except StopAsyncIteration:
+        return []
+    return [entity async for entity in page]
@@ -0,0 +1,844 @@
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.data.tables import EdmType, EntityProperty, TableEntity, TableTransactionError, UpdateMode
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+from uuid import UUID
+import asyncio
+import base64
+import bisect
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import odata_filter
+
+# A local stand-in for the parts of the Azure table SDK this project uses, for testing and benchmarking without a network or an Azure account
+#
+# Selected with the connection string:
+# - memory://<name> keeps the tables in memory, shared by every client in the process using the same name
+# - sqlite:///<path> keeps the tables in a SQLite file (sqlite://<relative path> works too)
+# Either can end with ?latency_ms=<milliseconds>, which is added to every request so pooling and concurrency behave more like they would over a network
+#
+# Setting TABLE_EMULATOR to one of these connection strings sends every table connection there, whatever connection string is given
+# (so the apps and the CLI can run locally without changing what callers send)
+# Connection strings which point to the emulator themselves are only used when TABLE_EMULATOR_URLS is on,
+# since they would let whoever gives the connection string create SQLite files or in-memory stores (which are never freed) on the machine
+#
+# The same behaviour as the service is kept where the project depends on it: merge/replace upserts, ETags and timestamps,
+# If-Match (412, while If-None-Match on reads is ignored like the service does), pages ordered by PartitionKey and RowKey with continuation tokens,
+# all-or-nothing transactions of up to 100 entities in one partition, and filters (parsed with odata_filter, including on Timestamp)
+
+
+
+SCHEMES = ("memory", "sqlite")
+TABLE_EMULATOR = os.environ.get("TABLE_EMULATOR")
+TABLE_EMULATOR_URLS = os.environ.get("TABLE_EMULATOR_URLS", "false").lower() in ("1", "true", "yes")
+# The default latency (in milliseconds) added to every emulated request, when the connection string does not give one
+TABLE_EMULATOR_LATENCY_MS = float(os.environ.get("TABLE_EMULATOR_LATENCY_MS", "0"))
+
+MAX_PAGE_SIZE = 1000
+MAX_TRANSACTION_SIZE = 100
+
+_stores_lock = threading.Lock()
+_stores:Dict[Tuple[str, str], Any] = {}
+_etag_counter = itertools.count()
+
+
+def is_emulator_url(conn_str:Optional[str]):
+    '''
+    Check if a connection string points to the emulator (memory:// or sqlite://)
+    '''
+
+    return conn_str is not None and urlsplit(conn_str).scheme in SCHEMES
+
+
+def emulator_connection_string(conn_str:Optional[str]):
+    '''
+    Get the emulator connection string to use instead of conn_str
+
+    Parameters:
+    - conn_str: the connection string given by the caller
+
+    Return:
+    an emulator connection string, or None if the connection should go to Azure
+
+    Raises ValueError if conn_str points to the emulator but TABLE_EMULATOR_URLS is off (and TABLE_EMULATOR is not set)
+    '''
+
+    if(is_emulator_url(conn_str) and TABLE_EMULATOR_URLS):
+        return conn_str
+    if(TABLE_EMULATOR is not None):
+        return TABLE_EMULATOR
+    if(is_emulator_url(conn_str)):
+        raise ValueError("Emulator connection strings (memory:// and sqlite://) can only be used when TABLE_EMULATOR_URLS is on")
+    return None
+
+
+def open_store(conn_str:str):
+    '''
+    Get the store behind an emulator connection string, shared by every client using the same name or file
+
+    Parameters:
+    - conn_str (required): an emulator connection string
+
+    Return:
+    a tuple (store, url, latency) with the MemoryStore or SqliteStore, the url of the store without options, and the latency in seconds
+    '''
+
+    parts = urlsplit(conn_str)
+    options = parse_qs(parts.query)
+    latency = float(options.get("latency_ms", [TABLE_EMULATOR_LATENCY_MS])[0]) / 1000
+    location = parts.netloc + parts.path
+    key = (parts.scheme, location)
+    with _stores_lock:
+        store = _stores.get(key)
+        if(store is None):
+            store = MemoryStore() if parts.scheme == "memory" else SqliteStore(location)
+            _stores[key] = store
+    return store, f"{parts.scheme}://{location}", latency
+
+
+def close_stores():
+    '''
+    Drop every in-memory store and close every SQLite file (ie between tests)
+
+    Return: None
+    '''
+
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
+
+# Property values are kept the way the service sends them (an EDM type and a JSON value),
+# so what comes back matches the SDK: 64-bit integers as EntityProperty, datetimes in UTC, GUIDs as UUID and binary as bytes
+def encode_value(value:Any):
+    if(isinstance(value, EntityProperty)):
+        edm_type = EdmType(value.edm_type).value
+        return [edm_type, encode_value(value.value)[1]]
+    if(isinstance(value, bool)):
+        return [EdmType.BOOLEAN.value, value]
+    if(isinstance(value, int)):
+        return [EdmType.INT32.value if value.bit_length() <= 31 else EdmType.INT64.value, value]
+    if(isinstance(value, float)):
+        return [EdmType.DOUBLE.value, value]
+    if(isinstance(value, str)):
+        return [EdmType.STRING.value, value]
+    if(isinstance(value, datetime)):
+        if(value.tzinfo is None):
+            value = value.replace(tzinfo=timezone.utc)
+        return [EdmType.DATETIME.value, value.astimezone(timezone.utc).isoformat()]
+    if(isinstance(value, UUID)):
+        return [EdmType.GUID.value, str(value)]
+    if(isinstance(value, bytes)):
+        return [EdmType.BINARY.value, base64.b64encode(value).decode("ascii")]
+    raise TypeError(f"Type not supported when sending data to the service: {type(value)}")
+
+
+# Looked up once, since reading enum values is slow enough to show up when scanning large tables
+_DECODERS = {
+    EdmType.INT64.value : lambda value: EntityProperty(int(value), EdmType.INT64),
+    EdmType.DATETIME.value : datetime.fromisoformat,
+    EdmType.GUID.value : UUID,
+    EdmType.BINARY.value : base64.b64decode,
+}
+
+
+def decode_value(edm_type:str, value:Any):
+    decoder = _DECODERS.get(edm_type)
+    return value if decoder is None else decoder(value)
+
+
+def encode_entity(entity:Dict[str, Any]):
+    # None values are left out, like the SDK does
+    return {key : encode_value(value) for key, value in entity.items() if value is not None}
+
+
+def decode_entity(properties:Dict[str, list]):
+    return {key : decode_value(edm_type, value) for key, (edm_type, value) in properties.items()}
+
+
+def substitute_parameters(query_filter:str, parameters:Optional[Dict[str, Any]]):
+    '''
+    Fill the parameters into a filter the same way the SDK does (only words starting with @ are replaced)
+    '''
+
+    if(not parameters):
+        return query_filter
+    words = query_filter.split(" ")
+    for index, word in enumerate(words):
+        if(word.startswith("@")):
+            value = parameters[word[1:]]
+            if(isinstance(value, bool)):
+                words[index] = str(value).lower()
+            elif(isinstance(value, int)):
+                words[index] = str(value) if value.bit_length() <= 32 else f"{value}L"
+            elif(isinstance(value, float)):
+                words[index] = str(value)
+            elif(isinstance(value, datetime)):
+                words[index] = "datetime'{}'".format(encode_value(value)[1])
+            elif(isinstance(value, UUID)):
+                words[index] = f"guid'{value}'"
+            elif(isinstance(value, bytes)):
+                words[index] = f"X'{value.hex()}'"
+            else:
+                words[index] = "'{}'".format(str(value).replace("'", "''"))
+    return " ".join(words)
+
+
+def _error(kind:type, status_code:int, message:str, **kwargs):
+    error = kind(message=message, **kwargs)
+    error.status_code = status_code
+    return error
+
+
+def _new_version():
+    # A new ETag and timestamp for every write
+    timestamp = datetime.now(timezone.utc)
+    etag = "W/\"datetime'{}'-{}\"".format(timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), next(_etag_counter))
+    return etag, timestamp.isoformat()
+
+
+class MemoryStore:
+    '''
+    Tables kept in memory, each a dictionary of records plus a sorted list of their keys for paging
+    A record is a tuple (encoded properties, etag, timestamp), and is never changed once stored
+    '''
+
+    def __init__(self):
+        # Held by the clients while they check and then change records, so each operation is atomic
+        self.lock = threading.RLock()
+        self._records:Dict[str, Dict[Tuple[str, str], tuple]] = {}
+        self._keys:Dict[str, List[Tuple[str, str]]] = {}
+
+    def create_table(self, table:str):
+        with self.lock:
+            if(table in self._records):
+                return False
+            self._records[table] = {}
+            self._keys[table] = []
+            return True
+
+    def delete_table(self, table:str):
+        with self.lock:
+            self._keys.pop(table, None)
+            return self._records.pop(table, None) is not None
+
+    def has_table(self, table:str):
+        return table in self._records
+
+    def get(self, table:str, key:Tuple[str, str]):
+        return self._records[table].get(key)
+
+    def write(self, table:str, changes:List[Tuple[Tuple[str, str], Optional[tuple]]]):
+        # Each change is (key, record), where a record of None deletes the key
+        with self.lock:
+            records = self._records[table]
+            keys = self._keys[table]
+            for key, record in changes:
+                if(record is None):
+                    if(records.pop(key, None) is not None):
+                        del keys[bisect.bisect_left(keys, key)]
+                else:
+                    if(key not in records):
+                        bisect.insort(keys, key)
+                    records[key] = record
+
+    def scan(self, table:str, after:Optional[Tuple[str, str]], bounds:Tuple[Optional[str], Optional[str]] = (None, None)):
+        '''
+        The records of a table in key order, starting after a key, and only in the PartitionKeys between bounds (lowest, highest, either can be None)
+        Reads a snapshot a few keys at a time, so writes can happen while a page is being read
+        '''
+
+        lowest, highest = bounds
+        while(True):
+            with self.lock:
+                keys = self._keys[table]
+                start = 0
+                if(lowest is not None):
+                    start = bisect.bisect_left(keys, (lowest, ""))
+                if(after is not None):
+                    start = max(start, bisect.bisect_right(keys, after))
+                records = self._records[table]
+                rows = [(key, records[key]) for key in keys[start:start + MAX_PAGE_SIZE]]
+            for key, record in rows:
+                if(highest is not None and key[0] > highest):
+                    return
+                yield key, record
+            if(len(rows) < MAX_PAGE_SIZE):
+                return
+            after = rows[-1][0]
+
+    def close(self):
+        with self.lock:
+            self._records.clear()
+            self._keys.clear()
+
+
+class SqliteStore:
+    '''
+    Tables kept in a SQLite file, one row per entity with the encoded properties as JSON
+    '''
+
+    def __init__(self, path:str):
+        self.lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            if(path != ":memory:"):
+                self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS emulated_tables (name TEXT PRIMARY KEY)")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS entities (
+                    table_name TEXT NOT NULL,
+                    partition_key TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    etag TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    properties TEXT NOT NULL,
+                    PRIMARY KEY (table_name, partition_key, row_key)
+                ) WITHOUT ROWID
+            """)
+
+    def create_table(self, table:str):
+        with self.lock:
+            return self._connection.execute("INSERT OR IGNORE INTO emulated_tables (name) VALUES (?)", (table,)).rowcount == 1
+
+    def delete_table(self, table:str):
+        with self.lock:
+            self._connection.execute("BEGIN")
+            self._connection.execute("DELETE FROM entities WHERE table_name = ?", (table,))
+            deleted = self._connection.execute("DELETE FROM emulated_tables WHERE name = ?", (table,)).rowcount == 1
+            self._connection.execute("COMMIT")
+            return deleted
+
+    def has_table(self, table:str):
+        with self.lock:
+            return self._connection.execute("SELECT 1 FROM emulated_tables WHERE name = ?", (table,)).fetchone() is not None
+
+    def get(self, table:str, key:Tuple[str, str]):
+        with self.lock:
+            row = self._connection.execute("SELECT properties, etag, timestamp FROM entities WHERE table_name = ? AND partition_key = ? AND row_key = ?", (table, key[0], key[1])).fetchone()
+        if(row is None):
+            return None
+        return (json.loads(row[0]), row[1], row[2])
+
+    def write(self, table:str, changes:List[Tuple[Tuple[str, str], Optional[tuple]]]):
+        with self.lock:
+            self._connection.execute("BEGIN")
+            try:
+                for key, record in changes:
+                    if(record is None):
+                        self._connection.execute("DELETE FROM entities WHERE table_name = ? AND partition_key = ? AND row_key = ?", (table, key[0], key[1]))
+                    else:
+                        self._connection.execute("INSERT OR REPLACE INTO entities (table_name, partition_key, row_key, etag, timestamp, properties) VALUES (?, ?, ?, ?, ?, ?)",
+                            (table, key[0], key[1], record[1], record[2], json.dumps(record[0])))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def scan(self, table:str, after:Optional[Tuple[str, str]], bounds:Tuple[Optional[str], Optional[str]] = (None, None)):
+        lowest, highest = bounds
+        while(True):
+            conditions = ["table_name = ?"]
+            arguments:List[Any] = [table]
+            if(after is not None):
+                conditions.append("(partition_key > ? OR (partition_key = ? AND row_key > ?))")
+                arguments.extend([after[0], after[0], after[1]])
+            if(lowest is not None):
+                conditions.append("partition_key >= ?")
+                arguments.append(lowest)
+            if(highest is not None):
+                conditions.append("partition_key <= ?")
+                arguments.append(highest)
+            with self.lock:
+                rows = self._connection.execute(f"SELECT partition_key, row_key, properties, etag, timestamp FROM entities WHERE {' AND '.join(conditions)} ORDER BY partition_key, row_key LIMIT ?",
+                    arguments + [MAX_PAGE_SIZE]).fetchall()
+            for partition_key, row_key, properties, etag, timestamp in rows:
+                yield (partition_key, row_key), (json.loads(properties), etag, timestamp)
+            if(len(rows) < MAX_PAGE_SIZE):
+                return
+            after = (rows[-1][0], rows[-1][1])
+
+    def close(self):
+        with self.lock:
+            self._connection.close()
+
+
+def _partition_bounds(node):
+    # The lowest and highest PartitionKey a filter can match (None when it is not limited)
+    # gt and lt are treated like ge and le, the filter itself still decides which entities match
+    if(isinstance(node, odata_filter.And)):
+        left, right = _partition_bounds(node.left), _partition_bounds(node.right)
+        lowest = max((bound for bound in (left[0], right[0]) if bound is not None), default=None)
+        highest = min((bound for bound in (left[1], right[1]) if bound is not None), default=None)
+        return lowest, highest
+    if(isinstance(node, odata_filter.Or)):
+        left, right = _partition_bounds(node.left), _partition_bounds(node.right)
+        lowest = None if left[0] is None or right[0] is None else min(left[0], right[0])
+        highest = None if left[1] is None or right[1] is None else max(left[1], right[1])
+        return lowest, highest
+    if(isinstance(node, odata_filter.Comparison) and node.field == "PartitionKey" and isinstance(node.value, str)):
+        if(node.op == "eq"):
+            return node.value, node.value
+        if(node.op in ("gt", "ge")):
+            return node.value, None
+        if(node.op in ("lt", "le")):
+            return None, node.value
+    return None, None
+
+
+def _to_entity(record:tuple, select:Optional[List[str]] = None, values:Optional[Dict[str, Any]] = None):
+    # values are the decoded properties of the record, when they were already decoded
+    properties, etag, timestamp = record
+    if(values is None):
+        values = decode_entity(properties)
+    if(select is not None):
+        # Like the service, selecting Timestamp only makes sure it comes back with the metadata
+        values = {field : values.get(field) for field in select if field != "Timestamp"}
+    entity = TableEntity(values)
+    entity._metadata = {"etag" : etag, "timestamp" : datetime.fromisoformat(timestamp)}
+    return entity
+
+
+def _entity_key(entity:Dict[str, Any]):
+    partition_key = entity.get("PartitionKey")
+    row_key = entity.get("RowKey")
+    if(not isinstance(partition_key, str) or not isinstance(row_key, str)):
+        raise ValueError("PartitionKey and RowKey must be strings")
+    return (partition_key, row_key)
+
+
+def _select_list(select:Optional[Any]):
+    if(isinstance(select, str)):
+        return [field.strip() for field in select.split(",")]
+    return select
+
+
+class EmulatedTable:
+    '''
+    The operations of one emulated table, shared by the sync and async clients (which add the latency)
+    '''
+
+    def __init__(self, store, table_name:str):
+        self.store = store
+        self.table_name = table_name
+
+    def _check_table(self):
+        if(not self.store.has_table(self.table_name)):
+            raise _error(ResourceNotFoundError, 404, f"TableNotFound: the table {self.table_name} does not exist")
+
+    def _check_condition(self, current:Optional[tuple], etag:Optional[str], match_condition:Optional[MatchConditions]):
+        if(match_condition == MatchConditions.IfNotModified and (current is None or current[1] != etag)):
+            raise _error(ResourceModifiedError, 412, "UpdateConditionNotSatisfied: the entity was changed since it was read")
+        if(match_condition == MatchConditions.IfModified and current is not None and current[1] == etag):
+            raise _error(ResourceModifiedError, 412, "UpdateConditionNotSatisfied: the entity was not changed")
+
+    def _merged(self, current:Optional[tuple], entity:Dict[str, Any], mode:Any):
+        properties = encode_entity(entity)
+        if(current is not None and UpdateMode(mode) == UpdateMode.MERGE):
+            properties = {**current[0], **properties}
+        etag, timestamp = _new_version()
+        return (properties, etag, timestamp)
+
+    def _plan_write(self, operation:str, entity:Dict[str, Any], options:Dict[str, Any], current:Optional[tuple]):
+        # Returns the new record (None to delete) for one write, or raises if it is not allowed
+        operation = str(getattr(operation, "value", operation)).lower()
+        etag = options.get("etag")
+        match_condition = options.get("match_condition")
+        if(match_condition is not None and etag is None and isinstance(entity, TableEntity)):
+            etag = entity.metadata.get("etag")
+        if(operation == "upsert"):
+            return self._merged(current, entity, options.get("mode", UpdateMode.MERGE))
+        if(operation == "create"):
+            if(current is not None):
+                raise _error(ResourceExistsError, 409, "EntityAlreadyExists: the entity already exists")
+            return self._merged(None, entity, UpdateMode.REPLACE)
+        if(operation == "update"):
+            if(current is None):
+                raise _error(ResourceNotFoundError, 404, "ResourceNotFound: the entity does not exist")
+            self._check_condition(current, etag, match_condition)
+            return self._merged(current, entity, options.get("mode", UpdateMode.MERGE))
+        if(operation == "delete"):
+            if(current is not None):
+                self._check_condition(current, etag, match_condition)
+            return None
+        raise ValueError(f"Unknown transaction operation: {operation}")
+
+    def write(self, operation:str, entity:Dict[str, Any], **options):
+        self._check_table()
+        key = _entity_key(entity)
+        with self.store.lock:
+            record = self._plan_write(operation, entity, options, self.store.get(self.table_name, key))
+            self.store.write(self.table_name, [(key, record)])
+        if(record is None):
+            return {}
+        return {"etag" : record[1], "date" : datetime.fromisoformat(record[2])}
+
+    def get(self, partition_key:str, row_key:str, select:Optional[Any] = None):
+        self._check_table()
+        record = self.store.get(self.table_name, (partition_key, row_key))
+        if(record is None):
+            raise _error(ResourceNotFoundError, 404, "ResourceNotFound: the entity does not exist")
+        return _to_entity(record, _select_list(select))
+
+    def transaction(self, operations:Iterable[tuple]):
+        self._check_table()
+        operations = list(operations)
+        if(len(operations) == 0):
+            return []
+        if(len(operations) > MAX_TRANSACTION_SIZE):
+            raise _error(TableTransactionError, 400, f"0:InvalidInput: a transaction can have at most {MAX_TRANSACTION_SIZE} operations")
+        keys = []
+        for index, operation in enumerate(operations):
+            key = _entity_key(operation[1])
+            if(key[0] != _entity_key(operations[0][1])[0]):
+                raise _error(TableTransactionError, 400, f"{index}:CommandsInBatchActOnDifferentPartitions: every entity in a transaction must have the same PartitionKey")
+            if(key in keys):
+                raise _error(TableTransactionError, 400, f"{index}:InvalidDuplicateRow: the transaction changes the same entity more than once")
+            keys.append(key)
+
+        with self.store.lock:
+            changes = []
+            for index, operation in enumerate(operations):
+                options = operation[2] if len(operation) > 2 else {}
+                try:
+                    changes.append((keys[index], self._plan_write(operation[0], operation[1], options, self.store.get(self.table_name, keys[index]))))
+                except HttpResponseError as e:
+                    # Nothing is written if any operation fails
+                    raise _error(TableTransactionError, e.status_code, f"{index}:{e.message}")
+            self.store.write(self.table_name, changes)
+        return [{} if record is None else {"etag" : record[1], "date" : datetime.fromisoformat(record[2])} for _, record in changes]
+
+    def prepare_query(self, query_filter:Optional[str], parameters:Optional[Dict[str, Any]]):
+        # Returns (predicate, bounds) for scan_page, raising like the service does for a bad filter
+        if(query_filter is None or query_filter.strip() == ""):
+            return None, (None, None)
+        query_filter = substitute_parameters(query_filter, parameters)
+        try:
+            node = odata_filter.parse_filter(query_filter)
+        except ValueError as e:
+            raise _error(HttpResponseError, 400, f"InvalidInput: {e}")
+        # Like the service, a filter on PartitionKey only reads the partitions it can match
+        if("Timestamp" in query_filter):
+            # Timestamp is not one of the stored properties, so it is only added when the filter may use it
+            return (lambda values, timestamp: odata_filter.evaluate(node, {**values, "Timestamp" : datetime.fromisoformat(timestamp)})), _partition_bounds(node)
+        return (lambda values, timestamp: odata_filter.evaluate(node, values)), _partition_bounds(node)
+
+    def scan_page(self, predicate:Optional[Callable], bounds:Tuple[Optional[str], Optional[str]], select:Optional[List[str]], page_size:int, continuation:Optional[Dict[str, str]]):
+        # Returns (entities, continuation), where continuation is None when there are no more pages
+        self._check_table()
+        after = None
+        if(continuation is not None):
+            after = (continuation["PartitionKey"], continuation["RowKey"])
+        entities = []
+        last = None
+        for key, record in self.store.scan(self.table_name, after, bounds):
+            if(len(entities) >= page_size):
+                # There is at least one more entity after this page
+                return entities, {"PartitionKey" : last[0], "RowKey" : last[1]}
+            last = key
+            values = decode_entity(record[0])
+            if(predicate is None or predicate(values, record[2])):
+                entities.append(_to_entity(record, select, values))
+        return entities, None
+
+
+class _Pages:
+    # The page iterator returned by by_page, with the continuation token of the next page like the SDK's
+    def __init__(self, table:EmulatedTable, predicate, bounds, select, page_size:int, continuation:Optional[Dict[str, str]], wait:Callable):
+        self.table = table
+        self.predicate = predicate
+        self.bounds = bounds
+        self.select = select
+        self.page_size = page_size
+        self.continuation_token = continuation
+        self.wait = wait
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if(self.done):
+            raise StopIteration
+        self.wait()
+        entities, self.continuation_token = self.table.scan_page(self.predicate, self.bounds, self.select, self.page_size, self.continuation_token)
+        self.done = self.continuation_token is None
+        return iter(entities)
+
+
+class EmulatedItemPaged:
+    # What query_entities and list_entities return, iterating the entities or the pages (by_page) like the SDK's ItemPaged
+    def __init__(self, table:EmulatedTable, query_filter:Optional[str], select:Optional[Any], parameters:Optional[Dict[str, Any]], results_per_page:Optional[int], wait:Callable):
+        self.table = table
+        self.predicate, self.bounds = table.prepare_query(query_filter, parameters)
+        self.select = _select_list(select)
+        self.page_size = min(results_per_page or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        self.wait = wait
+
+    def by_page(self, continuation_token:Optional[Dict[str, str]] = None):
+        return _Pages(self.table, self.predicate, self.bounds, self.select, self.page_size, continuation_token, self.wait)
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+
+class TableClient:
+    '''
+    The emulated (sync) TableClient, with the same methods as the SDK's for the operations this project uses
+    '''
+
+    def __init__(self, store, url:str, table_name:str, latency:float = 0):
+        self.url = url
+        self.table_name = table_name
+        self.latency = latency
+        self._table = EmulatedTable(store, table_name)
+
+    def _wait(self):
+        if(self.latency > 0):
+            time.sleep(self.latency)
+
+    def create_table(self):
+        self._wait()
+        if(not self._table.store.create_table(self.table_name)):
+            raise _error(ResourceExistsError, 409, f"TableAlreadyExists: the table {self.table_name} already exists")
+
+    def delete_table(self):
+        self._wait()
+        self._table.store.delete_table(self.table_name)
+
+    def create_entity(self, entity:Dict[str, Any], **kwargs):
+        self._wait()
+        return self._table.write("create", entity)
+
+    def upsert_entity(self, entity:Dict[str, Any], mode:UpdateMode = UpdateMode.MERGE, **kwargs):
+        self._wait()
+        return self._table.write("upsert", entity, mode=mode)
+
+    def update_entity(self, entity:Dict[str, Any], mode:UpdateMode = UpdateMode.MERGE, *, etag:Optional[str] = None, match_condition:Optional[MatchConditions] = None, **kwargs):
+        self._wait()
+        return self._table.write("update", entity, mode=mode, etag=etag, match_condition=match_condition)
+
+    def delete_entity(self, *args, etag:Optional[str] = None, match_condition:Optional[MatchConditions] = None, **kwargs):
+        self._wait()
+        self._table.write("delete", _delete_target(args, kwargs), etag=etag, match_condition=match_condition)
+
+    def get_entity(self, partition_key:str, row_key:str, *, select:Optional[Any] = None, headers:Optional[Dict[str, str]] = None, **kwargs):
+        self._wait()
+        return self._table.get(partition_key, row_key, select)
+
+    def query_entities(self, query_filter:str, *, results_per_page:Optional[int] = None, select:Optional[Any] = None, parameters:Optional[Dict[str, Any]] = None, **kwargs):
+        return EmulatedItemPaged(self._table, query_filter, select, parameters, results_per_page, self._wait)
+
+    def list_entities(self, *, results_per_page:Optional[int] = None, select:Optional[Any] = None, **kwargs):
+        return EmulatedItemPaged(self._table, None, select, None, results_per_page, self._wait)
+
+    def submit_transaction(self, operations:Iterable[tuple], **kwargs):
+        self._wait()
+        return self._table.transaction(operations)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _delete_target(args:tuple, kwargs:Dict[str, Any]):
+    # delete_entity takes either an entity, or a PartitionKey and RowKey
+    entity = kwargs.pop("entity", None) or (args[0] if len(args) == 1 else None)
+    if(entity is not None):
+        return entity
+    partition_key = kwargs.pop("partition_key", args[0] if len(args) > 0 else None)
+    row_key = kwargs.pop("row_key", args[1] if len(args) > 1 else None)
+    return {"PartitionKey" : partition_key, "RowKey" : row_key}
+
+
+class TableServiceClient:
+    '''
+    The emulated (sync) TableServiceClient (see the top of this module for the connection strings)
+    '''
+
+    def __init__(self, conn_str:str):
+        self.store, self.url, self.latency = open_store(conn_str)
+
+    @classmethod
+    def from_connection_string(cls, conn_str:str, **kwargs):
+        return cls(conn_str)
+
+    def get_table_client(self, table_name:str):
+        return TableClient(self.store, self.url, table_name, self.latency)
+
+    def create_table_if_not_exists(self, table_name:str):
+        if(self.latency > 0):
+            time.sleep(self.latency)
+        self.store.create_table(table_name)
+        return self.get_table_client(table_name)
+
+    def delete_table(self, table_name:str):
+        if(self.latency > 0):
+            time.sleep(self.latency)
+        self.store.delete_table(table_name)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _AsyncPage:
+    def __init__(self, entities:List[TableEntity]):
+        self.entities = entities
+
+    async def __aiter__(self):
+        for entity in self.entities:
+            yield entity
+
+
+class _AsyncPages:
+    # The async page iterator returned by by_page
+    def __init__(self, pages:_Pages, latency:float):
+        self.pages = pages
+        self.latency = latency
+
+    @property
+    def continuation_token(self):
+        return self.pages.continuation_token
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if(self.pages.done):
+            raise StopAsyncIteration
+        if(self.latency > 0):
+            await asyncio.sleep(self.latency)
+        return _AsyncPage(list(next(self.pages)))
+
+
+class AsyncEmulatedItemPaged:
+    def __init__(self, paged:EmulatedItemPaged, latency:float):
+        self.paged = paged
+        self.latency = latency
+
+    def by_page(self, continuation_token:Optional[Dict[str, str]] = None):
+        return _AsyncPages(self.paged.by_page(continuation_token), self.latency)
+
+    async def __aiter__(self):
+        async for page in self.by_page():
+            async for entity in page:
+                yield entity
+
+
+class AsyncTableClient:
+    '''
+    The emulated async TableClient (the counterpart of azure.data.tables.aio.TableClient)
+    '''
+
+    def __init__(self, store, url:str, table_name:str, latency:float = 0):
+        self.url = url
+        self.table_name = table_name
+        self.latency = latency
+        self._table = EmulatedTable(store, table_name)
+
+    async def _wait(self):
+        if(self.latency > 0):
+            await asyncio.sleep(self.latency)
+
+    async def create_table(self):
+        await self._wait()
+        if(not self._table.store.create_table(self.table_name)):
+            raise _error(ResourceExistsError, 409, f"TableAlreadyExists: the table {self.table_name} already exists")
+
+    async def delete_table(self):
+        await self._wait()
+        self._table.store.delete_table(self.table_name)
+
+    async def create_entity(self, entity:Dict[str, Any], **kwargs):
+        await self._wait()
+        return self._table.write("create", entity)
+
+    async def upsert_entity(self, entity:Dict[str, Any], mode:UpdateMode = UpdateMode.MERGE, **kwargs):
+        await self._wait()
+        return self._table.write("upsert", entity, mode=mode)
+
+    async def update_entity(self, entity:Dict[str, Any], mode:UpdateMode = UpdateMode.MERGE, *, etag:Optional[str] = None, match_condition:Optional[MatchConditions] = None, **kwargs):
+        await self._wait()
+        return self._table.write("update", entity, mode=mode, etag=etag, match_condition=match_condition)
+
+    async def delete_entity(self, *args, etag:Optional[str] = None, match_condition:Optional[MatchConditions] = None, **kwargs):
+        await self._wait()
+        self._table.write("delete", _delete_target(args, kwargs), etag=etag, match_condition=match_condition)
+
+    async def get_entity(self, partition_key:str, row_key:str, *, select:Optional[Any] = None, headers:Optional[Dict[str, str]] = None, **kwargs):
+        await self._wait()
+        return self._table.get(partition_key, row_key, select)
+
+    def query_entities(self, query_filter:str, *, results_per_page:Optional[int] = None, select:Optional[Any] = None, parameters:Optional[Dict[str, Any]] = None, **kwargs):
+        return AsyncEmulatedItemPaged(EmulatedItemPaged(self._table, query_filter, select, parameters, results_per_page, lambda: None), self.latency)
+
+    def list_entities(self, *, results_per_page:Optional[int] = None, select:Optional[Any] = None, **kwargs):
+        return AsyncEmulatedItemPaged(EmulatedItemPaged(self._table, None, select, None, results_per_page, lambda: None), self.latency)
+
+    async def submit_transaction(self, operations:Iterable[tuple], **kwargs):
+        await self._wait()
+        return self._table.transaction(operations)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncTableServiceClient:
+    '''
+    The emulated async TableServiceClient (the counterpart of azure.data.tables.aio.TableServiceClient)
+    '''
+
+    def __init__(self, conn_str:str):
+        self.store, self.url, self.latency = open_store(conn_str)
+
+    @classmethod
+    def from_connection_string(cls, conn_str:str, **kwargs):
+        return cls(conn_str)
+
+    def get_table_client(self, table_name:str):
+        return AsyncTableClient(self.store, self.url, table_name, self.latency)
+
+    async def create_table_if_not_exists(self, table_name:str):
+        if(self.latency > 0):
+            await asyncio.sleep(self.latency)
+        self.store.create_table(table_name)
+        return self.get_table_client(table_name)
+
+    async def delete_table(self, table_name:str):
+        if(self.latency > 0):
+            await asyncio.sleep(self.latency)
+        self.store.delete_table(table_name)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
@@ -0,0 +1,177 @@
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+import entity_json
+import json
+import os
+import sqlite3
+import sys
+import table_api
+
+# Incremental table mirror for the table_api CLI (python table_api.py sync ...)
+#
+# The first sync copies every entry, and each sync after that only asks for what changed since the last one (see table_api.changes):
+# changed entries replace their old copy and deleted ones (found through their tombstones) are removed, so the table is never read in full again
+# With a query, the changes are checked against it after they are read, so an entry changed so that it no longer meets the query is removed too
+# The mirror is either a JSON lines file (one entry per line, with the watermark kept next to it in <path>.sync),
+# or a SQLite database (.db, .sqlite or .sqlite3) with the entries and the watermark in the same file
+
+
+
+FORMATS = ("jsonl", "sqlite")
+# Where changes without a Timestamp go
+_EARLIEST = datetime.min.replace(tzinfo=timezone.utc)
+
+
+def ordered_changes(changes:Dict[str, Any]):
+    '''
+    Put the changed entries and deleted keys returned by table_api.changes in the order they happened,
+    so an entry deleted and then published again (or the other way around) ends up the way it is in the table
+
+    Parameters:
+    - changes (required): what table_api.changes returned
+
+    Return:
+    a list of ("upsert", entry) and ("delete", keys) tuples, oldest first
+    '''
+
+    operations = [(entity.get("Timestamp"), 1, "upsert", entity) for entity in changes["changed"]]
+    # Deletes go first when an entry was written at the same time as its tombstone, so the entry is kept
+    operations += [(tombstone.get("Timestamp"), 0, "delete", tombstone) for tombstone in changes["deleted"]]
+    operations.sort(key=lambda operation: (operation[0] or _EARLIEST, operation[1]))
+    return [(operation, item) for _, _, operation, item in operations]
+
+
+def _key(entity:Dict[str, Any]):
+    return (entity["PartitionKey"], entity["RowKey"])
+
+
+class JsonlMirror:
+    # The file is read, changed and written to a temporary file which then replaces it, so a failed sync leaves the last copy whole
+    # The watermark is saved after the entries, so if saving it fails the next sync only applies the same changes again
+    def __init__(self, path:str):
+        self.path = path
+        self.state_path = path + ".sync"
+
+    def load_state(self):
+        if(not os.path.exists(self.state_path) or not os.path.exists(self.path)):
+            return None
+        with open(self.state_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def apply(self, changes:Dict[str, Any], state:Dict[str, Any], full:bool):
+        lines = {}
+        if(not full and os.path.exists(self.path)):
+            with open(self.path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if(line.strip() != ""):
+                        lines[_key(json.loads(line))] = line.rstrip("\n")
+        for operation, item in ordered_changes(changes):
+            if(operation == "upsert"):
+                lines[_key(item)] = entity_json.dumps(item).decode("utf-8")
+            else:
+                lines.pop(_key(item), None)
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8", newline="\n") as file:
+            # Ordered like the table, so the file only changes where the entries did
+            file.write("".join(lines[key] + "\n" for key in sorted(lines)))
+        os.replace(temporary_path, self.path)
+        with open(self.state_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(self.state_path + ".tmp", self.state_path)
+        return len(lines)
+
+    def close(self):
+        pass
+
+
+class SqliteMirror:
+    # The changes and the new watermark are written in one transaction, so the mirror and its watermark always agree
+    def __init__(self, path:str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS entities (
+                partition_key TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                timestamp TEXT,
+                entity TEXT NOT NULL,
+                PRIMARY KEY (partition_key, row_key)
+            )""")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+
+    def load_state(self):
+        row = self.connection.execute("SELECT value FROM sync_state WHERE key = 'state'").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def apply(self, changes:Dict[str, Any], state:Dict[str, Any], full:bool):
+        with self.connection:
+            if(full):
+                self.connection.execute("DELETE FROM entities")
+            for operation, item in ordered_changes(changes):
+                if(operation == "upsert"):
+                    timestamp = item.get("Timestamp")
+                    self.connection.execute("INSERT OR REPLACE INTO entities (partition_key, row_key, timestamp, entity) VALUES (?, ?, ?, ?)",
+                        (item["PartitionKey"], item["RowKey"], None if timestamp is None else timestamp.isoformat(), entity_json.dumps(item).decode("utf-8")))
+                else:
+                    self.connection.execute("DELETE FROM entities WHERE partition_key = ? AND row_key = ?", _key(item))
+            self.connection.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('state', ?)", (json.dumps(state),))
+        return self.connection.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def sync_table(table:table_api.TableClient, mirror, query_str:Optional[str] = None, fields:Optional[List[str]] = None, full:bool = False):
+    '''
+    Bring a mirror of a table up to date, with only the changes since the last sync
+
+    Parameters:
+    - table (required): a TableClient which points to the table to mirror
+    - mirror (required): a JsonlMirror or SqliteMirror
+    - query_str: only mirror the entries which meet this query (see table_api.query for formatting)
+    - fields: only mirror these fields. None mirrors all fields
+    - full: copy the whole table again, instead of only the changes
+
+    Return:
+    a dictionary with how many entries "changed" and were "deleted", how many "entries" the mirror has, whether it was a "full" copy and the new "watermark"
+    '''
+
+    # A mirror made from another table, query or fields can't be brought up to date with changes, so it is copied again
+    source = {"table" : f"{table.url}/{table.table_name}", "query" : query_str, "fields" : fields}
+    state = mirror.load_state()
+    since = None
+    if(not full and state is not None):
+        if(state.get("source") == source):
+            since = state.get("watermark")
+        else:
+            print("Warning: the mirror was made from another table, query or fields, so the whole table is copied again", file=sys.stderr)
+    if(since is not None and table_api.tombstone_table(table) is None):
+        print("Warning: deleted entries are not tracked (TABLE_TOMBSTONES is off), so they stay in the mirror until it is copied again with --full", file=sys.stderr)
+
+    changes = table_api.changes(table, since, query_str, fields)
+    entries = mirror.apply(changes, {"source" : source, "watermark" : changes["watermark"]}, full=since is None)
+    return {"changed" : len(changes["changed"]), "deleted" : len(changes["deleted"]), "entries" : entries, "full" : since is None, "watermark" : changes["watermark"]}
+
+
+def cli_sync(connection_string:str, mirror_path:str, mirror_format:Optional[str] = None, query_str:Optional[str] = None, fields:Optional[List[str]] = None, full:bool = False):
+    if(mirror_format is None):
+        extension = os.path.splitext(mirror_path)[1].lower().lstrip(".")
+        mirror_format = "sqlite" if extension in ("db", "sqlite", "sqlite3") else "jsonl"
+    if(mirror_format not in FORMATS):
+        raise Exception(f"Unknown mirror format '{mirror_format}', use one of: {', '.join(FORMATS)}")
+    if(fields is not None and len(fields) == 0):
+        fields = None
+
+    table = table_api.get_table(connection_string, table_api.DEFAULT_TABLE_NAME)
+    mirror = SqliteMirror(mirror_path) if mirror_format == "sqlite" else JsonlMirror(mirror_path)
+    try:
+        summary = sync_table(table, mirror, query_str, fields, full)
+    finally:
+        mirror.close()
+
+    if(summary["full"]):
+        print("Successfully copied {} entries to {}".format(summary["entries"], mirror_path), file=sys.stderr)
+    else:
+        print("Successfully synced {} changed and {} deleted entries to {} ({} entries)".format(summary["changed"], summary["deleted"], mirror_path, summary["entries"]), file=sys.stderr)
@@ -0,0 +1,195 @@
+from azure.data.tables import EdmType, EntityProperty
+from datetime import datetime, timezone
+from uuid import UUID
+import odata_filter
+import pytest
+
+
+
+def comparison(query:str):
+    node = odata_filter.parse_filter(query)
+    assert isinstance(node, odata_filter.Comparison)
+    return node
+
+
+@pytest.mark.parametrize("query, keys", [
+    ("PartitionKey eq 'p' and RowKey eq 'r'", [("p", "r")]),
+    ("RowKey eq 'r' and PartitionKey eq 'p'", [("p", "r")]),
+    # The value can be on either side
+    ("'p' eq PartitionKey and 'r' eq RowKey", [("p", "r")]),
+    ("(PartitionKey eq 'p' and RowKey eq 'a') or (PartitionKey eq 'q' and RowKey eq 'b')", [("p", "a"), ("q", "b")]),
+    # The same key twice is only read once
+    ("(PartitionKey eq 'p' and RowKey eq 'a') or (RowKey eq 'a' and PartitionKey eq 'p')", [("p", "a")]),
+    ("PartitionKey eq 'it''s' and RowKey eq 'r'", [("it's", "r")]),
+])
+def test_key_lookups_become_point_reads(query, keys):
+    plan = odata_filter.plan_query(query)
+    assert plan.kind == odata_filter.POINT_READ
+    assert plan.keys == keys
+    assert plan.partitions == list(dict.fromkeys(key[0] for key in keys))
+    assert plan.explain()["keys"] == [{"PartitionKey" : partition_key, "RowKey" : row_key} for partition_key, row_key in keys]
+
+
+@pytest.mark.parametrize("query, kind, partitions", [
+    (None, odata_filter.SCAN, []),
+    ("  ", odata_filter.SCAN, []),
+    ("PartitionKey eq 'p'", odata_filter.PARTITION, ["p"]),
+    ("PartitionKey eq 'p' and RowKey gt 'a'", odata_filter.PARTITION, ["p"]),
+    # Can never match, but is not a lookup of one entry
+    ("PartitionKey eq 'p' and RowKey eq 'a' and RowKey eq 'b'", odata_filter.PARTITION, ["p"]),
+    ("(PartitionKey eq 'p' and RowKey eq 'a') or PartitionKey eq 'q'", odata_filter.PARTITION, ["p", "q"]),
+    ("PartitionKey eq 'p' and RowKey eq 'a' and v eq 1", odata_filter.PARTITION, ["p"]),
+    ("RowKey eq 'a'", odata_filter.SCAN, []),
+    ("PartitionKey ne 'p' and RowKey eq 'a'", odata_filter.SCAN, []),
+    ("PartitionKey eq 'p' or v eq 1", odata_filter.SCAN, []),
+    ("not (PartitionKey eq 'p' and RowKey eq 'a')", odata_filter.SCAN, []),
+])
+def test_other_queries_are_not_point_reads(query, kind, partitions):
+    plan = odata_filter.plan_query(query)
+    assert plan.kind == kind
+    assert plan.keys == []
+    assert plan.partitions == partitions
+
+
+@pytest.mark.parametrize("literal, value", [
+    ("'text'", "text"),
+    ("'O''Brien'", "O'Brien"),
+    ("''", ""),
+    ("42", 42),
+    ("-7", -7),
+    ("42L", 42),
+    ("2.5", 2.5),
+    ("2D", 2.0),
+    ("1e3", 1000.0),
+    ("true", True),
+    ("False", False),
+    ("datetime'2024-01-31T12:00:00Z'", datetime(2024, 1, 31, 12, tzinfo=timezone.utc)),
+    ("datetime'2024-01-31T12:00:00.5+00:00'", datetime(2024, 1, 31, 12, 0, 0, 500000, tzinfo=timezone.utc)),
+    ("guid'c9da6455-213d-42c9-9a79-3e9149a57833'", UUID("c9da6455-213d-42c9-9a79-3e9149a57833")),
+    ("binary'0aff'", b"\x0a\xff"),
+    ("X'0aff'", b"\x0a\xff"),
+])
+def test_typed_literals(literal, value):
+    node = comparison(f"v eq {literal}")
+    assert node.field == "v"
+    assert node.op == "eq"
+    assert node.value == value
+    assert type(node.value) == type(value)
+
+
+def test_literal_on_the_left_flips_the_operator():
+    node = comparison("5 lt v")
+    assert (node.field, node.op, node.value) == ("v", "gt", 5)
+
+
+def test_keywords_are_case_insensitive():
+    node = odata_filter.parse_filter("a EQ 1 AND NOT b Eq 2 OR c eq 3")
+    assert isinstance(node, odata_filter.Or)
+    assert isinstance(node.left, odata_filter.And)
+    assert isinstance(node.left.right, odata_filter.Not)
+
+
+def test_and_binds_tighter_than_or():
+    node = odata_filter.parse_filter("a eq 1 or b eq 2 and c eq 3")
+    assert isinstance(node, odata_filter.Or)
+    assert isinstance(node.right, odata_filter.And)
+
+
+def test_parentheses_group():
+    node = odata_filter.parse_filter("(a eq 1 or b eq 2) and c eq 3")
+    assert isinstance(node, odata_filter.And)
+    assert isinstance(node.left, odata_filter.Or)
+
+
+def test_not_applies_to_the_next_factor():
+    node = odata_filter.parse_filter("not a eq 1 and b eq 2")
+    assert isinstance(node, odata_filter.And)
+    assert isinstance(node.left, odata_filter.Not)
+    node = odata_filter.parse_filter("not (a eq 1 and b eq 2)")
+    assert isinstance(node, odata_filter.Not)
+    assert isinstance(node.operand, odata_filter.And)
+    node = odata_filter.parse_filter("not not a eq 1")
+    assert isinstance(node.operand, odata_filter.Not)
+
+
+@pytest.mark.parametrize("query, message", [
+    ("", "empty"),
+    ("v eq 'open", "missing its closing quote"),
+    ("v eq 1 & w eq 2", "unexpected character '&'"),
+    ("v 1", "expected one of eq"),
+    ("v eq", "found the end of the query"),
+    ("v eq 1 w eq 2", "expected and, or or the end of the query"),
+    ("(v eq 1", "expected ')'"),
+    ("v eq 1)", "expected and, or or the end of the query"),
+    ("v eq and", "expected a field name or value"),
+    ("1 eq 2", "needs a field name on one side"),
+    ("v eq w", "compares two fields"),
+    ("PartitionKey eq 1", "can only be compared with a string"),
+    ("RowKey eq true", "can only be compared with a string"),
+    ("v eq datetime'yesterday'", "is not a valid value"),
+    ("v eq guid'1234'", "is not a valid value"),
+    ("v eq binary'xyz'", "is not a valid value"),
+    (" or ".join(["v eq 1"] * (odata_filter.MAX_COMPARISONS + 1)), "at most 15 comparisons"),
+])
+def test_rejected_queries(query, message):
+    with pytest.raises(ValueError, match="Invalid query") as error:
+        odata_filter.parse_filter(query)
+    assert message in str(error.value)
+
+
+def test_the_most_comparisons_allowed():
+    odata_filter.parse_filter(" or ".join(["v eq 1"] * odata_filter.MAX_COMPARISONS))
+
+
+ENTITY = {
+    "PartitionKey" : "p",
+    "RowKey" : "r",
+    "name" : "O'Brien",
+    "count" : 3,
+    "big" : EntityProperty(2 ** 40, EdmType.INT64),
+    "ratio" : 0.5,
+    "enabled" : True,
+    # Read from the database without a timezone, which means UTC
+    "seen" : datetime(2024, 1, 31, 12),
+    "id" : UUID("c9da6455-213d-42c9-9a79-3e9149a57833"),
+    "empty" : None,
+}
+
+
+@pytest.mark.parametrize("query, matches", [
+    ("PartitionKey eq 'p' and RowKey eq 'r'", True),
+    ("name eq 'O''Brien'", True),
+    ("name gt 'N'", True),
+    ("count eq 3", True),
+    ("count eq 3.0", True),
+    ("count ge 4", False),
+    ("ratio lt 1", True),
+    ("big eq 1099511627776L", True),
+    ("enabled eq true", True),
+    ("enabled ne false", True),
+    ("seen eq datetime'2024-01-31T12:00:00Z'", True),
+    ("seen lt datetime'2024-01-31T11:00:00-02:00'", True),
+    ("id eq guid'c9da6455-213d-42c9-9a79-3e9149a57833'", True),
+    # Values of different types never match
+    ("count eq '3'", False),
+    ("count ne '3'", False),
+    ("enabled eq 1", False),
+    ("name lt 5", False),
+    # A missing (or null) field never matches, not even ne
+    ("missing ne 1", False),
+    ("empty eq 1", False),
+    ("empty ne 1", False),
+    ("not missing eq 1", True),
+    ("not (count eq 3)", False),
+    ("count eq 1 or name eq 'O''Brien'", True),
+    ("count eq 3 and (enabled eq false or ratio eq 0.5)", True),
+    ("count eq 3 and not (enabled eq true or ratio eq 0.5)", False),
+])
+def test_evaluate(query, matches):
+    assert odata_filter.evaluate(odata_filter.parse_filter(query), ENTITY) == matches
+
+
+def test_query_fields():
+    node = odata_filter.parse_filter("count eq 3 and (not name eq 'a' or count gt 1) or RowKey eq 'r'")
+    assert odata_filter.query_fields(node) == ["count", "name", "RowKey"]
+    assert odata_filter.query_fields(None) == []
@@ -0,0 +1,296 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+import asyncio
+import threading
+import time
+
+
+class TTLCache:
+    '''
+    A thread safe, size-bounded in-memory cache where each entry expires after ttl seconds
+    When the cache is full, the least recently used entry is evicted
+
+    Loading goes through get_or_load (or aget_or_load for coroutines), which is single-flight:
+    if many callers miss on the same key at the same time, only one of them runs the loader and the rest wait for its result
+
+    With keep_expired, expired entries stay (until evicted) so peek can still return them,
+    which lets callers cheaply revalidate an expired value (ie with an ETag) and then refresh it
+
+    Every invalidate bumps the key's generation, and a value loaded before that is not stored (see generation and put),
+    so a load which races with an update can't put the old value back in the cache
+    '''
+
+    def __init__(self, max_size:int = 1024, ttl:float = 60, cache_none:bool = False, keep_expired:bool = False):
+        '''
+        Parameters:
+        - max_size: the maximum number of entries to keep, 0 disables the cache
+        - ttl: how many seconds an entry stays valid, 0 disables the cache
+        - cache_none: whether a None result from a loader should be cached (negative caching)
+        - keep_expired: whether expired entries are kept so they can be revalidated
+        '''
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_none = cache_none
+        self.keep_expired = keep_expired
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self._entries:"OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading:Dict[Hashable, threading.Event] = {}
+        self._async_loading:Dict[Hashable, asyncio.Task] = {}
+        # The generation of each recently invalidated key (bounded like the entries), and how many generations were dropped
+        # A dropped generation could hide an invalidate, so any load that started before one was dropped is not stored
+        self._generations:"OrderedDict[Hashable, int]" = OrderedDict()
+        self._dropped_generations = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def _lookup(self, key:Hashable):
+        # Must be called while holding the lock, returns (found, value)
+        entry = self._entries.get(key)
+        if(entry is None):
+            return False, None
+        value, expires = entry
+        if(expires <= time.monotonic()):
+            if(not self.keep_expired):
+                del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _generation(self, key:Hashable):
+        # Must be called while holding the lock
+        return (self._dropped_generations, self._generations.get(key, 0))
+
+    def generation(self, key:Hashable):
+        '''
+        Get the current generation of a key, to pass to put after loading its value
+
+        Parameters:
+        - key (required): the key to look up
+
+        Return:
+        an opaque value which changes whenever the key is invalidated
+        '''
+
+        with self._lock:
+            return self._generation(key)
+
+    def get(self, key:Hashable, default:Any = None):
+        '''
+        Get a cached value without loading it
+
+        Parameters:
+        - key (required): the key to look up
+        - default: what to return if the key is not cached (or has expired)
+
+        Return:
+        the cached value, or default
+        '''
+
+        with self._lock:
+            found, value = self._lookup(key)
+            if(found):
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def peek(self, key:Hashable):
+        '''
+        Get a cached value even if it has expired (only useful with keep_expired)
+
+        Parameters:
+        - key (required): the key to look up
+
+        Return:
+        a tuple (found, value, fresh), where fresh is False if the value has expired and should be revalidated
+        '''
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if(entry is None):
+                self.misses += 1
+                return False, None, False
+            value, expires = entry
+            self._entries.move_to_end(key)
+            if(expires <= time.monotonic()):
+                self.misses += 1
+                return True, value, False
+            self.hits += 1
+            return True, value, True
+
+    def refresh(self, key:Hashable):
+        '''
+        Mark an expired value as valid again for another ttl seconds (ie after revalidating it)
+
+        Parameters:
+        - key (required): the key to refresh
+
+        Return: None
+        '''
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if(entry is not None):
+                self._entries[key] = (entry[0], time.monotonic() + self.ttl)
+                self.revalidations += 1
+
+    def put(self, key:Hashable, value:Any, ttl:Optional[float] = None, generation:Optional[tuple] = None):
+        '''
+        Add or replace a cached value
+
+        Parameters:
+        - key (required): the key to store the value under
+        - value (required): the value to store
+        - ttl: how many seconds this entry stays valid, defaults to the cache's ttl
+        - generation: the key's generation from before the value was loaded (see generation).
+          If the key was invalidated since, the value may be stale and is not stored
+
+        Return: None
+        '''
+
+        if(not self.enabled):
+            return
+        if(value is None and not self.cache_none):
+            return
+        if(ttl is None):
+            ttl = self.ttl
+        with self._lock:
+            if(generation is not None and generation != self._generation(key)):
+                return
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while(len(self._entries) > self.max_size):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key:Optional[Hashable] = None):
+        '''
+        Remove an entry from the cache
+
+        Parameters:
+        - key: the key to remove. None removes every entry
+
+        Return: None
+        '''
+
+        with self._lock:
+            if(key is None):
+                self._entries.clear()
+                self._generations.clear()
+                self._dropped_generations += 1
+            else:
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._generations.move_to_end(key)
+                if(len(self._generations) > max(self.max_size, 1)):
+                    self._generations.popitem(last=False)
+                    self._dropped_generations += 1
+
+    def get_or_load(self, key:Hashable, loader:Callable[[], Any]):
+        '''
+        Get a cached value, or load and cache it if missing. Safe to call from many threads
+
+        Parameters:
+        - key (required): the key to look up
+        - loader (required): a function with no arguments returning the value for key
+
+        Return:
+        the cached or freshly loaded value
+        '''
+
+        if(not self.enabled):
+            return loader()
+        while(True):
+            with self._lock:
+                found, value = self._lookup(key)
+                if(found):
+                    self.hits += 1
+                    return value
+                event = self._loading.get(key)
+                if(event is None):
+                    self.misses += 1
+                    event = threading.Event()
+                    self._loading[key] = event
+                    generation = self._generation(key)
+                    break
+            # Someone else is already loading this key, wait for them and check again
+            event.wait()
+
+        try:
+            value = loader()
+            self.put(key, value, generation=generation)
+            return value
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    async def _aload(self, key:Hashable, loader:Callable[[], Awaitable[Any]], generation:tuple):
+        # The load shared by every aget_or_load caller on key, run as its own task so it is never cancelled along with one of them
+        try:
+            value = await loader()
+            self.put(key, value, generation=generation)
+            return value
+        finally:
+            with self._lock:
+                del self._async_loading[key]
+
+    async def aget_or_load(self, key:Hashable, loader:Callable[[], Awaitable[Any]]):
+        '''
+        The coroutine version of get_or_load. Concurrent callers on the same event loop share one loader call
+        The loader runs in its own task, so it keeps going for the other callers (and is still cached) if the one which started it is cancelled
+
+        Parameters:
+        - key (required): the key to look up
+        - loader (required): a function with no arguments returning an awaitable of the value for key
+
+        Return:
+        the cached or freshly loaded value
+        '''
+
+        if(not self.enabled):
+            return await loader()
+        with self._lock:
+            found, value = self._lookup(key)
+            if(found):
+                self.hits += 1
+                return value
+            task = self._async_loading.get(key)
+            if(task is None):
+                self.misses += 1
+                task = asyncio.ensure_future(self._aload(key, loader, self._generation(key)))
+                # Mark the exception as retrieved in case every caller was cancelled before it finished
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
+                self._async_loading[key] = task
+            else:
+                # Waiting on someone else's load still saves a lookup
+                self.hits += 1
+
+        # shield, so a caller being cancelled does not cancel the load for everyone
+        return await asyncio.shield(task)
+
+    def stats(self):
+        '''
+        Get the cache statistics
+
+        Return:
+        a dictionary with the size, max size, ttl, hit, miss and eviction counts of the cache
+        '''
+
+        with self._lock:
+            return {
+                "size" : len(self._entries),
+                "max_size" : self.max_size,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "revalidations" : self.revalidations
+            }